@@ -33,13 +33,20 @@ bl_info = {
     "tracker_url": "https://github.com/clarkx/VisionHDR/issues",
     "category": "Render"}
 
-import bpy, bgl, os, blf
+import bpy, bgl, os, sys, blf, hashlib, time, json, csv, subprocess, fnmatch
+import bpy.utils.previews
 from bpy_extras import view3d_utils
 from mathutils import Vector, Matrix, Quaternion, Euler
 from bpy.types import PropertyGroup, Panel, Operator
 from bpy.props import IntProperty, FloatProperty, BoolProperty, FloatVectorProperty, EnumProperty, StringProperty, CollectionProperty, PointerProperty
 from bpy_extras.view3d_utils import location_3d_to_region_2d
+from bpy.app.handlers import persistent
+from mathutils.bvhtree import BVHTree
+import numpy as np
 import math
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import functools
 
 #########################################################################################################
 
@@ -50,11 +57,181 @@ def update_panel(self, context):
         bpy.utils.unregister_class(VISIONHDR_PT_Init)
     except:
         pass
-    VISIONHDR_PT_Init.bl_category = context.user_preferences.addons[__name__].preferences.category
+    prefs = get_preferences()
+    if prefs is not None:
+        VISIONHDR_PT_Init.bl_category = prefs.category
     bpy.utils.register_class(VISIONHDR_PT_Init)
     
 #########################################################################################################
 
+#########################################################################################################
+def get_preferences():
+    """Return the preferences of the addon or None if the addon is not enabled"""
+    addon = bpy.context.user_preferences.addons.get(__name__)
+    if addon is None:
+        return None
+    return addon.preferences
+
+#########################################################################################################
+
+#########################################################################################################
+def update_proxy(self, context):
+    """Relink the images of the lights after a change of the proxy resolution"""
+    for graph in _world_graphs.values():
+        graph.topology = None
+    for cobj in list(get_index(context.scene, rebuild=True).objects.values()):
+        if cobj.type != 'EMPTY' and cobj.data.name.startswith("VisionHDR"):
+            update_mat(cobj.VisionHDR, context)
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRSection():
+    """Context manager timing a section of code with the profiler"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRNullSection():
+    """Context manager doing nothing when the profiler is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_section = VisionHDRNullSection()
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRProfiler():
+    """Timings of the hot paths : the last calls in ring buffers and a trace of the events"""
+
+    def __init__(self, size=256, trace_size=100000):
+        self.enabled = False
+        self.size = size
+        self.trace_size = trace_size
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.counts = {}
+        self.trace = deque(maxlen=self.trace_size)
+        self.origin = time.perf_counter()
+        self.event = ""
+        self.breakdown = {}
+        self.last_event = ""
+        self.last_breakdown = {}
+        self.update_start = None
+
+    def section(self, name):
+        """Return a context manager timing the code of the block"""
+        if not self.enabled:
+            return _null_section
+        return VisionHDRSection(self, name)
+
+    def record(self, name, start, duration):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = deque(maxlen=self.size)
+            self.counts[name] = 0
+        stats.append(duration)
+        self.counts[name] += 1
+        self.breakdown[name] = self.breakdown.get(name, 0.0) + duration
+        self.trace.append((name, start, duration))
+
+    def begin_event(self, name):
+        """Start the breakdown of a new event of a modal operator"""
+        if not self.enabled:
+            return
+        if self.breakdown:
+            self.last_event = self.event
+            self.last_breakdown = self.breakdown
+        self.event = name
+        self.breakdown = {}
+
+    def summary(self):
+        """Return the name, number of calls, last, mean and max time in ms of each section"""
+        return [(name, self.counts[name], stats[-1] * 1e3, sum(stats) / len(stats) * 1e3, max(stats) * 1e3)
+                for name, stats in sorted(self.stats.items())]
+
+    def export(self, filepath):
+        """Write the trace in the Chrome trace format (chrome://tracing)"""
+        events = [{"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (start - self.origin) * 1e6, "dur": duration * 1e6}
+                  for name, start, duration in self.trace]
+        with open(filepath, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+_profiler = VisionHDRProfiler()
+
+def profiled(name=None):
+    """Decorator timing the function with the profiler, a single test when disabled"""
+    def decorator(function):
+        label = name or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _profiler.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _profiler.record(label, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def profiler_update_pre(scene):
+    """Start timing the update of the scene following the changes of the addon"""
+    if _profiler.enabled:
+        _profiler.update_start = time.perf_counter()
+
+@persistent
+def profiler_update_post(scene):
+    """Time the update of the scene"""
+    if _profiler.enabled and _profiler.update_start is not None:
+        _profiler.record("scene_update", _profiler.update_start, time.perf_counter() - _profiler.update_start)
+        _profiler.update_start = None
+
+#########################################################################################################
+
+#########################################################################################################
+def update_profiling(self, context):
+    """Enable or disable the profiler from the preferences"""
+    _profiler.reset()
+    _profiler.enabled = self.profiling
+
+#########################################################################################################
+
+#########################################################################################################
+def draw_profiler(left, top):
+    """Draw the timings of the last event and of the sections"""
+    lines = ["%s : %s" % (_profiler.last_event, "  ".join("%s %.2f" % (name, duration * 1e3) for name, duration in sorted(_profiler.last_breakdown.items())))]
+    lines += ["%-20s %6d calls  last %7.2f  mean %7.2f  max %7.2f ms" % line for line in _profiler.summary()]
+    blf.size(0, 11, 72)
+    for i, line in enumerate(lines):
+        blf.position(0, left, top - 14 * (i + 1), 0)
+        blf.draw(0, line)
+
+#########################################################################################################
+
 #########################################################################################################
 class VisionHDRPrefs(bpy.types.AddonPreferences):
     """Preferences"""
@@ -75,6 +252,86 @@ class VisionHDRPrefs(bpy.types.AddonPreferences):
             default="VisionHDR",
             update=update_panel,
             )
+
+    update_mode = bpy.props.EnumProperty(
+            name="Updates",
+            description="How the image options are applied to the world while a slider is dragged",
+            items=(
+            ("IMMEDIATE", "Immediate", "Update the world on each change of the slider"),
+            ("COALESCE", "Coalesce", "Update the world at most at the update rate"),
+            ("RELEASE", "Apply on release", "Update the world once the slider stops moving"),
+            ),
+            default="COALESCE",
+            )
+
+    update_rate = bpy.props.FloatProperty(
+            name="Update rate",
+            description="Maximum number of updates of the world per second",
+            min=1.0, max=240.0,
+            default=30.0,
+            )
+
+    release_delay = bpy.props.FloatProperty(
+            name="Release delay",
+            description="Time without change of the slider before applying the update (seconds)",
+            min=0.01, max=2.0,
+            default=0.15,
+            )
+
+    proxy_resolution = bpy.props.EnumProperty(
+            name="Proxy",
+            description="Resolution of the images used in the viewport.\n"+\
+            "The full resolution images are used for the final renders",
+            items=(
+            ("NONE", "Full resolution", ""),
+            ("1024", "1K", ""),
+            ("2048", "2K", ""),
+            ("4096", "4K", ""),
+            ),
+            default="2048",
+            update=update_proxy,
+            )
+
+    library_paths = bpy.props.StringProperty(
+            name="Library",
+            description="Directories of the HDRI library, separated by ';'",
+            default="",
+            )
+
+    worker_count = bpy.props.IntProperty(
+            name="Workers",
+            description="Number of background Blender processes used to read the images",
+            min=1, max=64,
+            default=2,
+            )
+
+    cache_size = bpy.props.IntProperty(
+            name="Cache size (MB)",
+            description="Maximum size on disk of the cache of the image analysis",
+            min=1,
+            default=512,
+            )
+
+    raycast_threshold = bpy.props.IntProperty(
+            name="Raycast threshold",
+            description="Motion of the mouse in pixels before the light is raycast again in edit mode",
+            min=0, max=50,
+            default=2,
+            )
+
+    raycast_rate = bpy.props.FloatProperty(
+            name="Raycast rate",
+            description="Maximum number of raycasts of the light per second in edit mode, the refresh rate of the display",
+            min=1.0, max=240.0,
+            default=60.0,
+            )
+
+    profiling = bpy.props.BoolProperty(
+            name="Profiling",
+            description="Time the hot paths of the addon and display them over the viewport in edit mode",
+            default=False,
+            update=update_profiling,
+            )
                                
     def draw(self, context):
         scene = context.scene
@@ -83,6 +340,75 @@ class VisionHDRPrefs(bpy.types.AddonPreferences):
         row.prop(self, "category")
         row.label(text="HUD Color")
         row.prop(scene, "HUD_color", text="")
+        row = layout.row()
+        row.prop(self, "update_mode")
+        if self.update_mode == 'COALESCE':
+            row.prop(self, "update_rate")
+        elif self.update_mode == 'RELEASE':
+            row.prop(self, "release_delay")
+        row.label(text="Updates: %d requested, %d applied, %d coalesced" % (_scheduler.requests, _scheduler.flushes, _scheduler.coalesced()))
+        row = layout.row()
+        row.prop(self, "raycast_threshold")
+        row.prop(self, "raycast_rate")
+        row = layout.row()
+        row.prop(self, "proxy_resolution")
+        row = layout.row()
+        row.prop(self, "library_paths")
+        row.prop(self, "worker_count")
+        row = layout.row()
+        row.prop(self, "cache_size")
+        row.operator("scene.clear_hdri_cache", text="Clear cache", icon='X')
+        row = layout.row()
+        row.prop(self, "profiling")
+        row.operator("scene.export_hdri_trace", text="Export trace", icon='TIME')
+
+#########################################################################################################
+
+#########################################################################################################
+def circle_vertices(segments=20):
+    """Vertices (segments, 2) of the unit circle"""
+    angles = np.arange(segments) * (2.0 * math.pi / segments)
+    return np.stack((np.cos(angles), np.sin(angles)), axis=-1).astype(np.float32)
+
+def frame_vertices():
+    """Vertices (5, 2) of the closed outline of the unit square"""
+    return np.array(((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0)), dtype=np.float32)
+
+def frame_transform(width, height, inset):
+    """Offset and scale of the unit square for a frame inside a region"""
+    return (inset, inset), (width - 2 * inset, height - 2 * inset)
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRHudShape():
+    """Fixed 2d geometry of the HUD compiled once in a display list, only its transform changes per frame"""
+
+    def __init__(self, mode, vertices):
+        self.mode = mode
+        self.vertices = vertices
+        self.list = 0
+
+    def compile(self):
+        self.list = bgl.glGenLists(1)
+        bgl.glNewList(self.list, bgl.GL_COMPILE)
+        bgl.glBegin(self.mode)
+        for x, y in self.vertices.tolist():
+            bgl.glVertex2f(x, y)
+        bgl.glEnd()
+        bgl.glEndList()
+
+    def draw(self, offset, scale):
+        if self.list == 0 or not bgl.glIsList(self.list):
+            self.compile()
+        bgl.glPushMatrix()
+        bgl.glTranslatef(offset[0], offset[1], 0.0)
+        bgl.glScalef(scale[0], scale[1], 1.0)
+        bgl.glCallList(self.list)
+        bgl.glPopMatrix()
+
+_hud_circle = VisionHDRHudShape(bgl.GL_LINE_LOOP, circle_vertices())
+_hud_frame = VisionHDRHudShape(bgl.GL_LINE_STRIP, frame_vertices())
 
 #########################################################################################################
 
@@ -108,33 +434,16 @@ def draw_line_3d(color, start, end, hit, width=1):
 #########################################################################################################   
 def draw_circle_2d(color, cx, cy, r, rot = 0):
     """Draw a circle in bgl for HUD"""
-    #http://slabode.exofire.net/circle_draw.shtml
-    num_segments = 20   
-    if num_segments < 1:
-        num_segments = 1
-    theta = 2 * 3.1415926 / num_segments
-    c = math.cos(theta) 
-    s = math.sin(theta)
-    x = r 
-    y = 0
     bgl.glLineWidth(5.0)
     bgl.glColor4f(*color)
     bgl.glEnable(bgl.GL_BLEND)
     bgl.glEnable(bgl.GL_LINE_SMOOTH)
-    bgl.glPushMatrix()
-    bgl.glTranslatef(cx, cy,0)
-    bgl.glBegin(bgl.GL_LINE_LOOP)
-    for i in range (num_segments):
-        bgl.glVertex2f(x , y )
-        t = x
-        x = c * x - s * y
-        y = s * t + c * y
-    bgl.glEnd() 
-    bgl.glPopMatrix()
+    _hud_circle.draw((cx, cy), (r, r))
         
 #########################################################################################################
 
 #########################################################################################################   
+@profiled()
 def draw_callback_2d(self, context, event):
     """Display and draw bgl informations"""
     obj_light = context.active_object
@@ -157,14 +466,12 @@ def draw_callback_2d(self, context, event):
     #---Draw frame around the view3D
         bgl.glEnable(bgl.GL_BLEND)
         bgl.glLineWidth(4)
-        bgl.glBegin(bgl.GL_LINE_STRIP)
-        bgl.glVertex2i(lw, lw)
-        bgl.glVertex2i(region.width - lw, lw)
-        bgl.glVertex2i(region.width - lw, region.height - lw)
-        bgl.glVertex2i(lw, region.height - lw)
-        bgl.glVertex2i(lw, lw)
-        bgl.glEnd() 
+        _hud_frame.draw(*frame_transform(region.width, region.height, lw))
                                                         
+    #---Timings of the addon
+        if _profiler.enabled:
+            draw_profiler(left + 10, region.height - 40)
+
     #---Restore opengl defaults
         bgl.glLineWidth(1)
         bgl.glDisable(bgl.GL_BLEND)
@@ -172,6 +479,7 @@ def draw_callback_2d(self, context, event):
 #########################################################################################################
 
 #########################################################################################################   
+@profiled()
 def draw_callback_3d(self, context, event):
     """Display and draw bgl informations"""
     obj_light = context.active_object
@@ -216,12 +524,168 @@ def draw_target_px(self, context, event):
 #########################################################################################################
 
 #########################################################################################################
+class VisionHDRRaycaster():
+    """Scene acceleration structure used to raycast the light on the meshes"""
+
+    def __init__(self):
+        self.trees = {}
+        self.objects = []
+        self.bounds_min = np.zeros((0, 3))
+        self.bounds_max = np.zeros((0, 3))
+        self.dirty = set()
+
+    def tree_key(self, obj):
+        """Meshes without modifiers share the same tree in local space"""
+        if obj.modifiers:
+            return "OBJECT_" + obj.name
+        return "MESH_" + obj.data.name
+
+    def build_tree(self, context, obj):
+        """Create the BVH tree of the object in local space"""
+        if obj.modifiers:
+            return BVHTree.FromObject(obj, context.scene)
+
+        mesh = obj.data
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        loops = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loops)
+        loop_start = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_start)
+        polygons = [p.tolist() for p in np.split(loops, loop_start[1:])] if len(loop_start) else []
+
+        return BVHTree.FromPolygons(co.reshape(-1, 3).tolist(), polygons)
+
+    def refresh(self, context):
+        """Update only the trees and the bounds of the objects that changed"""
+        objects = []
+        keys = set()
+        bounds = []
+        
+        for obj in context.visible_objects:
+            if obj.type != 'MESH' or "VisionHDR" in obj.data.name:
+                continue
+            key = self.tree_key(obj)
+            keys.add(key)
+            if key not in self.trees or key in self.dirty:
+                self.trees[key] = self.build_tree(context, obj)
+                self.dirty.discard(key)
+
+        #---World bounding box of the object
+            matrix = obj.matrix_world.copy()
+            corners = np.array([matrix * Vector(c) for c in obj.bound_box])
+            bounds.append((corners.min(axis=0), corners.max(axis=0)))
+            objects.append((obj, key, matrix, matrix.inverted()))
+
+    #---Remove the trees of the deleted objects
+        for key in set(self.trees) - keys:
+            del self.trees[key]
+        
+        self.objects = objects
+        if bounds:
+            self.bounds_min = np.array([b[0] for b in bounds])
+            self.bounds_max = np.array([b[1] for b in bounds])
+        else:
+            self.bounds_min = np.zeros((0, 3))
+            self.bounds_max = np.zeros((0, 3))
+
+    def release(self):
+        """Drop the objects of the scene, the trees of the meshes stay for the next use"""
+        self.objects = []
+    #---The edits of the objects with modifiers are only seen through the objects : their trees are built again
+        for key in [key for key in self.trees if key.startswith("OBJECT_")]:
+            del self.trees[key]
+            self.dirty.discard(key)
+        self.bounds_min = np.zeros((0, 3))
+        self.bounds_max = np.zeros((0, 3))
+
+    def ray_cast(self, origin, direction, ray_max=1000.0):
+        """Return the closest object hit by the ray with the location and normal in local space"""
+        direction = direction.normalized()
+        o = np.array(origin)
+        d = np.array(direction)
+        d[np.abs(d) < 1e-12] = 1e-12
+
+    #---Slab test against the world bounding boxes
+        t1 = (self.bounds_min - o) / d
+        t2 = (self.bounds_max - o) / d
+        t_near = np.minimum(t1, t2).max(axis=1)
+        t_far = np.maximum(t1, t2).min(axis=1)
+        candidates = np.nonzero((t_far >= np.maximum(t_near, 0.0)) & (t_near <= ray_max))[0]
+
+    #---Test the meshes from the nearest box to the farthest
+        best_distance = ray_max
+        result = None
+        for i in candidates[np.argsort(t_near[candidates])]:
+            if t_near[i] > best_distance:
+                break
+            obj, key, matrix, matrix_inv = self.objects[i]
+            origin_obj = matrix_inv * origin
+            direction_obj = (matrix_inv * (origin + direction)) - origin_obj
+            hit, normal, face_index, distance = self.trees[key].ray_cast(origin_obj, direction_obj.normalized())
+            if hit is None:
+                continue
+            distance = ((matrix * hit) - origin).length
+            if distance < best_distance:
+                best_distance = distance
+                result = (obj, matrix, hit, normal)
+
+        return result
+
+#########################################################################################################
+
+#########################################################################################################
+_raycaster = None
+
+@profiled()
+def get_raycaster(context):
+    """Return the raycaster of the scene updated from the last use"""
+    global _raycaster
+    
+    if _raycaster is None:
+        _raycaster = VisionHDRRaycaster()
+    _raycaster.refresh(context)
+    
+    return _raycaster
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def raycaster_update(scene):
+    """Flag the trees of the edited meshes to rebuild them on the next use"""
+    if _raycaster is None:
+        return
+    
+    if bpy.data.meshes.is_updated:
+        for mesh in bpy.data.meshes:
+            if mesh.is_updated:
+                _raycaster.dirty.add("MESH_" + mesh.name)
+
+    if bpy.data.objects.is_updated:
+        for obj, key, matrix, matrix_inv in _raycaster.objects:
+        #---Skip the objects deleted since the last refresh
+            try:
+                if obj.modifiers and obj.is_updated_data:
+                    _raycaster.dirty.add(key)
+            except ReferenceError:
+                continue
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def raycaster_reset(dummy):
+    """Forget the trees and the objects of the previous file or of the undone state"""
+    global _raycaster
+    _raycaster = None
+
+#########################################################################################################
+
+#########################################################################################################
+@profiled()
 def raycast_light(self, context, coord, ray_max=1000.0):
     """Compute the location and rotation of the light from the angle or normal of the targeted face off the object"""
-    scene = context.scene
-    i = 0
-    p = 0
-    length_squared = 0
     light = context.active_object
     light['pixel_select'] = False
     self.reflect_angle = "View" if light.VisionHDR.reflect_angle == "0" else "Normal"
@@ -231,7 +695,6 @@ def raycast_light(self, context, coord, ray_max=1000.0):
 #---Get the ray from the viewport and mouse
     view_vector = view3d_utils.region_2d_to_vector_3d(self.region, self.rv3d, (coord))
     ray_origin = view3d_utils.region_2d_to_origin_3d(self.region, self.rv3d, (coord))
-    ray_target = ray_origin + (view_vector * ray_max)
 
     for area in bpy.context.screen.areas:
         if area.type == 'VIEW_3D':
@@ -239,224 +702,447 @@ def raycast_light(self, context, coord, ray_max=1000.0):
             if rv3d is not None: 
                 distance = area.spaces[0].region_3d.view_distance
 
+#---Find the closest object
+    target = self.raycaster.ray_cast(ray_origin, view_vector, ray_max)
     
-#---Select the object 
-    def visible_objects_and_duplis():
-        for obj in context.visible_objects:
-            if obj.type == 'MESH' and "VisionHDR" not in obj.data.name:
-                yield (obj, obj.matrix_world.copy())
-
-#---Cast the ray
-    def obj_ray_cast(obj, matrix):
-    #---Get the ray relative to the object
-        matrix_inv = matrix.inverted()
-        ray_origin_obj = matrix_inv * ray_origin
-        ray_target_obj = matrix_inv * ray_target
-        ray_direction_obj = ray_target_obj - ray_origin_obj
-
-    #---Cast the ray
-        success, hit, normal, face_index = obj.ray_cast(ray_origin_obj, ray_direction_obj)
-
-        return  success, hit, normal
+#---Define location, rotation and scale
+    if target is not None :
+        obj, matrix, hit, normal = target
+        
+    #---Define direction based on the normal of the object or the view angle
+        if self.reflect_angle == "Normal": 
+            direction = (normal * matrix.inverted())
+        else:
+            direction = (view_vector).reflect(normal * matrix.inverted())
 
-#---Find the closest object
-    best_length_squared = ray_max * ray_max
+    #---Define range
+        self.matrix = matrix
+        self.hit = hit
+        self.hit_world = (matrix * hit) + ((distance * .2) * direction)
+        self.direction = direction
+        self.target_name = obj.name
 
-#---Position of the light from the object
-    for obj, matrix in visible_objects_and_duplis():
-        i = 1
+    #---Only write the light when the result changed : each write triggers an update of the scene
+        changed = False
 
-        success, hit, normal = obj_ray_cast(obj, matrix)
+    #---Parent the light to the target object
+        if light.parent != obj:
+            light.parent = obj
+            light.matrix_parent_inverse = obj.matrix_world.inverted()
+            changed = True
 
-        if success :
-        #---Define direction based on the normal of the object or the view angle
-            if self.reflect_angle == "Normal" and (i == 1): 
-                direction = (normal * matrix.inverted())
-            else:
-                direction = (view_vector).reflect(normal * matrix.inverted())
-            
-        #---Define range
-            hit_world = (matrix * hit) + ((distance * .2) * direction)
-
-            length_squared = (hit_world - ray_origin).length_squared
-
-            if length_squared < best_length_squared:
-                best_length_squared = length_squared
-                self.matrix = matrix
-                self.hit = hit
-                self.hit_world = hit_world
-                self.direction = direction
-                self.target_name = obj.name
-                rotation = obj.rotation_euler.to_quaternion()
-
-            #---Parent the light to the target object
-                light.parent = obj
-                light.matrix_parent_inverse = obj.matrix_world.inverted()
-                
-#---Define location, rotation and scale
-    if length_squared > 0 :
         rotaxis = (self.direction.to_track_quat('Z','Y')).to_euler()
-        light['hit'] = (self.matrix * self.hit)
-        light['dir'] = self.direction
-
-    #---Rotation    
-        light.rotation_euler = rotaxis
 
     #---Lock the rotation of the sun on the selected pixel
         if light.VisionHDR.rotation_lock_sun:
-            light.rotation_euler.x = -math.radians(light.VisionHDR.hdri_rotationy)
+            rotaxis.x = -math.radians(light.VisionHDR.hdri_rotationy)
+
+    #---Rotation    
+        if any(abs(a - b) > 1e-6 for a, b in zip(light.rotation_euler, rotaxis)):
+            light.rotation_euler = rotaxis
+            changed = True
             
-        if light.VisionHDR.rotation_lock_img or light.VisionHDR.back_reflect:
-            light.VisionHDR.img_rotation = light.VisionHDR.img_pix_rot + math.degrees(light.rotation_euler.z)
-        else:
-            light.VisionHDR.hdri_rotation = light.VisionHDR.hdri_pix_rot + math.degrees(light.rotation_euler.z)
+            if light.VisionHDR.rotation_lock_img or light.VisionHDR.back_reflect:
+                light.VisionHDR.img_rotation = image_rotation(rotaxis.z, light.VisionHDR.img_pix_rot)
+            else:
+                light.VisionHDR.hdri_rotation = image_rotation(rotaxis.z, light.VisionHDR.hdri_pix_rot)
 
     #---Location
-        light.location = Vector((self.hit_world[0], self.hit_world[1], self.hit_world[2]))
+        location = Vector((self.hit_world[0], self.hit_world[1], self.hit_world[2]))
+        if (light.location - location).length > 1e-6:
+            light.location = location
+            changed = True
+
+        if changed:
+            light['hit'] = (self.matrix * self.hit)
+            light['dir'] = self.direction
+        return changed
+
+    return False
 
 #########################################################################################################
 
 #########################################################################################################
-def create_light_env(self, context):
-    """Cycles material nodes for the environment light"""
-    
-#---Create a new world if not exist
-    world = ""
-    for w in bpy.data.worlds:
-        if w.name == "VisionHDR_world":
-            world = bpy.data.worlds['VisionHDR_world']
-            
-    if world == "":
-        bpy.context.scene.world = bpy.data.worlds.new("VisionHDR_world")
-        world = bpy.context.scene.world
+class VisionHDRRaycastThrottle():
+    """Raycast the light in edit mode only when the mouse moved enough and at most at the raycast rate"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_coord = None
+        self.last_raycast = 0.0
+        self.pending = None
+        self.events = 0
+        self.raycasts = 0
+        self.updates = 0
+        self.skipped_motion = 0
+        self.skipped_rate = 0
+        self.latency = deque(maxlen=256)
+
+    def accept(self, coord, timer=False):
+        """Tell if the event raycasts now, the timer only applies the motion skipped by the rate"""
+        prefs = get_preferences()
+        threshold = prefs.raycast_threshold if prefs is not None else 2
+        rate = prefs.raycast_rate if prefs is not None else 60.0
+        now = time.perf_counter()
+        if timer:
+            if self.pending is None:
+                return False
+        else:
+            self.events += 1
+            if self.last_coord is not None and (coord[0] - self.last_coord[0]) ** 2 + (coord[1] - self.last_coord[1]) ** 2 < threshold ** 2:
+                self.skipped_motion += 1
+                return False
+            if self.pending is None:
+                self.pending = now
+        if now - self.last_raycast < 1.0 / rate:
+            if not timer:
+                self.skipped_rate += 1
+            return False
+        return True
 
-    world.use_nodes= True
-    world.node_tree.nodes.clear() 
-    cobj = bpy.context.object   
+    def done(self, coord, changed):
+        """Record the raycast and the time since the first event it applies"""
+        now = time.perf_counter()
+        self.raycasts += 1
+        self.updates += bool(changed)
+        self.last_coord = coord
+        self.last_raycast = now
+        self.latency.append(now - self.pending)
+        if _profiler.enabled:
+            _profiler.record("edit_light.latency", self.pending, now - self.pending)
+        self.pending = None
+
+    def summary(self):
+        latency = sum(self.latency) / len(self.latency) * 1e3 if self.latency else 0.0
+        return "%d events, %d raycasts, %d updates, skipped %d (motion) %d (rate), latency %.1f ms" % (
+            self.events, self.raycasts, self.updates, self.skipped_motion, self.skipped_rate, latency)
 
-#---Use multiple importance sampling for the world
-    context.scene.world.cycles.sample_as_light = True
+#########################################################################################################
 
-#---Texture Coordinate
-    coord = world.node_tree.nodes.new(type = 'ShaderNodeTexCoord')
-    coord.location = (-1660.0, 220.0)
-        
-#---Mapping Node HDRI
-    textmap = world.node_tree.nodes.new(type="ShaderNodeMapping")
-    textmap.vector_type = "POINT"
-    world.node_tree.links.new(coord.outputs[0], textmap.inputs[0])
-    textmap.location = (-1480.0, 440.0)
-
-#---Mapping Node Reflection
-    textmap2 = world.node_tree.nodes.new(type="ShaderNodeMapping")
-    textmap2.vector_type = "POINT"
-    world.node_tree.links.new(coord.outputs[0], textmap2.inputs[0])
-    textmap2.location = (-1480.0, 100.0)
+#########################################################################################################
+WORLD_GRAPH_VERSION = 3
 
+WORLD_GRAPH = (
+    # (key, name, type, location, settings, default values of the inputs, name of the node in the version 1)
+    ("coord", "VisionHDR_TexCoord", 'ShaderNodeTexCoord', (-1660.0, 220.0), {}, {}, "Texture Coordinate"),
+    ("mapping", "VisionHDR_Mapping", 'ShaderNodeMapping', (-1480.0, 440.0), {"vector_type": 'POINT'}, {}, "Mapping"),
+    ("mapping2", "VisionHDR_Mapping_Reflection", 'ShaderNodeMapping', (-1480.0, 100.0), {"vector_type": 'POINT'}, {}, "Mapping.001"),
 #-> Blur from  Bartek Skorupa : Source https://www.youtube.com/watch?v=kAUmLcXhUj0&feature=youtu.be&t=23m58s
-#---Noise Texture
-    noisetext = world.node_tree.nodes.new(type="ShaderNodeTexNoise")
-    noisetext.inputs[1].default_value = 1000
-    noisetext.inputs[2].default_value = 16
-    noisetext.inputs[3].default_value = 200
-    noisetext.location = (-1120.0, -60.0)
-
-#---Substract
-    substract = world.node_tree.nodes.new(type="ShaderNodeMixRGB")
-    substract.blend_type = 'SUBTRACT'
-    substract.inputs[0].default_value = 1
-    world.node_tree.links.new(noisetext.outputs[0], substract.inputs['Color1'])
-    substract.location = (-940.0, -60.0)
-
-#---Add
-    add = world.node_tree.nodes.new(type="ShaderNodeMixRGB")
-    add.blend_type = 'ADD'
-    add.inputs[0].default_value = 0
-    world.node_tree.links.new(textmap2.outputs[0], add.inputs['Color1'])
-    world.node_tree.links.new(substract.outputs[0], add.inputs['Color2'])
-    add.location = (-760.0, 100.0)
-
-#-> End Blur
-
-#---Environment Texture 
-    envtext = world.node_tree.nodes.new(type = 'ShaderNodeTexEnvironment')
-    world.node_tree.links.new(textmap.outputs[0], envtext.inputs[0])
-    envtext.location = (-580,380)
-
-#---Bright / Contrast
-    bright = world.node_tree.nodes.new(type = 'ShaderNodeBrightContrast')
-    world.node_tree.links.new(envtext.outputs[0], bright.inputs[0])
-    bright.location = (-400,340)
-
-#---Gamma
-    gamma = world.node_tree.nodes.new(type = 'ShaderNodeGamma')
-    world.node_tree.links.new(bright.outputs[0], gamma.inputs[0])
-    gamma.location = (-220,320)
-
-#---Hue / Saturation / Value
-    hue = world.node_tree.nodes.new(type = 'ShaderNodeHueSaturation')
-    world.node_tree.links.new(gamma.outputs[0], hue.inputs[4])
-    hue.location = (-40,340)
-    
-#---Reflection Texture 
-    imagtext = world.node_tree.nodes.new(type = 'ShaderNodeTexEnvironment')
-    world.node_tree.links.new(add.outputs[0], imagtext.inputs[0])
-    imagtext.location = (-580,100)
-
-#---Bright / Contrast
-    bright2 = world.node_tree.nodes.new(type = 'ShaderNodeBrightContrast')
-    world.node_tree.links.new(imagtext.outputs[0], bright2.inputs[0])
-    bright2.location = (-400,40)
-
-#---Gamma
-    gamma2 = world.node_tree.nodes.new(type = 'ShaderNodeGamma')
-    world.node_tree.links.new(bright2.outputs[0], gamma2.inputs[0])
-    gamma2.location = (-220,40)
-
-#---Hue / Saturation / Value
-    hue2 = world.node_tree.nodes.new(type = 'ShaderNodeHueSaturation')
-    world.node_tree.links.new(gamma2.outputs[0], hue2.inputs[4])
-    hue2.location = (-40,40)
-    
-#---Light path 
-    lightpath = world.node_tree.nodes.new(type = 'ShaderNodeLightPath')
-    lightpath.location = (-40,620)
-    
-#---Math 
-    math = world.node_tree.nodes.new(type = 'ShaderNodeMath')
-    math.use_clamp = True
-    math.operation = 'SUBTRACT'
-    world.node_tree.links.new(lightpath.outputs[0], math.inputs[0])
-    world.node_tree.links.new(lightpath.outputs[3], math.inputs[1])
-    math.location = (160,560)
-                
-#---Background 01
-    background1 = world.node_tree.nodes.new(type = 'ShaderNodeBackground')
-    background1.inputs[0].default_value = (0.8,0.8,0.8,1.0)
-    background1.location = (160,280)
-    background1.name = "VisionHDR_Background1"
+    ("noise", "VisionHDR_Blur_Noise", 'ShaderNodeTexNoise', (-1120.0, -60.0), {}, {1: 1000.0, 2: 16.0, 3: 200.0}, "Noise Texture"),
+    ("subtract", "VisionHDR_Blur_Subtract", 'ShaderNodeMixRGB', (-940.0, -60.0), {"blend_type": 'SUBTRACT'}, {0: 1.0}, "Mix"),
+    ("blur", "VisionHDR_Blur", 'ShaderNodeMixRGB', (-760.0, 100.0), {"blend_type": 'ADD'}, {0: 0.0}, "Mix.001"),
+    ("hdri_text", "VisionHDR_Environment", 'ShaderNodeTexEnvironment', (-580.0, 380.0), {}, {}, "Environment Texture"),
+    ("sun_clamp", "VisionHDR_SunClamp", 'ShaderNodeMixRGB', (-490.0, 560.0), {"blend_type": 'DARKEN'}, {0: 1.0}, ""),
+    ("hdri_bright", "VisionHDR_Bright", 'ShaderNodeBrightContrast', (-400.0, 340.0), {}, {}, "Bright/Contrast"),
+    ("hdri_gamma", "VisionHDR_Gamma", 'ShaderNodeGamma', (-220.0, 320.0), {}, {}, "Gamma"),
+    ("hdri_hue", "VisionHDR_Hue", 'ShaderNodeHueSaturation', (-40.0, 340.0), {}, {}, "Hue Saturation Value"),
+#---Exposure of the environment set by the overrides of the scene
+    ("exposure", "VisionHDR_Exposure", 'ShaderNodeMixRGB', (-40.0, 500.0), {"blend_type": 'MULTIPLY'}, {0: 1.0, 'Color2': (1.0, 1.0, 1.0, 1.0)}, ""),
+    ("img_text", "VisionHDR_Reflection", 'ShaderNodeTexEnvironment', (-580.0, 100.0), {}, {}, "Environment Texture.001"),
+    ("img_bright", "VisionHDR_Reflection_Bright", 'ShaderNodeBrightContrast', (-400.0, 40.0), {}, {}, "Bright/Contrast.001"),
+    ("img_gamma", "VisionHDR_Reflection_Gamma", 'ShaderNodeGamma', (-220.0, 40.0), {}, {}, "Gamma.001"),
+    ("img_hue", "VisionHDR_Reflection_Hue", 'ShaderNodeHueSaturation', (-40.0, 40.0), {}, {}, "Hue Saturation Value.001"),
+    ("lightpath", "VisionHDR_LightPath", 'ShaderNodeLightPath', (-40.0, 620.0), {}, {}, "Light Path"),
+#---The operation of the math node is set by the reflection option of the light
+    ("math", "VisionHDR_Math", 'ShaderNodeMath', (160.0, 560.0), {"use_clamp": True}, {}, "Math"),
+    ("background1", "VisionHDR_Background1", 'ShaderNodeBackground', (160.0, 280.0), {}, {0: (0.8, 0.8, 0.8, 1.0)}, "VisionHDR_Background1"),
+    ("background2", "VisionHDR_Background2", 'ShaderNodeBackground', (160.0, 180.0), {}, {}, "VisionHDR_Background2"),
+    ("mix", "VisionHDR_Mix", 'ShaderNodeMixShader', (340.0, 320.0), {}, {}, "Mix Shader"),
+    ("output", "VisionHDR_Output", 'ShaderNodeOutputWorld', (520.0, 300.0), {}, {}, "World Output"),
+    )
+
+WORLD_LINKS = (
+    # (key of the node, output, key of the node, input) : the links of the options are made by the relink of the graph,
+    # the input of hdri_bright (sun clamp) and of the output (background) are not in the spec so a build keeps them
+    ("coord", 0, "mapping", 0),
+    ("coord", 0, "mapping2", 0),
+    ("noise", 0, "subtract", 'Color1'),
+    ("mapping2", 0, "blur", 'Color1'),
+    ("subtract", 0, "blur", 'Color2'),
+    ("mapping", 0, "hdri_text", 0),
+    ("hdri_bright", 0, "hdri_gamma", 0),
+    ("hdri_gamma", 0, "hdri_hue", 4),
+    ("blur", 0, "img_text", 0),
+    ("img_text", 0, "img_bright", 0),
+    ("img_bright", 0, "img_gamma", 0),
+    ("img_gamma", 0, "img_hue", 4),
+    ("lightpath", 0, "math", 0),
+    ("lightpath", 3, "math", 1),
+    ("math", 0, "mix", 0),
+    ("background1", 0, "mix", 1),
+    ("background2", 0, "mix", 2),
+    )
+
+#########################################################################################################
+
+#########################################################################################################
+def migrate_stable_names(world):
+    """Version 2 : the nodes have stable names instead of the default names given by Blender"""
+    nodes = world.node_tree.nodes
+    for key, name, node_type, location, settings, inputs, legacy in WORLD_GRAPH:
+        node = nodes.get(legacy) if legacy else None
+        if node is not None and node.name != name and nodes.get(name) is None and node.bl_idname == node_type:
+            node.name = name
+
+#---Migrations of the worlds made by the previous versions, before the graph is compared to the spec
+WORLD_MIGRATIONS = (
+    (2, migrate_stable_names),
+    )
+
+#########################################################################################################
+
+#########################################################################################################
+def build_world_graph(world):
+    """Bring the nodes of the world to the spec, only what differs is added, removed or linked again"""
+    world.use_nodes = True
+    tree = world.node_tree
+    nodes = tree.nodes
+    version = world.get("visionhdr_graph_version", 1)
+    for target, migration in WORLD_MIGRATIONS:
+        if version < target:
+            migration(world)
+
+#---Nodes : the existing ones keep their location and the values set by the user
+    changes = 0
+    names = {}
+    for key, name, node_type, location, settings, inputs, legacy in WORLD_GRAPH:
+        names[key] = name
+        node = nodes.get(name)
+        if node is not None and node.bl_idname != node_type:
+            nodes.remove(node)
+            node = None
+        if node is None:
+            node = nodes.new(type=node_type)
+            node.name = name
+            node.location = location
+            for socket, value in inputs.items():
+                node.inputs[socket].default_value = value
+            changes += 1
+        for attribute, value in settings.items():
+            if getattr(node, attribute) != value:
+                setattr(node, attribute, value)
+                changes += 1
+
+#---Nodes of the previous templates
+    for node in list(nodes):
+        if node.name.startswith("VisionHDR_") and node.name not in names.values():
+            nodes.remove(node)
+            changes += 1
+
+#---Links
+    for from_key, output, to_key, input in WORLD_LINKS:
+        from_socket = nodes[names[from_key]].outputs[output]
+        to_socket = nodes[names[to_key]].inputs[input]
+        if not any(link.from_socket == from_socket for link in to_socket.links):
+            tree.links.new(from_socket, to_socket)
+            changes += 1
+
+    if version != WORLD_GRAPH_VERSION:
+        world["visionhdr_graph_version"] = WORLD_GRAPH_VERSION
+    if changes:
+        _world_graphs.pop(world.name, None)
+    
+    return changes
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRWorldGraph():
+    """Cached nodes of the VisionHDR world : relink only when the topology changes"""
+
+    def __init__(self, world):
+        self.world = world
+        self.pointer = world.as_pointer()
+        self.nodes = {}
+        nodes = world.node_tree.nodes
+        for key, name, node_type, location, settings, inputs, legacy in WORLD_GRAPH:
+            self.nodes[key] = nodes.get(name)
+        self.node_count = len(nodes)
+        self.topology = None
+
+    def __getitem__(self, key):
+        return self.nodes[key]
+
+    def valid(self, world):
+        return self.pointer == world.as_pointer() and self.node_count == len(world.node_tree.nodes)
+
+    def set_input(self, key, socket, value):
+        """Only write the values that changed"""
+        socket = self.nodes[key].inputs[socket]
+        if socket.default_value != value:
+            socket.default_value = value
+
+    def remove_links(self, key):
+        links = self.world.node_tree.links
+        for link in list(self.nodes[key].outputs['Color'].links):
+            links.remove(link)
+
+    @profiled("world_graph.relink")
+    def relink(self, cobj):
+        """Connect the nodes for the images and the background options of the light"""
+        n = self.nodes
+        links = self.world.node_tree.links
         
-#---Background 02
-    background2 = world.node_tree.nodes.new(type = 'ShaderNodeBackground')
-    background2.location = (160,180)
-    background2.name = "VisionHDR_Background2"
-    
-#---Mix Shader Node
-    mix = world.node_tree.nodes.new(type="ShaderNodeMixShader")
-    world.node_tree.links.new(math.outputs[0], mix.inputs[0])
-    world.node_tree.links.new(background1.outputs[0], mix.inputs[1])
-    world.node_tree.links.new(background2.outputs[0], mix.inputs[2])
-    mix.location = (340,320)
-    
-#---Output
-    output = world.node_tree.nodes.new("ShaderNodeOutputWorld") 
-    output.location = (520,300)
+        if cobj.VisionHDR.hdri_name != "":  
+            if cobj.VisionHDR.sh_lighting:
+                n["hdri_text"].image = sh_image(cobj)
+            else:
+                image = bpy.data.images[cobj.VisionHDR.hdri_name]
+                if cobj.VisionHDR.sun_split != 'NONE':
+                    image = get_desunned(image, cobj.VisionHDR.sun_split)
+                n["hdri_text"].image = viewport_image(image)
+            if cobj.VisionHDR.sun_clamp and n["sun_clamp"] is not None:
+            #---Clamp the sun out of the environment, the sun lamp carries its energy
+                clamp = float(get_sun_lobe(bpy.data.images[cobj.VisionHDR.hdri_name])["clamp"])
+                n["sun_clamp"].inputs['Color2'].default_value = (clamp, clamp, clamp, 1.0)
+                links.new(n["hdri_text"].outputs[0], n["sun_clamp"].inputs['Color1'])
+                links.new(n["sun_clamp"].outputs[0], n["hdri_bright"].inputs[0])
+            else:
+                links.new(n["hdri_text"].outputs[0], n["hdri_bright"].inputs[0])
+            if n["exposure"] is not None:
+                links.new(n["hdri_hue"].outputs[0], n["exposure"].inputs['Color1'])
+                links.new(n["exposure"].outputs[0], n["background1"].inputs[0])
+            else:
+                links.new(n["hdri_hue"].outputs[0], n["background1"].inputs[0])
+            links.new(n["lightpath"].outputs[0], n["math"].inputs[0])
+            links.new(n["lightpath"].outputs[3], n["math"].inputs[1])
+            links.new(n["math"].outputs[0], n["mix"].inputs[0])
+        else:
+        #--- Remove image HDRI links
+            cobj.VisionHDR.rotation_lock_img = False
+            self.remove_links("hdri_hue")
+            if n["exposure"] is not None:
+                self.remove_links("exposure")
     
-#---Links
-    world.node_tree.links.new(background1.outputs[0], output.inputs[0])
+    #---HDRI for background         
+        if cobj.VisionHDR.hdri_background:
+            links.new(n["background1"].outputs[0], n["output"].inputs[0])
+        else:
+            links.new(n["mix"].outputs[0], n["output"].inputs[0])
+
+    #---Image Background 
+        if cobj.VisionHDR.img_name != "" and not cobj.VisionHDR.hdri_background: 
+            n["img_text"].image = viewport_image(bpy.data.images[cobj.VisionHDR.img_name])
+            links.new(n["img_text"].outputs[0], n["background2"].inputs[0])
+            links.new(n["lightpath"].outputs[0], n["math"].inputs[0])
+            links.new(n["lightpath"].outputs[3], n["math"].inputs[1])
+            links.new(n["math"].outputs[0], n["mix"].inputs[0])
+            links.new(n["img_text"].outputs[0], n["img_bright"].inputs[0])
+            links.new(n["img_hue"].outputs[0], n["background2"].inputs[0])
+        else:
+        #--- Remove image background links
+            cobj.VisionHDR.rotation_lock_hdri = False
+            self.remove_links("img_hue")
+
+    #---Color background for reflection
+        n["math"].operation = 'ADD' if cobj.VisionHDR.back_reflect else 'SUBTRACT'
+
+    @profiled("world_graph.apply")
+    def apply(self, cobj):
+        """Update the nodes from the properties of the light"""
+        topology = (cobj.VisionHDR.hdri_name, cobj.VisionHDR.hdri_background, cobj.VisionHDR.img_name, cobj.VisionHDR.back_reflect, cobj.VisionHDR.sh_lighting, cobj.VisionHDR.sun_clamp, cobj.VisionHDR.sun_split)
+        if topology != self.topology:
+            self.relink(cobj)
+            self.topology = topology
+
+        if cobj.VisionHDR.hdri_name != "":  
+            self.set_input("hdri_bright", 'Bright', cobj.VisionHDR.hdri_bright)
+            self.set_input("hdri_bright", 'Contrast', cobj.VisionHDR.hdri_contrast)
+            self.set_input("hdri_gamma", 'Gamma', cobj.VisionHDR.hdri_gamma)
+            self.set_input("hdri_hue", 'Hue', cobj.VisionHDR.hdri_hue)
+            self.set_input("hdri_hue", 'Saturation', cobj.VisionHDR.hdri_saturation)
+            self.set_input("hdri_hue", 'Value', cobj.VisionHDR.hdri_value)
+
+        if cobj.VisionHDR.img_name != "" and not cobj.VisionHDR.hdri_background: 
+            self.set_input("img_bright", 'Bright', cobj.VisionHDR.img_bright)
+            self.set_input("img_bright", 'Contrast', cobj.VisionHDR.img_contrast)
+            self.set_input("img_gamma", 'Gamma', cobj.VisionHDR.img_gamma)
+            self.set_input("img_hue", 'Hue', cobj.VisionHDR.img_hue)
+            self.set_input("img_hue", 'Saturation', cobj.VisionHDR.img_saturation)
+            self.set_input("img_hue", 'Value', cobj.VisionHDR.img_value)                    
+
+#########################################################################################################
+
+#########################################################################################################
+_world_graphs = {}
+
+def get_world_graph(world):
+    """Return the cached nodes of the world, resolved again if the nodes changed"""
+    graph = _world_graphs.get(world.name)
+    if graph is None or not graph.valid(world):
+        graph = _world_graphs[world.name] = VisionHDRWorldGraph(world)
+    return graph
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def world_graph_reset(dummy):
+    """Forget the nodes after loading a file or undo"""
+    _world_graphs.clear()
+
+@persistent
+def world_graph_migrate(dummy):
+    """Update the VisionHDR worlds made by the previous versions of the addon"""
+    for world in bpy.data.worlds:
+        if world.library is None and world.node_tree is not None and world.get("visionhdr_graph_version", 1) < WORLD_GRAPH_VERSION:
+            if is_visionhdr_world(world):
+                build_world_graph(world)
+
+#########################################################################################################
+
+#########################################################################################################
+def is_visionhdr_world(world):
+    """Tell if the world is made by the addon, the worlds of the first versions only have their name"""
+    return world is not None and ("visionhdr_graph_version" in world or world.name.startswith("VisionHDR_world"))
+
+def find_world(context):
+    """Return the VisionHDR world of the scene, else the first one of the file or of its libraries"""
+    if is_visionhdr_world(context.scene.world):
+        return context.scene.world
+    worlds = [world for world in bpy.data.worlds if is_visionhdr_world(world)]
+    worlds.sort(key=lambda world: world.library is not None)
+    return worlds[0] if worlds else None
+
+def local_world(world):
+    """Return the world, or the local copy of a linked world : the copy shares the images of the library"""
+    if world.library is None:
+        return world
+    source = world.library.filepath + "|" + world.name
+    for local in bpy.data.worlds:
+        if local.library is None and local.get("visionhdr_linked") == source:
+            return local
+    local = world.copy()
+    local["visionhdr_linked"] = source
+    build_world_graph(local)
+    return local
+
+#########################################################################################################
+
+#########################################################################################################
+def create_light_env(self, context):
+    """Cycles material nodes for the environment light"""
+    
+#---Create a new world if not exist, the nodes of an existing world are updated in place
+    world = find_world(context)
+    if world is None:
+        world = bpy.data.worlds.new("VisionHDR_world")
+        world.use_nodes = True
+        world.node_tree.nodes.clear()
+    world = local_world(world)
+    context.scene.world = world
+    build_world_graph(world)
+
+#---Use multiple importance sampling for the world
+    world.cycles.sample_as_light = True
 
     lamp = create_light_sun(self, context)
 
+#---Options of the light on the nodes
+    get_world_graph(world).apply(lamp)
+
     return(lamp)
 
 #########################################################################################################
@@ -490,6 +1176,7 @@ def create_light_sun(self, context):
 #---Initialize MIS / Type / Name
     lamp.data.cycles.use_multiple_importance_sampling = True
     lamp.VisionHDR.lightname = context.active_object.data.name
+    get_index(context.scene, rebuild=True)
     
 #---Make the lamp sun object active
     bpy.context.scene.objects.active = bpy.data.objects[lamp.name]
@@ -537,6 +1224,7 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
     def check(self, context):
         return True
 
+    @profiled("check_region")
     def check_region(self,context,event):
         if context.area != None:
             if context.area.type == "VIEW_3D" :
@@ -552,10 +1240,25 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
             else:
                 self.in_view_3d = False         
             
+    def start_timer(self, context):
+        """Timer applying the last motion skipped by the raycast rate"""
+        if self._timer is None:
+            prefs = get_preferences()
+            rate = prefs.raycast_rate if prefs is not None else 60.0
+            self._timer = context.window_manager.event_timer_add(1.0 / rate, context.window)
+
+    def stop_timer(self):
+        if self._timer is not None:
+            bpy.context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+
+    @profiled("edit_light_modal")
     def modal(self, context, event):
         #-------------------------------------------------------------------
+        _profiler.begin_event(event.type)
         coord = (event.mouse_region_x, event.mouse_region_y)
-        context.area.tag_redraw()
+        if event.type not in {'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'TIMER'} or _profiler.enabled:
+            context.area.tag_redraw()
         obj_light = context.active_object
         #-------------------------------------------------------------------
 
@@ -580,14 +1283,22 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
                     
                 if event.type == 'LEFTMOUSE':
                     self.lmb = event.value == 'PRESS'
+                    if self.lmb:
+                        self.throttle.last_coord = None
+                        self.start_timer(context)
+                    else:
+                        self.stop_timer()
                 
                 if event.value == 'RELEASE':
                     context.window.cursor_modal_set("DEFAULT")
                     
-            #---RayCast the light
+            #---RayCast the light, only when the mouse moved enough and at most at the raycast rate
                 if self.editmode and not self.modif: 
-                    if self.lmb : 
-                        raycast_light(self, context, coord)
+                    if self.lmb and self.throttle.accept(coord, event.type == 'TIMER'): 
+                        changed = raycast_light(self, context, coord)
+                        self.throttle.done(coord, changed)
+                        if changed:
+                            context.area.tag_redraw()
                         bpy.context.window.cursor_modal_set("SCROLL_XY")
 
             else:
@@ -598,12 +1309,16 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
                 context.area.header_text_set()
                 context.window.cursor_modal_set("DEFAULT")
                 self.remove_handler()
+                if self.throttle.events:
+                    self.report({'INFO'}, "Raycast : " + self.throttle.summary())
                 return{'FINISHED'}
             
         #---Transform the light
             if self.editmode :
                 obj_light = context.active_object
                 text_header = "Left click to control position. Right click to confirm"
+                if _profiler.enabled:
+                    text_header += "  |  " + self.throttle.summary()
                 context.area.header_text_set(text_header)
                 return {'RUNNING_MODAL'}
 
@@ -632,6 +1347,9 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
         
     def remove_handler(self):
 
+        self.stop_timer()
+        if _raycaster is not None:
+            _raycaster.release()
         if self._handle_2d is not None:
             bpy.types.SpaceView3D.draw_handler_remove(self._handle_2d, 'WINDOW')
             self._handle_2d = None
@@ -660,6 +1378,10 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
                 self.save_energy = (lamp_or_softbox.scale[0] * lamp_or_softbox.scale[1]) * obj_light.VisionHDR.energy
                 
             self.visionHDR_area = context.area
+            self._timer = None
+            self.throttle = VisionHDRRaycastThrottle()
+            if self.editmode:
+                self.raycaster = get_raycaster(context)
                             
             if obj_light is not None and obj_light.type != 'EMPTY' and obj_light.data.name.startswith("VisionHDR") and self.editmode:
                 for ob in context.scene.objects:
@@ -683,248 +1405,2551 @@ class VISIONHDR_OT_EditLight(bpy.types.Operator):
 #########################################################################################################
 
 #########################################################################################################
-class VISIONHDR_OT_AddLightEnv(bpy.types.Operator):
-    bl_idname = "scene.addlightenv"
-    bl_label = "Add a new environment"
+class VISIONHDR_OT_AddLightEnv(bpy.types.Operator):
+    bl_idname = "scene.addlightenv"
+    bl_label = "Add a new environment"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        create_light_env(self, context)
+
+        return {'FINISHED'}
+        
+#########################################################################################################
+
+#########################################################################################################
+def reset_options(self, context):
+    """Reset the options for HDRI or reflection maps"""
+    
+    cobj = get_object(context, self.lightname)
+    
+#---Environment Light
+    graph = get_world_graph(context.scene.world)
+    hdri_bright = graph["hdri_bright"]
+    hdri_gamma = graph["hdri_gamma"]
+    hdri_hue = graph["hdri_hue"]
+    img_bright = graph["img_bright"]
+    img_gamma = graph["img_gamma"]
+    img_hue = graph["img_hue"]
+    
+    
+    if cobj.VisionHDR.hdri_reset:
+        cobj.VisionHDR.hdri_bright = hdri_bright.inputs['Bright'].default_value = 0
+        cobj.VisionHDR.hdri_contrast = hdri_bright.inputs['Contrast'].default_value = 0
+        cobj.VisionHDR.hdri_gamma = hdri_gamma.inputs['Gamma'].default_value = 1
+        cobj.VisionHDR.hdri_hue = hdri_hue.inputs['Hue'].default_value = 0.5
+        cobj.VisionHDR.hdri_saturation = hdri_hue.inputs['Saturation'].default_value = 1
+        cobj.VisionHDR.hdri_value = hdri_hue.inputs['Value'].default_value = 1
+        
+    if cobj.VisionHDR.img_reset:
+        cobj.VisionHDR.img_bright = img_bright.inputs['Bright'].default_value = 0
+        cobj.VisionHDR.img_contrast = img_bright.inputs['Contrast'].default_value = 0
+        cobj.VisionHDR.img_gamma = img_gamma.inputs['Gamma'].default_value = 1
+        cobj.VisionHDR.img_hue = img_hue.inputs['Hue'].default_value = 0.5
+        cobj.VisionHDR.img_saturation = img_hue.inputs['Saturation'].default_value = 1
+        cobj.VisionHDR.img_value = img_hue.inputs['Value'].default_value = 1
+
+#########################################################################################################
+
+#########################################################################################################
+@profiled()
+def update_rotation_hdri(self, context):
+    """Update the rotation of the environment image texture"""
+    
+    cobj = get_object(context, self.lightname)
+    graph = get_world_graph(context.scene.world)
+    mapping = graph["mapping"]
+    mapping2 = graph["mapping2"]
+    rotation = scene_rotation(context.scene, cobj)
+    
+    if cobj.VisionHDR.rotation_lock_hdri:
+        mapping2.rotation[2] -= (mapping.rotation[2] + math.radians(rotation))
+
+    mapping.rotation[2] = -math.radians(rotation)
+    
+#---Lock the rotation of the sun on the selected pixel
+    if cobj.VisionHDR.rotation_lock_sun:
+        cobj.rotation_euler.z = lamp_rotation(rotation, cobj.VisionHDR.hdri_pix_rot)
+
+#---Lamps extracted from the image turn with it
+    if cobj.VisionHDR.light_mode == 'EXTRACT':
+        orient_extracted(cobj, context)
+#########################################################################################################
+
+#########################################################################################################
+def scene_rotation(scene, cobj):
+    """Rotation of the environment image in the scene : the override of the scene or the rotation of the light"""
+    if scene.visionhdr.use_rotation:
+        return scene.visionhdr.rotation
+    return cobj.VisionHDR.hdri_rotation
+
+def apply_scene_overrides(scene):
+    """Write the rotation and exposure of the scene in the world shared with the other scenes"""
+    world = scene.world
+    if world is None or world.library is not None or world.node_tree is None or not is_visionhdr_world(world):
+        return
+    lights = get_lights(scene)
+    if not lights:
+        return
+    cobj = lights[0]
+    graph = get_world_graph(world)
+    rotation = scene_rotation(scene, cobj)
+    
+#---A baked time of day drives the rotation from its fcurves on each frame
+    animated = cobj.VisionHDR.time_baked or has_fcurve(world.node_tree, graph["mapping"].path_from_id("rotation"), 2)
+    if not animated and abs(graph["mapping"].rotation[2] + math.radians(rotation)) > 1e-6:
+        graph["mapping"].rotation[2] = -math.radians(rotation)
+        if cobj.VisionHDR.rotation_lock_sun and cobj.library is None:
+            cobj.rotation_euler.z = lamp_rotation(rotation, cobj.VisionHDR.hdri_pix_rot)
+    if graph["exposure"] is not None:
+        scale = 2.0 ** scene.visionhdr.exposure if scene.visionhdr.use_exposure else 1.0
+        color = graph["exposure"].inputs['Color2']
+        if tuple(color.default_value) != (scale, scale, scale, 1.0):
+            color.default_value = (scale, scale, scale, 1.0)
+
+def update_scene_override(self, context):
+    """Apply the overrides of the scene"""
+    apply_scene_overrides(context.scene)
+
+#########################################################################################################
+
+#########################################################################################################
+_override_scene = [None]
+
+@persistent
+def scene_override_update(scene):
+    """Apply the overrides of the scene when the active scene changes"""
+    if _override_scene[0] != scene.as_pointer():
+        _override_scene[0] = scene.as_pointer()
+        apply_scene_overrides(scene)
+
+@persistent
+def scene_override_render_pre(scene):
+    """Apply the overrides of the rendered scene, it may not be the active one"""
+    apply_scene_overrides(scene)
+
+@persistent
+def scene_override_render_post(scene):
+    """Bring back the overrides of the active scene"""
+    apply_scene_overrides(bpy.context.scene)
+
+@persistent
+def scene_override_reset(dummy):
+    """Apply the overrides again after loading a file"""
+    _override_scene[0] = None
+
+#########################################################################################################
+
+#########################################################################################################
+def update_rotation_hdri_lock(self, context):
+    """Lock / Unlock the rotation of the environment image texture"""
+    
+    cobj = get_object(context, self.lightname)
+    graph = get_world_graph(context.scene.world)
+    mapping = graph["mapping"]
+    mapping2 = graph["mapping2"]
+    
+    if cobj.VisionHDR.rotation_lock_hdri == False:
+        if round(-math.degrees(mapping2.rotation[2]), 2) != round(cobj.VisionHDR.img_rotation, 2) :
+            cobj.VisionHDR.img_rotation = -math.degrees(mapping2.rotation[2])
+
+#########################################################################################################
+
+#########################################################################################################
+def update_rotation_img(self, context):
+    """Update the rotation of the background image texture"""
+
+    cobj = get_object(context, self.lightname)
+    graph = get_world_graph(context.scene.world)
+    mapping = graph["mapping"]
+    mapping2 = graph["mapping2"]
+    if cobj.VisionHDR.rotation_lock_img:
+        mapping.rotation[2] -= (mapping2.rotation[2] + math.radians(cobj.VisionHDR.img_rotation))
+    mapping2.rotation[2] = -math.radians(cobj.VisionHDR.img_rotation)
+    
+#---Lock the rotation of the sun on the selected pixel
+    if cobj.VisionHDR.rotation_lock_sun:
+        cobj.rotation_euler.z = lamp_rotation(cobj.VisionHDR.img_rotation, cobj.VisionHDR.img_pix_rot)
+#########################################################################################################
+
+#########################################################################################################
+def update_rotation_img_lock(self, context):
+    """Lock / Unlock the rotatin of the background image texture"""
+    
+    cobj = get_object(context, self.lightname)
+    graph = get_world_graph(context.scene.world)
+    mapping = graph["mapping"]
+    mapping2 = graph["mapping2"]
+    
+    if cobj.VisionHDR.rotation_lock_img == False:
+        if round(-math.degrees(mapping.rotation[2]), 2) != round(cobj.VisionHDR.hdri_rotation, 2) :
+            cobj.VisionHDR.hdri_rotation = -math.degrees(mapping.rotation[2])
+
+#########################################################################################################
+
+#########################################################################################################
+@profiled()
+def update_lamp(self, context):
+    """Update the material nodes of the blender lights"""
+    cobj = get_object(context, self.lightname)
+    if cobj is None or cobj.data.node_tree is None:
+        return
+    emit = cobj.data.node_tree.nodes["Emission"]
+    emit.inputs[0].default_value = cobj.VisionHDR.lightcolor
+    emit.inputs[1].default_value = cobj.VisionHDR.sun_energy
+
+#########################################################################################################
+
+#########################################################################################################
+@profiled()
+def update_mat(self, context):
+    """Update the material nodes of the lights"""
+    
+#---Get the duplivert
+    cobj = get_object(context, self.lightname)
+
+    if cobj.type != 'EMPTY' and cobj.data.name.startswith("VisionHDR"):
+
+        if cobj.VisionHDR.hdri_reset == False and cobj.VisionHDR.img_reset == False:
+        #---Environment Light
+            get_world_graph(context.scene.world).apply(cobj)
+
+        else:
+            if cobj.VisionHDR.hdri_reset: 
+                cobj.VisionHDR.hdri_reset = False
+            if cobj.VisionHDR.img_reset: 
+                cobj.VisionHDR.img_reset = False                        
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRUpdateScheduler():
+    """Coalesce the updates of the world nodes while a slider is dragged"""
+
+    def __init__(self):
+        self.dirty = set()
+        self.last_request = 0.0
+        self.last_flush = 0.0
+        self.requests = 0
+        self.flushes = 0
+
+    def coalesced(self):
+        return self.requests - self.flushes - len(self.dirty)
+
+    def request(self, cobj, context):
+        """Update now or flag the light for the next flush"""
+        prefs = get_preferences()
+        self.requests += 1
+        if prefs is None or prefs.update_mode == 'IMMEDIATE':
+            self.flushes += 1
+            update_mat(cobj.VisionHDR, context)
+        else:
+            self.dirty.add(cobj.VisionHDR.lightname)
+            self.last_request = time.perf_counter()
+
+    def flush(self, context):
+        """Apply the pending updates if the rate of the preferences allows it"""
+        if not self.dirty:
+            return
+        prefs = get_preferences()
+        now = time.perf_counter()
+        if prefs is not None:
+            if prefs.update_mode == 'COALESCE' and now - self.last_flush < 1.0 / prefs.update_rate:
+                return
+            if prefs.update_mode == 'RELEASE' and now - self.last_request < prefs.release_delay:
+                return
+        
+        dirty = self.dirty
+        self.dirty = set()
+        self.last_flush = now
+        for lightname in dirty:
+            cobj = get_object(context, lightname)
+            if cobj is not None:
+                self.flushes += 1
+                update_mat(cobj.VisionHDR, context)
+
+_scheduler = VisionHDRUpdateScheduler()
+
+#########################################################################################################
+
+#########################################################################################################
+def queue_update_mat(self, context):
+    """Update the material nodes of the lights through the scheduler"""
+    cobj = get_object(context, self.lightname)
+    if cobj is not None:
+        _scheduler.request(cobj, context)
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def scheduler_flush(scene):
+    """Apply the pending updates of the world nodes"""
+    _scheduler.flush(bpy.context)
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def scheduler_reset(dummy):
+    """Forget the pending updates of the previous file"""
+    _scheduler.dirty.clear()
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRIndex():
+    """Index of the objects of a scene by VisionHDR light name"""
+
+    def __init__(self, scene):
+        self.objects = {}
+        self.lamps = {}
+        self.lights = []
+        self.owned = {}
+        for ob in scene.objects:
+            if ob.type != 'EMPTY':
+                if ob.VisionHDR.lightname != "":
+                    self.objects[ob.VisionHDR.lightname] = ob
+                if ob.data.name.startswith("WORLD_"):
+                    self.lamps[ob.data.name] = ob
+                if ob.VisionHDR.light_role == 'EXTRACTED':
+                    self.owned.setdefault(ob.VisionHDR.light_owner, []).append(ob)
+                elif ob.data.name.startswith("VisionHDR"):
+                    self.lights.append(ob)
+        for lights in self.owned.values():
+            lights.sort(key=lambda ob: ob.name)
+        self.count = len(scene.objects)
+
+def is_removed(obj):
+    """Tell if the indexed object was removed from the file"""
+    try:
+        obj.name
+    except ReferenceError:
+        return True
+    return False
+
+#########################################################################################################
+
+#########################################################################################################
+_indexes = {}
+
+def get_index(scene, rebuild=False):
+    """Return the index of the scene, built on the first use"""
+    index = _indexes.get(scene.name)
+    if index is None or rebuild:
+        index = _indexes[scene.name] = VisionHDRIndex(scene)
+    return index
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def index_update(scene):
+    """Forget the index of the scene when objects are added or removed, a replaced object is found by the lookups"""
+    index = _indexes.get(scene.name)
+    if index is not None and index.count != len(scene.objects):
+        del _indexes[scene.name]
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def index_reset(dummy):
+    """Forget the indexes after loading a file or undo"""
+    _indexes.clear()
+
+#########################################################################################################
+
+#########################################################################################################
+def get_object(context, lightname):
+    """Return the object with this name, None when the index has no such light"""
+
+    cobj = get_index(context.scene).objects.get(lightname)
+    if cobj is not None and (is_removed(cobj) or cobj.VisionHDR.lightname != lightname):
+        cobj = get_index(context.scene, rebuild=True).objects.get(lightname)
+
+    return(cobj)
+
+#########################################################################################################
+
+#########################################################################################################
+def get_lamp(context, lightname):
+    """Return the lamp with this name"""
+    
+    cobj = get_object(context, lightname)
+    lamp = get_index(context.scene).lamps.get("WORLD_" + cobj.data.name)
+    if lamp is not None and is_removed(lamp):
+        lamp = get_index(context.scene, rebuild=True).lamps.get("WORLD_" + cobj.data.name)
+    if lamp is not None:
+        cobj = lamp
+    return(cobj)
+
+def get_lights(scene):
+    """Return the VisionHDR lights of the scene, the index is rebuilt if one of them was removed"""
+    lights = get_index(scene).lights
+    if any(is_removed(obj) for obj in lights):
+        lights = get_index(scene, rebuild=True).lights
+    return lights
+
+
+#########################################################################################################
+
+#########################################################################################################
+#---Projections of the environment texture node. The center of the pixel (x, y) is at (x + 0.5, y + 0.5), the
+#---row 0 is the bottom of the image. The functions take scalars or arrays of broadcastable shapes.
+def pixel_to_uv(x, y, size_x, size_y):
+    """Texture coordinates (u, v) of the pixels"""
+    return (np.asarray(x, dtype=np.float64) + 0.5) / size_x, (np.asarray(y, dtype=np.float64) + 0.5) / size_y
+
+def uv_to_pixel(u, v, size_x, size_y):
+    """Pixel coordinates (x, y) of the texture coordinates"""
+    return np.asarray(u, dtype=np.float64) * size_x - 0.5, np.asarray(v, dtype=np.float64) * size_y - 0.5
+
+def uv_to_direction(u, v, projection='EQUIRECTANGULAR'):
+    """Unit direction (x, y, z) looked up at the texture coordinates, zero outside of a mirror ball"""
+    u, v = np.broadcast_arrays(np.asarray(u, dtype=np.float64), np.asarray(v, dtype=np.float64))
+    if projection == 'MIRROR_BALL':
+    #---Reflection of the view (0, 1, 0) on the normal of the ball
+        nx, nz = 2.0 * u - 1.0, 2.0 * v - 1.0
+        r2 = nx * nx + nz * nz
+        ny = -np.sqrt(np.maximum(1.0 - r2, 0.0))
+        inside = r2 <= 1.0
+        return (np.where(inside, -2.0 * ny * nx, 0.0), np.where(inside, 1.0 - 2.0 * ny * ny, 0.0), np.where(inside, -2.0 * ny * nz, 0.0))
+    
+    phi = math.pi * (1.0 - 2.0 * u)
+    lat = math.pi * (v - 0.5)
+    return np.cos(lat) * np.cos(phi), np.cos(lat) * np.sin(phi), np.sin(lat)
+
+def direction_to_uv(x, y, z, projection='EQUIRECTANGULAR'):
+    """Texture coordinates (u, v) of the unit directions"""
+    x, y, z = (np.asarray(c, dtype=np.float64) for c in (x, y, z))
+    if projection == 'MIRROR_BALL':
+        div = 2.0 * np.sqrt(np.maximum(0.5 * (1.0 - y), 0.0))
+        div = np.where(div > 0.0, div, 1.0)
+        return 0.5 * (x / div + 1.0), 0.5 * (z / div + 1.0)
+    
+    return 0.5 - np.arctan2(y, x) / (2.0 * math.pi), np.arctan2(z, np.hypot(x, y)) / math.pi + 0.5
+
+def pixel_to_direction(x, y, size_x, size_y, projection='EQUIRECTANGULAR'):
+    """Unit direction (x, y, z) of the pixels"""
+    return uv_to_direction(*pixel_to_uv(x, y, size_x, size_y), projection=projection)
+
+def direction_to_pixel(x, y, z, size_x, size_y, projection='EQUIRECTANGULAR'):
+    """Pixel coordinates (x, y) of the unit directions, wrapped around the seam of an equirectangular image"""
+    px, py = uv_to_pixel(*direction_to_uv(x, y, z, projection), size_x=size_x, size_y=size_y)
+    if projection != 'MIRROR_BALL':
+        px = (px + 0.5) % size_x - 0.5
+    return px, py
+
+def direction_to_euler(x, y, z):
+    """Rotation (x, z) in radians of a lamp whose axis Z points to the direction, the lamp shines from it"""
+    return np.arccos(np.clip(z, -1.0, 1.0)), np.arctan2(y, x) + math.pi / 2.0
+
+def euler_to_direction(euler_x, euler_z):
+    """Unit direction (x, y, z) of the axis Z of a lamp with this rotation"""
+    sin_x = np.sin(euler_x)
+    return sin_x * np.sin(euler_z), -sin_x * np.cos(euler_z), np.cos(euler_x)
+
+def rotate_direction(x, y, z, rotation):
+    """Direction in the world of a direction of the image turned by the rotation of the mapping node, in degrees"""
+    angle = np.radians(rotation)
+    return np.cos(angle) * x - np.sin(angle) * y, np.sin(angle) * x + np.cos(angle) * y, z
+
+def image_rotation(euler_z, pixel_rotation):
+    """Rotation of the image in degrees that keeps the pixel in front of a lamp turned by euler_z"""
+    return pixel_rotation + math.degrees(euler_z)
+
+def lamp_rotation(rotation, pixel_rotation):
+    """Rotation z in radians of the lamp in front of the pixel for a rotation of the image in degrees"""
+    return math.radians(rotation - pixel_rotation)
+
+#########################################################################################################
+
+#########################################################################################################
+def align_to_pixel(obj_light, img_type, x, y, size_x, size_y, projection='EQUIRECTANGULAR'):
+    """Compute the rotation of the image and the sun from a pixel of the image texture"""
+    euler_x, euler_z = direction_to_euler(*pixel_to_direction(x, y, size_x, size_y, projection))
+    pix_rot = -math.degrees(float(euler_z))
+    pix_roty = -math.degrees(float(euler_x))
+    if img_type == "HDRI":
+        obj_light.VisionHDR.hdri_rotation = image_rotation(obj_light.rotation_euler.z, pix_rot)
+        obj_light.VisionHDR.hdri_rotationy = pix_roty
+        obj_light.VisionHDR.hdri_pix_rot = pix_rot
+        obj_light.VisionHDR.hdri_pix_roty = pix_roty
+    else:
+        obj_light.VisionHDR.img_rotation = image_rotation(obj_light.rotation_euler.z, pix_rot)
+        obj_light.VisionHDR.img_pix_rot = pix_rot
+
+#########################################################################################################
+
+#########################################################################################################
+def image_pixels(image):
+    """Return the pixels of the image as a float array (height, width, channels)"""
+    size_x, size_y = image.size
+    pixels = np.empty(size_x * size_y * image.channels, dtype=np.float32)
+    try:
+        image.pixels.foreach_get(pixels)
+    except AttributeError:
+        pixels[:] = image.pixels[:]
+    
+    return pixels.reshape(size_y, size_x, image.channels)
+
+#########################################################################################################
+
+#########################################################################################################
+def luminance(pixels):
+    """Rec. 709 luminance of the RGB pixels"""
+    if pixels.shape[-1] < 3:
+        return pixels[..., 0]
+    return pixels[..., 0] * 0.2126 + pixels[..., 1] * 0.7152 + pixels[..., 2] * 0.0722
+
+#########################################################################################################
+
+#########################################################################################################
+def box_downsample(pixels, max_width):
+    """Average blocks of 2x2 pixels until the width is at most max_width"""
+    while pixels.shape[1] > max_width and pixels.shape[0] >= 2:
+        h, w = pixels.shape[0] // 2 * 2, pixels.shape[1] // 2 * 2
+        pixels = (pixels[0:h:2, 0:w:2] + pixels[1:h:2, 0:w:2] + pixels[0:h:2, 1:w:2] + pixels[1:h:2, 1:w:2]) * 0.25
+    
+    return pixels
+
+#########################################################################################################
+
+#########################################################################################################
+def luminance_pyramid(lum, min_width=64):
+    """Downsample the luminance by 2x2 box averages down to min_width"""
+    levels = [lum]
+    while levels[-1].shape[1] >= min_width * 2 and levels[-1].shape[0] >= 2:
+        levels.append(box_downsample(levels[-1], levels[-1].shape[1] - 1))
+    
+    return levels
+
+#########################################################################################################
+
+#########################################################################################################
+def find_sun_pixel(lum, analysis_width=1024):
+    """Return the centroid (x, y) in pixels of the brightest lobe of the luminance"""
+    levels = luminance_pyramid(lum)
+
+#---The coarse level smooth the noisy pixels to find the dominant lobe
+    coarse = levels[-1]
+    cy, cx = np.unravel_index(np.argmax(coarse), coarse.shape)
+
+#---Centroid of the lobe on a finer level
+    level = levels[0]
+    for l in levels:
+        if l.shape[1] <= analysis_width:
+            level = l
+            break
+    scale_x = level.shape[1] / coarse.shape[1]
+    scale_y = level.shape[0] / coarse.shape[0]
+    center_x = int((cx + 0.5) * scale_x)
+    center_y = int((cy + 0.5) * scale_y)
+    offsets_x = np.arange(-2 * int(math.ceil(scale_x)), 2 * int(math.ceil(scale_x)) + 1)
+    rows = np.arange(max(0, center_y - 2 * int(math.ceil(scale_y))), min(level.shape[0], center_y + 2 * int(math.ceil(scale_y)) + 1))
+    window = level[rows[:, None], (center_x + offsets_x) % level.shape[1]]
+
+    weights = np.where(window >= window.max() * 0.5, window, 0.0)
+    total = weights.sum()
+    if total <= 0:
+        x, y = center_x, center_y
+    else:
+        x = center_x + (weights.sum(axis=0) * offsets_x).sum() / total
+        y = (weights.sum(axis=1) * rows).sum() / total
+
+#---Back to the pixels of the image
+    full_x = ((x + 0.5) * lum.shape[1] / level.shape[1] - 0.5) % lum.shape[1]
+    full_y = (y + 0.5) * lum.shape[0] / level.shape[0] - 0.5
+    
+    return full_x, full_y
+
+#########################################################################################################
+
+#########################################################################################################
+BAND_SIZE = 16 * 1024 * 1024
+EXR_PIXEL_TYPES = {0: "<u4", 1: "<f2", 2: "<f4"}
+RGBE_SCALES = np.where(np.arange(256) > 0, np.ldexp(1.0, np.arange(256) - 136), 0.0).astype(np.float32)
+
+def map_hdr(filepath):
+    """Memory map the RGBE pixels of an uncompressed Radiance HDR file, None if not possible"""
+    with open(filepath, 'rb') as f:
+        if not f.readline().startswith(b"#?"):
+            return None
+        line = f.readline()
+        while line.strip() != b"":
+            if line.startswith(b"FORMAT=") and b"32-bit_rle_rgbe" not in line:
+                return None
+            line = f.readline()
+        resolution = f.readline().split()
+        offset = f.tell()
+        first = f.read(4)
+    if len(resolution) != 4 or resolution[0] != b"-Y" or resolution[2] != b"+X":
+        return None
+    size_y, size_x = int(resolution[1]), int(resolution[3])
+    
+#---Run length encoded scanlines can not be mapped
+    if 8 <= size_x < 32768 and first[:2] == b"\x02\x02" and (first[2] << 8 | first[3]) == size_x:
+        return None
+    if os.path.getsize(filepath) != offset + size_x * size_y * 4:
+        return None
+    
+    return np.memmap(filepath, dtype=np.uint8, mode='r', offset=offset, shape=(size_y, size_x, 4))
+
+#########################################################################################################
+
+#########################################################################################################
+def map_exr(filepath):
+    """Memory map the scanlines of an uncompressed OpenEXR file, None if not possible"""
+    with open(filepath, 'rb') as f:
+        header = f.read(65536)
+    if len(header) < 8 or header[:4] != b"\x76\x2f\x31\x01" or (header[4] | header[5] << 8 | header[6] << 16) & 0x1a00:
+        return None
+
+#---Attributes of the header : name, type, size, value
+    attributes = {}
+    position = 8
+    while header[position] != 0:
+        name_end = header.index(b"\x00", position)
+        type_end = header.index(b"\x00", name_end + 1)
+        size = int.from_bytes(header[type_end + 1:type_end + 5], 'little')
+        attributes[header[position:name_end]] = header[type_end + 5:type_end + 5 + size]
+        position = type_end + 5 + size
+        if position >= len(header):
+            return None
+    position += 1
+    if attributes.get(b"compression") != b"\x00":
+        return None
+    
+    channels = []
+    chlist = attributes[b"channels"]
+    index = 0
+    while chlist[index] != 0:
+        name_end = chlist.index(b"\x00", index)
+        pixel_type, x_sampling, y_sampling = (int.from_bytes(chlist[name_end + 1 + i:name_end + 5 + i], 'little') for i in (0, 8, 12))
+        if x_sampling != 1 or y_sampling != 1:
+            return None
+        channels.append((chlist[index:name_end].decode(), EXR_PIXEL_TYPES[pixel_type]))
+        index = name_end + 17
+    
+    x_min, y_min, x_max, y_max = (int.from_bytes(attributes[b"dataWindow"][i:i + 4], 'little', signed=True) for i in (0, 4, 8, 12))
+    size_x, size_y = x_max - x_min + 1, y_max - y_min + 1
+    record = np.dtype([("y", "<i4"), ("size", "<i4")] + [(name, pixel_type, (size_x,)) for name, pixel_type in channels])
+    
+#---The scanlines must follow each other from the top, one per chunk
+    offsets = np.memmap(filepath, dtype="<u8", mode='r', offset=position, shape=(size_y,))
+    if attributes.get(b"lineOrder", b"\x00") != b"\x00" or np.any(offsets != offsets[0] + np.arange(size_y, dtype=np.uint64) * record.itemsize):
+        return None
+    
+    return np.memmap(filepath, dtype=record, mode='r', offset=int(offsets[0]), shape=(size_y,))
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRPixels():
+    """Float pixels of an image by bands of rows from the bottom. The file of the image is memory mapped
+    if possible, otherwise the pixels of the Blender image are copied once in a float32 buffer."""
+
+    def __init__(self, image):
+        self.image = image
+        self.filepath = image_filepath(image)
+        self.buffer = None
+        self.hdr = self.exr = None
+        self.size = None
+
+    def layout(self):
+        """Return the width, height and number of channels, the file is only opened on the first call"""
+        if self.size is not None:
+            return self.size
+        
+        if self.filepath is not None and not self.image.is_dirty:
+            try:
+                if self.filepath.lower().endswith(".hdr"):
+                    self.hdr = map_hdr(self.filepath)
+                elif self.filepath.lower().endswith(".exr"):
+                    self.exr = map_exr(self.filepath)
+            except (IOError, OSError, ValueError, KeyError, IndexError) as error:
+                print("(VisionHDR) Unable to map %s : %s" % (self.filepath, error))
+                
+        if self.hdr is not None:
+            self.size = (self.hdr.shape[1], self.hdr.shape[0], 3)
+        elif self.exr is not None:
+            names = self.exr.dtype.names
+            self.exr_channels = [c for c in ("R", "G", "B", "A") if c in names] if "R" in names else [names[2]]
+            self.size = (self.exr.dtype[2].shape[0], self.exr.shape[0], len(self.exr_channels))
+        else:
+            self.size = (self.image.size[0], self.image.size[1], self.image.channels)
+        return self.size
+
+    def mapped(self):
+        self.layout()
+        return self.hdr is not None or self.exr is not None
+
+    def band(self, start, end):
+        """Pixels of the rows start to end (height, width, channels) : a view of the buffer or decoded from the file"""
+        size_x, size_y, channels = self.layout()
+        if self.hdr is not None:
+            rgbe = self.hdr[size_y - end:size_y - start][::-1]
+            return (rgbe[..., :3] + np.float32(0.5)) * RGBE_SCALES[rgbe[..., 3]][..., None]
+        if self.exr is not None:
+            records = self.exr[size_y - end:size_y - start][::-1]
+            return np.stack([records[c] for c in self.exr_channels], axis=-1).astype(np.float32)
+        return self.read()[start:end]
+
+    def bands(self, multiple=1):
+        """Yield (start, end, pixels) for bands of at most BAND_SIZE floats, of a multiple of rows"""
+        size_x, size_y, channels = self.layout()
+        rows = max(multiple, BAND_SIZE // max(1, size_x * channels) // multiple * multiple)
+        for start in range(0, size_y, rows):
+            end = min(size_y, start + rows)
+            yield start, end, self.band(start, end)
+
+    def read(self):
+        """All the pixels (height, width, channels) in one float32 buffer"""
+        if self.buffer is None:
+            if self.mapped():
+                size_x, size_y, channels = self.size
+                self.buffer = np.empty((size_y, size_x, channels), dtype=np.float32)
+                for start, end, pixels in self.bands():
+                    self.buffer[start:end] = pixels
+            else:
+                self.buffer = image_pixels(self.image)
+        return self.buffer
+
+    def factor(self, max_width):
+        """Size of the blocks averaged by box_downsample for this width"""
+        factor = 1
+        while self.layout()[0] // factor > max_width:
+            factor *= 2
+        return factor
+
+    def downsample(self, max_width, function=None):
+        """Box filtered pixels of at most max_width (as box_downsample), computed band by band.
+        The function is applied on the bands of pixels before the filter."""
+        factor = self.factor(max_width)
+        if factor == 1 and not self.mapped():
+            pixels = self.read()
+            return pixels if function is None else function(pixels)
+        
+        parts = []
+        for start, end, pixels in self.bands(factor):
+            rows = (end - start) // factor * factor
+            if rows:
+                pixels = pixels[:rows] if function is None else function(pixels[:rows])
+                parts.append(box_downsample(pixels, max_width))
+        return np.concatenate(parts)
+
+#########################################################################################################
+
+#########################################################################################################
+#---Version of the data of each producer : bump it when the producer or its format changes
+CACHE_VERSIONS = {
+    "analysis": 1,
+    "proxy": 1,
+    "desun": 1,
+    "sun_lobe": 1,
+    "lights": 1,
+    "importance": 1,
+    "sh": 1,
+    }
+
+def cache_key(kind, *parts):
+    """Key of a cache entry from the producer, its version and the parts that identify the input"""
+    return "|".join([kind, "v%d" % CACHE_VERSIONS[kind]] + [str(part) for part in parts])
+
+#########################################################################################################
+
+#########################################################################################################
+class VisionHDRCache():
+    """Persistent cache of the image analysis : one .npz file per entry with LRU eviction"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key, extension=".npz"):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + extension)
+
+    def touch(self, path):
+        """Last access for the LRU eviction"""
+        os.utime(path, None)
+
+    def get(self, key):
+        """Return the arrays stored for this key or None"""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                data = {name: entry[name] for name in entry.files}
+        except (IOError, OSError, ValueError):
+            self.remove(path)
+            return None
+        if str(data.pop("cache_key", "")) != key:
+            return None
+
+        self.touch(path)
+        return data
+
+    def put(self, key, data):
+        """Store the arrays for this key"""
+        path = self.path(key)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, cache_key=key, **data)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as error:
+            print("(VisionHDR) Unable to write the cache : ", error)
+            self.remove(tmp_path)
+            return
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".tmp"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries above the size limit"""
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+#########################################################################################################
+
+#########################################################################################################
+_cache = None
+
+def get_cache():
+    """Return the cache stored beside the user configuration of the addon"""
+    global _cache
+    
+    if _cache is None:
+        _cache = VisionHDRCache(config_directory("cache"), 512 * 1024 * 1024)
+    
+    prefs = get_preferences()
+    if prefs is not None:
+        _cache.max_size = prefs.cache_size * 1024 * 1024
+    
+    return _cache
+
+#########################################################################################################
+
+#########################################################################################################
+def image_filepath(image):
+    """Return the absolute path of the file of the image or None if packed or generated"""
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    if image.packed_file is None and image.source == 'FILE' and os.path.isfile(filepath):
+        return os.path.normcase(os.path.abspath(filepath))
+    return None
+
+#########################################################################################################
+
+#########################################################################################################
+def file_key(filepath):
+    """Key of the file from its path, modification time and size"""
+    stat = os.stat(filepath)
+    return "%s|%s|%s" % (filepath, stat.st_mtime, stat.st_size)
+
+#########################################################################################################
+
+#########################################################################################################
+def image_key(image, source=None):
+    """Key of the image from its file path, modification time and size or from its pixels"""
+    filepath = image_filepath(image)
+    if filepath is not None:
+        return file_key(filepath)
+    
+    if source is None:
+        source = VisionHDRPixels(image)
+    return "pixels|" + hashlib.sha1(np.ascontiguousarray(source.read()).data).hexdigest()
+
+#########################################################################################################
+
+#########################################################################################################
+@profiled()
+def analyze_image(image, source=None):
+    """Return the sun position and the luminance statistics of the image, from the cache if possible"""
+    if source is None:
+        source = VisionHDRPixels(image)
+    key = image_key(image, source)
+    
+    cache = get_cache()
+    analysis = cache.get(cache_key("analysis", key))
+    if analysis is not None:
+        return analysis
+
+#---Weight of the rows from the solid angle of the equirectangular image
+    size_x, size_y, channels = source.layout()
+    weights = np.cos((np.arange(size_y) + 0.5) / size_y * math.pi - math.pi / 2)
+    weights /= weights.sum() * size_x
+
+#---Statistics of the full resolution bands and luminance downsampled for the sun detection
+    factor = source.factor(1024)
+    lum_max, mean_lum, color, levels = 0.0, 0.0, np.zeros(3), []
+    for start, end, pixels in source.bands(factor):
+        lum = luminance(pixels)
+        lum_max = max(lum_max, float(lum.max()))
+        mean_lum += float((lum.sum(axis=1) * weights[start:end]).sum())
+        if channels >= 3:
+            color += (pixels[..., :3].sum(axis=1) * weights[start:end, None]).sum(axis=0)
+        rows = (end - start) // factor * factor
+        if rows:
+            levels.append(box_downsample(lum[:rows], 1024))
+    if channels < 3:
+        color = np.repeat(mean_lum, 3)
+    x, y = find_sun_pixel(np.concatenate(levels))
+    x = ((x + 0.5) * factor - 0.5) % size_x
+    y = (y + 0.5) * factor - 0.5
+    
+    analysis = {
+        "sun": np.array([x, y]),
+        "size": np.array([size_x, size_y]),
+        "lum_mean": np.array(mean_lum),
+        "lum_max": np.array(lum_max),
+        "color": color / max(color.max(), 1e-8),
+    #---Exposure (EV) to bring the average luminance to middle grey
+        "exposure": np.array(math.log2(0.18 / mean_lum) if mean_lum > 0 else 0.0),
+        }
+    cache.put(cache_key("analysis", key), analysis)
+    
+    return analysis
+
+#########################################################################################################
+
+#########################################################################################################
+def set_image_pixels(image, pixels):
+    """Write a float array (height, width, channels) in the pixels of the image"""
+    if pixels.shape[-1] < image.channels:
+        alpha = np.ones(pixels.shape[:2] + (image.channels - pixels.shape[-1],), dtype=np.float32)
+        pixels = np.concatenate((pixels, alpha), axis=-1)
+    pixels = np.ascontiguousarray(pixels[..., :image.channels], dtype=np.float32).ravel()
+    try:
+        image.pixels.foreach_set(pixels)
+    except AttributeError:
+        image.pixels[:] = pixels.tolist()
+
+#########################################################################################################
+
+#########################################################################################################
+def get_proxy(image, resolution):
+    """Return a downsampled copy of the image for the viewport, cached on disk"""
+    source = VisionHDRPixels(image)
+    key = cache_key("proxy", resolution, image_key(image, source))
+    name = ("VisionHDR_PROXY_%d_%s" % (resolution, image.name))[:63]
+    proxy = bpy.data.images.get(name)
+    if proxy is not None and proxy.get("visionhdr_key") == key and os.path.isfile(bpy.path.abspath(proxy.filepath)):
+        return proxy
+
+#---The size of the image is only read if the proxy is not cached, to avoid loading the pixels
+    cache = get_cache()
+    path = cache.path(key, ".exr")
+    if not os.path.isfile(path) and source.layout()[0] <= resolution:
+        return image
+
+    if proxy is not None:
+        bpy.data.images.remove(proxy, do_unlink=True)
+
+    if os.path.isfile(path):
+        proxy = bpy.data.images.load(path)
+        proxy.name = name
+        cache.touch(path)
+    else:
+    #---Box filtered mip level of the image : the average radiance is preserved
+        pixels = source.downsample(resolution)
+        proxy = bpy.data.images.new(name, pixels.shape[1], pixels.shape[0], alpha=True, float_buffer=True)
+        set_image_pixels(proxy, pixels)
+        proxy.filepath_raw = path
+        proxy.file_format = 'OPEN_EXR'
+        proxy.save()
+        cache.evict()
+
+    proxy["visionhdr_key"] = key
+    proxy["visionhdr_source"] = image.name
+    
+    return proxy
+
+#########################################################################################################
+
+#########################################################################################################
+def viewport_image(image):
+    """Return the proxy of the image if enabled in the preferences"""
+    prefs = get_preferences()
+    if prefs is None or prefs.proxy_resolution == 'NONE':
+        return image
+    return get_proxy(image, int(prefs.proxy_resolution))
+
+#########################################################################################################
+
+#########################################################################################################
+_proxy_swaps = []
+
+@persistent
+def proxy_render_pre(scene):
+    """Render with the full resolution images instead of the proxies"""
+    for world in bpy.data.worlds:
+        if world.node_tree is None:
+            continue
+        for node in world.node_tree.nodes:
+            if node.type == 'TEX_ENVIRONMENT' and node.image is not None and "visionhdr_source" in node.image:
+                source = bpy.data.images.get(node.image["visionhdr_source"])
+                if source is not None:
+                    _proxy_swaps.append((node, node.image))
+                    node.image = source
+
+#########################################################################################################
+
+#########################################################################################################
+@persistent
+def proxy_render_post(scene):
+    """Restore the proxies after the render"""
+    for node, proxy in _proxy_swaps:
+        node.image = proxy
+    del _proxy_swaps[:]
+
+#########################################################################################################
+
+#########################################################################################################
+def equirect_directions(size_x, size_y):
+    """Unit directions (x, y, z) of the pixel centers of an equirectangular image, of shape (size_y, size_x)"""
+    x, y, z = pixel_to_direction(np.arange(size_x)[None, :], np.arange(size_y)[:, None], size_x, size_y)
+    
+    return np.broadcast_arrays(x, y, z)
+
+#########################################################################################################
+
+#########################################################################################################
+def equirect_solid_angles(size_x, size_y):
+    """Solid angle of the pixels of each row of an equirectangular image"""
+    lat = math.pi * ((np.arange(size_y) + 0.5) / size_y - 0.5)
+    return (2.0 * math.pi / size_x) * (math.pi / size_y) * np.cos(lat)
+
+#########################################################################################################
+
+#########################################################################################################
+def sh_basis(x, y, z):
+    """Real spherical harmonics basis up to L2 (9 functions) on the last axis"""
+    return np.stack((
+        0.282095 * np.ones_like(x),
+        0.488603 * y,
+        0.488603 * z,
+        0.488603 * x,
+        1.092548 * x * y,
+        1.092548 * y * z,
+        0.315392 * (3.0 * z * z - 1.0),
+        1.092548 * x * z,
+        0.546274 * (x * x - y * y),
+        ), axis=-1)
+
+#---Convolution of the bands with the clamped cosine (Ramamoorthi & Hanrahan)
+SH_IRRADIANCE = np.array((math.pi,) + (2.0 * math.pi / 3.0,) * 3 + (math.pi / 4.0,) * 5)
+
+#########################################################################################################
+
+#########################################################################################################
+def sh_project(pixels, max_width=1024):
+    """Project the RGB radiance of an equirectangular image on the L2 spherical harmonics : array (9, 3)"""
+    pixels = box_downsample(pixels, max_width)
+    size_y, size_x = pixels.shape[:2]
+    rgb = pixels[..., :3] if pixels.shape[-1] >= 3 else np.repeat(pixels[..., :1], 3, axis=-1)
+    basis = sh_basis(*equirect_directions(size_x, size_y))
+    
+    return np.einsum('hwk,hwc,h->kc', basis, rgb.astype(np.float64), equirect_solid_angles(size_x, size_y))
+
+#########################################################################################################
+
+#########################################################################################################
+def sh_irradiance(coeffs, x, y, z):
+    """Irradiance received by a surface of normal (x, y, z) from the spherical harmonics"""
+    return np.tensordot(sh_basis(x, y, z), coeffs * SH_IRRADIANCE[:, None], axes=1)
+
+#########################################################################################################
+
+#########################################################################################################
+def sh_image(cobj, size_x=64, size_y=32):
+    """Low frequency environment image rebuilt from the spherical harmonics of the light"""
+    name = ("VisionHDR_SH_" + cobj.name)[:63]
+    image = bpy.data.images.get(name)
+    if image is None:
+        image = bpy.data.images.new(name, size_x, size_y, alpha=True, float_buffer=True)
+
+#---The radiance limited to the L2 band gives the same diffuse lighting as the full image
+    coeffs = np.array(cobj.VisionHDR.sh_coeffs).reshape(9, 3)
+    radiance = np.tensordot(sh_basis(*equirect_directions(image.size[0], image.size[1])), coeffs, axes=1)
+    set_image_pixels(image, np.maximum(radiance, 0.0).astype(np.float32))
+    
+    return image
+
+@persistent
+def sh_image_restore(dummy):
+    """Fill the spherical harmonics images again after loading a file : generated pixels are not saved"""
+    for obj in bpy.data.objects:
+        if obj.type == 'LAMP' and obj.library is None and obj.VisionHDR.sh_lighting and any(obj.VisionHDR.sh_coeffs):
+            sh_image(obj)
+
+#########################################################################################################
+
+#########################################################################################################
+def sun_lobe(pixels, sun_x, sun_y, radius=8.0, max_width=2048):
+    """Irradiance of the sun lobe above the level of the sky around it and the level to clamp it"""
+    sun = [float(c) for c in pixel_to_direction(sun_x, sun_y, pixels.shape[1], pixels.shape[0])]
+
+#---The box filter keeps the integral of the radiance
+    pixels = box_downsample(pixels, max_width)
+    size_y, size_x = pixels.shape[:2]
+    rgb = pixels[..., :3] if pixels.shape[-1] >= 3 else np.repeat(pixels[..., :1], 3, axis=-1)
+    x, y, z = equirect_directions(size_x, size_y)
+    cos_angle = x * sun[0] + y * sun[1] + z * sun[2]
+    lobe = cos_angle > math.cos(math.radians(radius))
+    ring = ~lobe & (cos_angle > math.cos(math.radians(radius * 1.5)))
+
+#---Sky around the sun
+    background = rgb[ring].mean(axis=0) if ring.any() else np.zeros(3)
+    excess = np.maximum(rgb - background, 0.0) * lobe[..., None]
+    irradiance = (excess * equirect_solid_angles(size_x, size_y)[:, None, None]).sum(axis=(0, 1))
+    
+    return {
+        "irradiance": irradiance,
+        "background": background,
+        "clamp": np.array(float(rgb[~lobe].max()) if (~lobe).any() else float(rgb.max())),
+        }
+
+#########################################################################################################
+
+#########################################################################################################
+_sun_lobes = {}
+
+def get_sun_lobe(image, source=None):
+    """Return the sun lobe of the image from the memory or disk cache"""
+    if source is None:
+        source = VisionHDRPixels(image)
+    key = cache_key("sun_lobe", image_key(image, source))
+    lobe = _sun_lobes.get(key)
+    if lobe is not None:
+        return lobe
+
+    cache = get_cache()
+    lobe = cache.get(key)
+    if lobe is None:
+        x, y = analyze_image(image, source)["sun"]
+        factor = source.factor(2048)
+        lobe = sun_lobe(source.downsample(2048), (x + 0.5) / factor - 0.5, (y + 0.5) / factor - 0.5)
+        cache.put(key, lobe)
+    _sun_lobes[key] = lobe
+    
+    return lobe
+
+#########################################################################################################
+
+#########################################################################################################
+def calibrate_sun(cobj):
+    """Set the strength and color of the sun lamp from the sun lobe of the environment image"""
+    irradiance = get_sun_lobe(bpy.data.images[cobj.VisionHDR.hdri_name])["irradiance"]
+    strength = float(irradiance.max())
+    if strength <= 0:
+        return False
+
+#---Only update the lamp if the values changed
+    color = tuple(irradiance / strength) + (1.0,)
+    if abs(cobj.VisionHDR.sun_energy - strength) > 1e-4:
+        cobj.VisionHDR.sun_energy = strength
+    if any(abs(a - b) > 1e-4 for a, b in zip(cobj.VisionHDR.lightcolor, color)):
+        cobj.VisionHDR.lightcolor = color
+    return True
+
+#########################################################################################################
+
+#########################################################################################################
+def update_sun_calibrate(self, context):
+    """Calibrate the sun when the automatic calibration is enabled"""
+    cobj = get_object(context, self.lightname)
+    if cobj.VisionHDR.sun_calibrate and cobj.VisionHDR.hdri_name != "":
+        calibrate_sun(cobj)
+
+#########################################################################################################
+
+#########################################################################################################
+EXTRACT_WIDTH = 512
+#---Clusters smaller than this radius in degrees are suns, the larger ones are area lamps
+EXTRACT_SUN_RADIUS = 2.0
+
+def label_components(mask):
+    """Label the 4-connected areas of the mask, wrapping around the seam of the image : (labels, count), -1 outside"""
+    size = mask.size
+    labels = np.where(mask, np.arange(size).reshape(mask.shape), size)
+    while True:
+    #---Smallest label of the neighbours, the columns wrap around the seam of the equirectangular image
+        smallest = np.minimum(labels, np.minimum(np.roll(labels, 1, axis=1), np.roll(labels, -1, axis=1)))
+        smallest[1:] = np.minimum(smallest[1:], labels[:-1])
+        smallest[:-1] = np.minimum(smallest[:-1], labels[1:])
+        smallest = np.where(mask, smallest, size)
+    #---Pointer jumping : a pixel takes the label of the pixel its label points to
+        smallest = np.minimum(smallest, np.append(smallest.ravel(), size)[smallest])
+        if np.array_equal(smallest, labels):
+            break
+        labels = smallest
+
+#---Consecutive labels, the pixels outside the mask have the largest one
+    roots, labels = np.unique(labels.ravel(), return_inverse=True)
+    count = len(roots) - (0 if mask.all() else 1)
+    
+    return np.where(mask, labels.reshape(mask.shape), -1), count
+
+#########################################################################################################
+
+#########################################################################################################
+def light_clusters(pixels, count=4, threshold=3.0):
+    """Direction, irradiance and solid angle of the count brightest clusters, threshold in EV above the median"""
+    size_y, size_x = pixels.shape[:2]
+    rgb = pixels[..., :3] if pixels.shape[-1] >= 3 else np.repeat(pixels[..., :1], 3, axis=-1)
+    lum = luminance(rgb)
+    background = np.median(rgb.reshape(-1, 3), axis=0)
+    labels, found = label_components(lum > max(float(np.median(lum)), 1e-6) * 2.0 ** threshold)
+    if found == 0:
+        return {"direction": np.zeros((0, 3)), "irradiance": np.zeros((0, 3)), "solid_angle": np.zeros(0)}
+
+#---Sums over the pixels of each cluster of the radiance above the background
+    inside = labels >= 0
+    index = labels[inside]
+    omega = np.broadcast_to(equirect_solid_angles(size_x, size_y)[:, None], lum.shape)[inside]
+    excess = np.maximum(rgb[inside] - background, 0.0) * omega[:, None]
+    weights = luminance(excess)
+    irradiance = np.stack([np.bincount(index, excess[:, c], found) for c in range(3)], axis=-1)
+    direction = np.stack([np.bincount(index, d[inside] * weights, found) for d in equirect_directions(size_x, size_y)], axis=-1)
+    solid_angle = np.bincount(index, omega, found)
+
+    order = np.argsort(-luminance(irradiance), kind='stable')[:count]
+    direction = direction[order]
+    
+    return {
+        "direction": direction / np.maximum(np.linalg.norm(direction, axis=-1), 1e-12)[:, None],
+        "irradiance": irradiance[order],
+        "solid_angle": solid_angle[order],
+        }
+
+#########################################################################################################
+
+#########################################################################################################
+def get_light_clusters(image, count, threshold):
+    """Return the brightest clusters of the image from the cache"""
+    source = VisionHDRPixels(image)
+    key = cache_key("lights", count, "%g" % threshold, image_key(image, source))
+    cache = get_cache()
+    clusters = cache.get(key)
+    if clusters is None:
+        clusters = light_clusters(source.downsample(EXTRACT_WIDTH), count, threshold)
+        cache.put(key, clusters)
+    
+    return clusters
+
+#########################################################################################################
+
+#########################################################################################################
+def get_extracted(context, lightname):
+    """Return the lamps extracted for the light, sorted by name"""
+    lights = get_index(context.scene).owned.get(lightname, [])
+    if any(is_removed(obj) or obj.VisionHDR.light_owner != lightname for obj in lights):
+        lights = get_index(context.scene, rebuild=True).owned.get(lightname, [])
+    
+    return lights
+
+#########################################################################################################
+
+#########################################################################################################
+def remove_extracted(obj):
+    """Remove an extracted lamp and its data"""
+    lamp = obj.data
+    bpy.data.objects.remove(obj, do_unlink=True)
+    if lamp.users == 0:
+        bpy.data.lamps.remove(lamp, do_unlink=True)
+
+#########################################################################################################
+
+#########################################################################################################
+def orient_extracted(cobj, context):
+    """Point the extracted lamps to their cluster in the rotated environment image"""
+    distance = cobj.VisionHDR.extract_distance
+    for obj in get_extracted(context, cobj.VisionHDR.lightname):
+        direction = Vector([float(c) for c in rotate_direction(*obj.VisionHDR.light_direction, rotation=scene_rotation(context.scene, cobj))])
+        euler_x, euler_z = direction_to_euler(*direction)
+        obj.rotation_euler = (float(euler_x), 0.0, float(euler_z))
+        obj.location = direction * distance
+
+#########################################################################################################
+
+#########################################################################################################
+def extract_lights(cobj, context):
+    """Create one lamp per bright cluster of the environment image, managed as the set of the light"""
+    clusters = get_light_clusters(bpy.data.images[cobj.VisionHDR.hdri_name], cobj.VisionHDR.extract_count, cobj.VisionHDR.extract_threshold)
+    lights = get_extracted(context, cobj.VisionHDR.lightname)
+    found = len(clusters["direction"])
+    
+#---Remove the lamps of the previous extraction that are not needed anymore
+    for obj in lights[found:]:
+        remove_extracted(obj)
+    
+    distance = cobj.VisionHDR.extract_distance
+    for i in range(found):
+        radius = math.acos(max(-1.0, 1.0 - float(clusters["solid_angle"][i]) / (2.0 * math.pi)))
+        lamp_type = 'SUN' if math.degrees(radius) < EXTRACT_SUN_RADIUS else 'AREA'
+        if i < len(lights):
+            obj = lights[i]
+            if obj.data.type != lamp_type:
+                obj.data.type = lamp_type
+        else:
+            lamp = bpy.data.lamps.new("HDRI_LIGHT_%02d" % (i + 1), lamp_type)
+            lamp.use_nodes = True
+            lamp.cycles.use_multiple_importance_sampling = True
+            obj = bpy.data.objects.new(lamp.name, lamp)
+            context.scene.objects.link(obj)
+            obj.VisionHDR.light_role = 'EXTRACTED'
+            obj.VisionHDR.light_owner = cobj.VisionHDR.lightname
+            obj.VisionHDR.lightname = lamp.name
+        #---The updates of the energy and color find the lamp through the index
+            get_index(context.scene, rebuild=True)
+        obj.VisionHDR.light_direction = clusters["direction"][i].tolist()
+        
+    #---A sun gives the irradiance of the cluster, an area lamp gives it at the distance of the lamp
+        irradiance = clusters["irradiance"][i]
+        strength = float(irradiance.max())
+        if lamp_type == 'SUN':
+            obj.data.shadow_soft_size = math.tan(radius)
+            obj.VisionHDR.sun_energy = strength
+        else:
+            obj.data.shape = 'SQUARE'
+            obj.data.size = 2.0 * distance * math.tan(radius)
+            obj.VisionHDR.sun_energy = math.pi * distance * distance * strength
+        obj.VisionHDR.lightcolor = tuple(irradiance / max(strength, 1e-12)) + (1.0,)
+    
+    get_index(context.scene, rebuild=True)
+    orient_extracted(cobj, context)
+    
+    return found
+
+#########################################################################################################
+
+#########################################################################################################
+def update_light_mode(self, context):
+    """Replace the sun lamp by the lamps extracted from the environment image, or bring it back"""
+    cobj = get_object(context, self.lightname)
+    extract = cobj.VisionHDR.light_mode == 'EXTRACT'
+    if extract and cobj.VisionHDR.hdri_name != "":
+        extract_lights(cobj, context)
+    elif not extract:
+        for obj in get_extracted(context, cobj.VisionHDR.lightname):
+            remove_extracted(obj)
+        get_index(context.scene, rebuild=True)
+    if cobj.hide_render != extract:
+        cobj.hide_render = extract
+
+def update_extract(self, context):
+    """Extract the lamps again with the new settings"""
+    cobj = get_object(context, self.lightname)
+    if cobj.VisionHDR.light_mode == 'EXTRACT' and cobj.VisionHDR.hdri_name != "":
+        extract_lights(cobj, context)
+
+#########################################################################################################
+
+#########################################################################################################
+def has_fcurve(id_data, data_path, index):
+    """Tell if the property is animated by the action of the data"""
+    animation = id_data.animation_data
+    return animation is not None and animation.action is not None and animation.action.fcurves.find(data_path, index) is not None
+
+def bake_fcurve(id_data, data_path, index, frames, values):
+    """Replace the fcurve of the property by linear keys, evaluated by Blender on each frame without Python"""
+    if id_data.animation_data is None:
+        id_data.animation_data_create()
+    animation = id_data.animation_data
+    if animation.action is None:
+        animation.action = bpy.data.actions.new(("VisionHDR_" + id_data.name)[:63])
+    fcurves = animation.action.fcurves
+    fcurve = fcurves.find(data_path, index)
+    if fcurve is not None:
+        fcurves.remove(fcurve)
+    fcurve = fcurves.new(data_path, index, "VisionHDR")
+    fcurve.keyframe_points.add(len(frames))
+    fcurve.keyframe_points.foreach_set("co", np.column_stack((frames, values)).astype(np.float32).ravel())
+    for key in fcurve.keyframe_points:
+        key.interpolation = 'LINEAR'
+    fcurve.update()
+
+def clear_baked(id_data):
+    """Remove the fcurves baked by the addon"""
+    if id_data is None or id_data.animation_data is None or id_data.animation_data.action is None:
+        return
+    fcurves = id_data.animation_data.action.fcurves
+    for fcurve in [fcurve for fcurve in fcurves if fcurve.group is not None and fcurve.group.name == "VisionHDR"]:
+        fcurves.remove(fcurve)
+
+#########################################################################################################
+
+#########################################################################################################
+def bake_time_of_day(cobj, context, frames, rotation, sun_euler=None, energy=None, color=None):
+    """Bake the rotation of the images, the sun and the extracted lamps, with the energy and color of the sun"""
+    frames = np.asarray(frames, dtype=np.float64)
+    rotation = np.broadcast_to(np.asarray(rotation, dtype=np.float64), frames.shape)
+    graph = get_world_graph(context.scene.world)
+    tree = context.scene.world.node_tree
+
+#---Images : the reflection image keeps its offset when it is locked on the environment image
+    mapping = -np.radians(rotation)
+    bake_fcurve(tree, graph["mapping"].path_from_id("rotation"), 2, frames, mapping)
+    if cobj.VisionHDR.rotation_lock_hdri:
+        offset = graph["mapping2"].rotation[2] - graph["mapping"].rotation[2]
+        bake_fcurve(tree, graph["mapping2"].path_from_id("rotation"), 2, frames, mapping + offset)
+
+#---Sun lamp, the angles are unwrapped so the keys do not turn the long way
+    if sun_euler is None and cobj.VisionHDR.rotation_lock_sun:
+        sun_euler = (np.full(frames.shape, cobj.rotation_euler.x), np.radians(rotation - cobj.VisionHDR.hdri_pix_rot))
+    if sun_euler is not None:
+        bake_fcurve(cobj, "rotation_euler", 0, frames, np.broadcast_to(sun_euler[0], frames.shape))
+        bake_fcurve(cobj, "rotation_euler", 2, frames, np.unwrap(np.broadcast_to(sun_euler[1], frames.shape)))
+    emission = cobj.data.node_tree.nodes["Emission"] if cobj.data.node_tree is not None else None
+    if emission is not None and energy is not None:
+        bake_fcurve(cobj.data.node_tree, emission.inputs[1].path_from_id("default_value"), 0, frames, np.broadcast_to(energy, frames.shape))
+    if emission is not None and color is not None:
+        color = np.broadcast_to(color, frames.shape + (3,))
+        for channel in range(3):
+            bake_fcurve(cobj.data.node_tree, emission.inputs[0].path_from_id("default_value"), channel, frames, color[:, channel])
+
+#---Lamps extracted from the image
+    distance = cobj.VisionHDR.extract_distance
+    for obj in get_extracted(context, cobj.VisionHDR.lightname):
+        direction = rotate_direction(*obj.VisionHDR.light_direction, rotation=rotation)
+        euler_x, euler_z = direction_to_euler(*direction)
+        bake_fcurve(obj, "rotation_euler", 0, frames, np.broadcast_to(euler_x, frames.shape))
+        bake_fcurve(obj, "rotation_euler", 2, frames, np.unwrap(euler_z))
+        for axis in range(3):
+            bake_fcurve(obj, "location", axis, frames, np.broadcast_to(direction[axis], frames.shape) * distance)
+
+    cobj.VisionHDR.time_baked = True
+
+def clear_time_of_day(cobj, context):
+    """Remove the baked animation of the light"""
+    clear_baked(context.scene.world.node_tree)
+    clear_baked(cobj)
+    clear_baked(cobj.data.node_tree)
+    for obj in get_extracted(context, cobj.VisionHDR.lightname):
+        clear_baked(obj)
+    cobj.VisionHDR.time_baked = False
+
+def time_of_day_frames(cobj, scene):
+    """Frames of the scene baked with the step of the light, the last frame included"""
+    frames = np.arange(scene.frame_start, scene.frame_end + 1, cobj.VisionHDR.time_step)
+    if frames[-1] != scene.frame_end:
+        frames = np.append(frames, scene.frame_end)
+    return frames
+
+#########################################################################################################
+
+#########################################################################################################
+def local_timestamps(year, month, day, hours, timezone):
+    """Seconds since 1970-01-01 UTC of the local dates and hours, on arrays"""
+    year, month, day = (np.asarray(v, dtype=np.int64) for v in (year, month, day))
+#---Days from the civil date (proleptic Gregorian calendar)
+    y = year - (month <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    days = era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+    
+    return days * 86400.0 + (np.asarray(hours, dtype=np.float64) - timezone) * 3600.0
+
+def solar_position(timestamps, latitude, longitude):
+    """Azimuth (clockwise from the north) and elevation in degrees of the sun, NOAA solar calculator"""
+    jc = (np.asarray(timestamps, dtype=np.float64) / 86400.0 + 2440587.5 - 2451545.0) / 36525.0
+    mean_long = np.radians((280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360.0)
+    mean_anom = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    center = (np.sin(mean_anom) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+              + np.sin(2.0 * mean_anom) * (0.019993 - 0.000101 * jc) + np.sin(3.0 * mean_anom) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * jc)
+    app_long = np.radians(np.degrees(mean_long) + center - 0.00569 - 0.00478 * np.sin(omega))
+    obliquity = np.radians(23.0 + (26.0 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60.0) / 60.0 + 0.00256 * np.cos(omega))
+    declination = np.arcsin(np.sin(obliquity) * np.sin(app_long))
+    var_y = np.tan(obliquity / 2.0) ** 2
+    eq_time = 4.0 * np.degrees(var_y * np.sin(2.0 * mean_long) - 2.0 * eccent * np.sin(mean_anom)
+                               + 4.0 * eccent * var_y * np.sin(mean_anom) * np.cos(2.0 * mean_long)
+                               - 0.5 * var_y * var_y * np.sin(4.0 * mean_long) - 1.25 * eccent * eccent * np.sin(2.0 * mean_anom))
+
+#---Hour angle from the true solar time in minutes
+    solar_time = (np.asarray(timestamps, dtype=np.float64) % 86400.0 / 60.0 + eq_time + 4.0 * longitude) % 1440.0
+    hour_angle = np.radians(solar_time / 4.0 - 180.0)
+    lat = math.radians(latitude)
+    cos_zenith = np.clip(math.sin(lat) * np.sin(declination) + math.cos(lat) * np.cos(declination) * np.cos(hour_angle), -1.0, 1.0)
+    zenith = np.arccos(cos_zenith)
+    cos_azimuth = np.clip((math.sin(lat) * cos_zenith - np.sin(declination)) / np.maximum(math.cos(lat) * np.sin(zenith), 1e-12), -1.0, 1.0)
+    azimuth = np.where(hour_angle > 0.0, np.degrees(np.arccos(cos_azimuth)) + 180.0, 540.0 - np.degrees(np.arccos(cos_azimuth))) % 360.0
+
+#---Refraction of the standard atmosphere
+    elevation = 90.0 - np.degrees(zenith)
+    tan_e = np.tan(np.radians(elevation))
+    tan_e = np.where(tan_e == 0.0, 1e-12, tan_e)
+    refraction = np.where(elevation > 85.0, 0.0,
+                 np.where(elevation > 5.0, 58.1 / tan_e - 0.07 / tan_e ** 3 + 0.000086 / tan_e ** 5,
+                 np.where(elevation > -0.575, 1735.0 + elevation * (-518.2 + elevation * (103.4 + elevation * (-12.79 + elevation * 0.711))),
+                 -20.772 / tan_e))) / 3600.0
+    
+    return azimuth, elevation + refraction
+
+def sun_direction(azimuth, elevation, north=0.0):
+    """Unit direction (x, y, z) of the sun in the scene, the north is the axis Y turned by north degrees"""
+    azimuth = np.radians(np.asarray(azimuth, dtype=np.float64) - north)
+    elevation = np.radians(elevation)
+    return np.cos(elevation) * np.sin(azimuth), np.cos(elevation) * np.cos(azimuth), np.sin(elevation)
+
+def sun_air_mass(elevation):
+    """Length of the path of the sunlight through the atmosphere relative to the zenith, Kasten-Young"""
+    zenith = 90.0 - np.clip(np.asarray(elevation, dtype=np.float64), 0.0, 90.0)
+    return 1.0 / (np.cos(np.radians(zenith)) + 0.50572 * (96.07995 - zenith) ** -1.6364)
+
+def sun_attenuation(elevation):
+    """Direct irradiance of the sun relative to the zenith : Kasten-Young air mass and Meinel, zero below the horizon"""
+    elevation = np.asarray(elevation, dtype=np.float64)
+    return np.where(elevation > 0.0, 0.7 ** (sun_air_mass(elevation) ** 0.678) / 0.7, 0.0)
+
+#---Rayleigh optical depth of the atmosphere at 650, 550 and 450 nm (Hansen & Travis)
+SUN_RAYLEIGH_DEPTH = np.array((0.0493, 0.0973, 0.2213))
+
+def sun_tint(elevation):
+    """RGB tint (..., 3) of the sun scattered by the air : white at the zenith, redder to the horizon, max channel 1"""
+    transmittance = np.exp(-SUN_RAYLEIGH_DEPTH * np.maximum(np.asarray(sun_air_mass(elevation))[..., None] - 1.0, 0.0))
+    return transmittance / transmittance.max(axis=-1)[..., None]
+
+#########################################################################################################
+
+#########################################################################################################
+def light_sun_position(cobj, hours):
+    """Rotation (x, z) of the sun, its attenuation and its tint for local hours at the date and place of the light"""
+    v = cobj.VisionHDR
+    timestamps = local_timestamps(v.sun_year, v.sun_month, v.sun_day, hours, v.sun_timezone)
+    azimuth, elevation = solar_position(timestamps, v.sun_latitude, v.sun_longitude)
+    euler_x, euler_z = direction_to_euler(*sun_direction(azimuth, elevation, v.sun_north))
+    if np.ndim(euler_z) > 0:
+        euler_z = np.unwrap(euler_z)
+    return euler_x, euler_z, sun_attenuation(elevation), sun_tint(elevation)
+
+def place_sun(cobj, context):
+    """Turn the sun to its position at the date and place of the light, the image follows when the rotation is locked"""
+    euler_x, euler_z, attenuation, tint = light_sun_position(cobj, cobj.VisionHDR.sun_hour)
+    euler_x, euler_z = float(euler_x), float(euler_z)
+
+#---The sun of the image stays under the lamp : inverse of the lock of the rotation
+    if cobj.VisionHDR.rotation_lock_sun:
+        rotation = (image_rotation(euler_z, cobj.VisionHDR.hdri_pix_rot) + 180.0) % 360.0 - 180.0
+        if context.scene.visionhdr.use_rotation:
+            context.scene.visionhdr.rotation = rotation
+        elif abs(cobj.VisionHDR.hdri_rotation - rotation) > 1e-4:
+            cobj.VisionHDR.hdri_rotation = rotation
+    cobj.rotation_euler.x = euler_x
+    cobj.rotation_euler.z = euler_z
+    return float(attenuation)
+
+def bake_sun_position(cobj, context):
+    """Bake the path of the sun from the start to the end hour over the frames of the scene"""
+    scene = context.scene
+    frames = time_of_day_frames(cobj, scene)
+    span = max(scene.frame_end - scene.frame_start, 1)
+    start, end = cobj.VisionHDR.sun_hour, cobj.VisionHDR.sun_hour_end
+    euler_x, euler_z, attenuation, tint = light_sun_position(cobj, start + (end - start) * (frames - scene.frame_start) / span)
+    
+    if cobj.VisionHDR.rotation_lock_sun:
+        rotation = np.degrees(euler_z) + cobj.VisionHDR.hdri_pix_rot
+    else:
+        rotation = scene_rotation(scene, cobj)
+    
+#---The color of the light is the color of the sun at the zenith
+    energy = cobj.VisionHDR.sun_energy * attenuation
+    color = np.asarray(cobj.VisionHDR.lightcolor[:3]) * tint
+    bake_time_of_day(cobj, context, frames, rotation, sun_euler=(euler_x, euler_z), energy=energy, color=color)
+    return frames
+
+def update_sun_position(self, context):
+    """Place the sun when the date or the place of the light changes"""
+    cobj = get_object(context, self.lightname)
+    if cobj is not None and cobj.VisionHDR.use_sun_position:
+        place_sun(cobj, context)
+
+#########################################################################################################
+
+#########################################################################################################
+def rgbe(rgb):
+    """Radiance RGBE encoding of float pixels (..., 3)"""
+    rgb = np.maximum(rgb, 0.0)
+    m = rgb.max(axis=-1)
+    mantissa, exponent = np.frexp(m)
+    valid = m > 1e-32
+    scale = np.where(valid, mantissa * 256.0 / np.where(valid, m, 1.0), 0.0)
+    encoded = np.empty(rgb.shape[:-1] + (4,), dtype=np.uint8)
+    encoded[..., :3] = np.minimum(rgb * scale[..., None], 255.0)
+    encoded[..., 3] = np.where(valid, exponent + 128, 0)
+    return encoded
+
+#########################################################################################################
+
+#########################################################################################################
+def desun_band(rgb, rows, size_y, sun_x, sun_direction, cos_radius, level, mode):
+    """Remove the sun from a band of rows of the image, return the band unchanged if it misses the lobe"""
+    size_x = rgb.shape[1]
+    lat = math.pi * ((rows + 0.5) / size_y - 0.5)
+    phi = math.pi * (1.0 - 2.0 * (np.arange(size_x) + 0.5) / size_x)
+    cos_angle = (np.cos(lat)[:, None] * (sun_direction[0] * np.cos(phi) + sun_direction[1] * np.sin(phi))[None, :]
+                 + (np.sin(lat) * sun_direction[2])[:, None])
+    lobe = cos_angle > cos_radius
+    if not lobe.any():
+        return rgb
+    rgb = rgb.copy()
+    
+    if mode == 'CLAMP':
+        rgb[lobe] = np.minimum(rgb[lobe], level)
+        return rgb
+
+#---Inpaint the pixels of the lobe brighter than the sky : interpolate along the rows between the sky on
+#---each side, the sun is moved to the middle of the band so the rows do not wrap around
+    shift = size_x // 2 - int(sun_x)
+    rgb = np.roll(rgb, shift, axis=1)
+    disc = np.roll(lobe, shift, axis=1) & (rgb.max(axis=-1) > level)
+    found = disc.any(axis=1)
+    first = np.argmax(disc, axis=1)
+    last = size_x - 1 - np.argmax(disc[:, ::-1], axis=1)
+    left = np.maximum(first - 1, 0)
+    right = np.minimum(last + 1, size_x - 1)
+    band_rows = np.arange(rgb.shape[0])
+    columns = np.arange(size_x)[None, :]
+    t = np.clip((columns - left[:, None]) / np.maximum(right - left, 1)[:, None], 0.0, 1.0)
+    fill = rgb[band_rows, left][:, None, :] * (1.0 - t[..., None]) + rgb[band_rows, right][:, None, :] * t[..., None]
+    inside = found[:, None] & (columns >= first[:, None]) & (columns <= last[:, None])
+    rgb[inside] = np.minimum(fill[inside], level)
+    
+    return np.roll(rgb, -shift, axis=1)
+
+#########################################################################################################
+
+#########################################################################################################
+def write_desunned(image, path, mode, source):
+    """Write the image without its sun in a Radiance HDR file, band by band from the top row"""
+    size_x, size_y, channels = source.layout()
+    x, y = analyze_image(image, source)["sun"]
+    level = float(get_sun_lobe(image, source)["clamp"])
+    sun_direction = [float(c) for c in pixel_to_direction(x, y, size_x, size_y)]
+    cos_radius = math.cos(math.radians(8.0))
+
+#---Only one band of the result is in memory, the file is written from the top row
+    band_rows = max(1, BAND_SIZE // (size_x * channels))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n-Y %d +X %d\n" % (size_y, size_x))
+        for end in range(size_y, 0, -band_rows):
+            start = max(0, end - band_rows)
+            pixels = source.band(start, end)
+            rgb = pixels[..., :3] if channels >= 3 else np.repeat(pixels[..., :1], 3, axis=-1)
+            band = desun_band(rgb, np.arange(start, end), size_y, x, sun_direction, cos_radius, level, mode)
+            f.write(rgbe(band[::-1]).tobytes())
+    os.replace(tmp_path, path)
+
+#########################################################################################################
+
+#########################################################################################################
+def get_desunned(image, mode):
+    """Return the image without its sun from the disk cache, the sun lamp carries its energy"""
+    source = VisionHDRPixels(image)
+    key = cache_key("desun", mode, image_key(image, source))
+    name = ("VisionHDR_DESUN_" + image.name)[:63]
+    desun = bpy.data.images.get(name)
+    if desun is not None and desun.get("visionhdr_key") == key and os.path.isfile(bpy.path.abspath(desun.filepath)):
+        return desun
+    
+    cache = get_cache()
+    path = cache.path(key, ".hdr")
+    if os.path.isfile(path):
+        cache.touch(path)
+    else:
+        write_desunned(image, path, mode, source)
+        cache.evict()
+
+    if desun is not None:
+        bpy.data.images.remove(desun, do_unlink=True)
+    desun = bpy.data.images.load(path)
+    desun.name = name
+    desun["visionhdr_key"] = key
+    
+    return desun
+
+#########################################################################################################
+
+#########################################################################################################
+HEATMAP_SIZE = 256
+HEATMAP_STOPS = (0.0, 0.25, 0.5, 0.75, 1.0)
+HEATMAP_COLORS = ((0.0, 0.0, 0.0), (0.35, 0.0, 0.55), (0.9, 0.15, 0.1), (1.0, 0.8, 0.0), (1.0, 1.0, 1.0))
+
+def block_sums(values, size_x, size_y):
+    """Sums of the values over the texels of a map of size_x by size_y"""
+    if values.shape[:2] == (size_y, size_x):
+        return values
+    rows = np.searchsorted((np.arange(values.shape[0]) * size_y) // values.shape[0], np.arange(size_y))
+    columns = np.searchsorted((np.arange(values.shape[1]) * size_x) // values.shape[1], np.arange(size_x))
+    return np.add.reduceat(np.add.reduceat(values, rows, axis=0), columns, axis=1)
+
+def importance_map(pixels, max_width=4096, min_efficiency=0.9):
+    """Luminance CDF of the equirectangular image as sampled by Cycles and the concentration of its energy"""
+    pixels = box_downsample(pixels, max_width)
+    size_y, size_x = pixels.shape[:2]
+    lum = luminance(pixels)
+    if lum.max() <= 0:
+        lum = np.ones_like(lum)
+    solid_angles = np.broadcast_to(equirect_solid_angles(size_x, size_y)[:, None].astype(np.float32), lum.shape)
+    radiance = lum * solid_angles
+
+#---Marginal CDF of the rows
+    rows = radiance.sum(axis=1, dtype=np.float64)
+    marginal = np.cumsum(rows) / rows.sum()
+
+#---Efficiency of the sampling of the radiance with a piecewise constant map of each resolution,
+#---relative to the map at the resolution of the analysis : sum(L dw) / sum(texel L^2 dw * texel dw / texel L dw)
+    squared = radiance * lum
+#---The maps are 2:1 : a panorama or a strip with less rows only gets the maps it can fill
+    resolutions = [r for r in (256, 512, 1024, 2048, 4096) if r <= min(size_x, 2 * size_y)]
+    efficiencies = []
+    if resolutions:
+        sums = [block_sums(values, resolutions[-1], resolutions[-1] // 2).astype(np.float64) for values in (radiance, squared, solid_angles)]
+        for r in reversed(resolutions):
+            if r != resolutions[-1]:
+                sums = [s[0::2, :] + s[1::2, :] for s in sums]
+                sums = [s[:, 0::2] + s[:, 1::2] for s in sums]
+            s1, s2, a = sums
+            efficiencies.insert(0, min(float(s1.sum() / np.sum(s2 * a / np.maximum(s1, 1e-30))), 1.0))
+    else:
+        resolutions, efficiencies = [256], [1.0]
+    resolution = next((r for r, e in zip(resolutions, efficiencies) if e >= min_efficiency), resolutions[-1])
+
+#---Solid angle of the brightest pixels holding half and 90% of the energy
+    lum = box_downsample(lum[..., None], 1024)[..., 0]
+    solid_angles = np.broadcast_to(equirect_solid_angles(lum.shape[1], lum.shape[0])[:, None], lum.shape)
+    order = np.argsort(lum, axis=None)[::-1]
+    energy = np.cumsum((lum * solid_angles).ravel()[order])
+    energy /= energy[-1]
+    area = np.cumsum(solid_angles.ravel()[order])
+    area_50 = float(area[min(np.searchsorted(energy, 0.5), area.size - 1)])
+    area_90 = float(area[min(np.searchsorted(energy, 0.9), area.size - 1)])
+    
+    return {
+        "marginal": marginal,
+        "area_50": np.array(area_50 / (4 * math.pi)),
+        "area_90": np.array(area_90 / (4 * math.pi)),
+        "resolutions": np.array(resolutions),
+        "efficiencies": np.array(efficiencies),
+        "resolution": np.array(resolution),
+        "heatmap": heatmap(box_downsample(lum[..., None], HEATMAP_SIZE)[..., 0]),
+        }
+
+#########################################################################################################
+
+#########################################################################################################
+def heatmap(values):
+    """Color ramp of the log of the values, as 8 bits RGBA pixels"""
+    values = np.log10(np.maximum(values, 1e-6))
+    low, high = np.percentile(values, 1), values.max()
+    values = np.clip((values - low) / max(high - low, 1e-6), 0.0, 1.0)
+    colors = [np.interp(values, HEATMAP_STOPS, [color[c] for color in HEATMAP_COLORS]) for c in range(3)]
+    pixels = np.stack(colors + [np.ones_like(values)], axis=-1)
+    return (pixels * 255).astype(np.uint8)
+
+#########################################################################################################
+
+#########################################################################################################
+_importance = {}
+_importance_previews = None
+_importance_items = []
+
+def get_importance(image):
+    """Return the importance map of the image from the memory or disk cache"""
+    source = VisionHDRPixels(image)
+    key = cache_key("importance", image_key(image, source))
+    importance = _importance.get(key)
+    if importance is not None:
+        return key, importance
+
+    cache = get_cache()
+    importance = cache.get(key)
+    if importance is None:
+        importance = importance_map(source.downsample(4096))
+        cache.put(key, importance)
+    _importance[key] = importance
+    
+    return key, importance
+
+def load_importance_preview(key, importance):
+    """Show the heat map of the importance map as an icon"""
+    global _importance_items
+
+    if _importance_previews is None:
+        return
+    if key not in _importance_previews:
+        path = get_cache().path(key, ".png")
+        if not os.path.isfile(path):
+            pixels = importance["heatmap"].astype(np.float32) / 255.0
+            image = bpy.data.images.new("VisionHDR_importance", pixels.shape[1], pixels.shape[0], alpha=True)
+            set_image_pixels(image, pixels)
+            image.filepath_raw = path
+            image.file_format = 'PNG'
+            image.save()
+            bpy.data.images.remove(image, do_unlink=True)
+        _importance_previews.load(key, path, 'IMAGE')
+    description = "Half of the energy in %.2f%% of the sphere" % (float(importance["area_50"]) * 100)
+    _importance_items = [(key, "Importance", description, _importance_previews[key].icon_id, 0)]
+
+def importance_items(self, context):
+    """Heat map of the importance map of the current image for the icon view"""
+    return _importance_items
+
+#########################################################################################################
+
+#########################################################################################################
+def apply_importance(cobj, context):
+    """Compute the importance map of the environment image and set the map resolution of the world"""
+    key, importance = get_importance(bpy.data.images[cobj.VisionHDR.hdri_name])
+    load_importance_preview(key, importance)
+    resolution = int(importance["resolution"])
+    if cobj.VisionHDR.importance_resolution != resolution:
+        cobj.VisionHDR.importance_resolution = resolution
+    if cobj.VisionHDR.importance_auto and context.scene.world.cycles.sample_map_resolution != resolution:
+        context.scene.world.cycles.sample_map_resolution = resolution
+
+def update_importance(self, context):
+    """Update the map resolution of the world with the environment image"""
+    cobj = get_object(context, self.lightname)
+    if cobj.VisionHDR.importance_auto and cobj.VisionHDR.hdri_name != "":
+        apply_importance(cobj, context)
+
+def update_hdri_name(self, context):
+    """Relink the new environment image"""
+    update_mat(self, context)
+    update_importance(self, context)
+    update_extract(self, context)
+    update_sun_calibrate(self, context)
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_DetectSun(bpy.types.Operator):
+    """Align the environment background with the brightest area of the image"""
+    
+    bl_idname = "object.detect_sun"
+    bl_description = "Find the sun in the image texture and compute the rotation.\n"+\
+                     "Use this to align the sun lamp with the brightest area of your image."
+    bl_label = "Auto-detect sun"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+    img_name = bpy.props.StringProperty()
+    img_type = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        image = bpy.data.images[self.img_name]
+        source = VisionHDRPixels(image)
+        size_x, size_y = source.layout()[:2]
+        if size_x == 0 or size_y == 0:
+            self.report({'WARNING'}, "No pixels found in the image " + image.name)
+            return {'CANCELLED'}
+        
+        x, y = analyze_image(image, source)["sun"]
+        align_to_pixel(obj_light, self.img_type, x, y, size_x, size_y)
+        
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_ProjectSH(bpy.types.Operator):
+    """Compute the spherical harmonics of the environment image"""
+    
+    bl_idname = "object.hdri_sh_project"
+    bl_description = "Project the environment image on 9 spherical harmonics coefficients.\n"+\
+                     "Use them for a cheap approximate lighting."
+    bl_label = "Spherical harmonics"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        image = bpy.data.images[obj_light.VisionHDR.hdri_name]
+        source = VisionHDRPixels(image)
+        if 0 in source.layout()[:2]:
+            self.report({'WARNING'}, "No pixels found in the image " + image.name)
+            return {'CANCELLED'}
+        
+        key = cache_key("sh", image_key(image, source))
+        cache = get_cache()
+        data = cache.get(key)
+        if data is None:
+            data = {"coeffs": sh_project(source.downsample(1024))}
+            cache.put(key, data)
+        
+        obj_light.VisionHDR.sh_coeffs = data["coeffs"].ravel().tolist()
+        if obj_light.VisionHDR.sh_lighting:
+            sh_image(obj_light)
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_Importance(bpy.types.Operator):
+    """Compute the importance map of the environment image"""
+    
+    bl_idname = "object.hdri_importance"
+    bl_description = "Measure how concentrated the energy of the environment image is.\n"+\
+                     "Recommend the map resolution needed to sample it without noise."
+    bl_label = "Importance map"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        image = bpy.data.images[obj_light.VisionHDR.hdri_name]
+        if 0 in VisionHDRPixels(image).layout()[:2]:
+            self.report({'WARNING'}, "No pixels found in the image " + image.name)
+            return {'CANCELLED'}
+        
+        apply_importance(obj_light, context)
+        self.report({'INFO'}, "Recommended map resolution : %d" % obj_light.VisionHDR.importance_resolution)
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_CalibrateSun(bpy.types.Operator):
+    """Set the strength and color of the sun from the environment image"""
+    
+    bl_idname = "object.calibrate_sun"
+    bl_description = "Integrate the radiance of the sun in the environment image.\n"+\
+                     "The strength and color of the sun lamp are computed from it."
+    bl_label = "Calibrate sun"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        if obj_light.VisionHDR.hdri_name == "" or not calibrate_sun(obj_light):
+            self.report({'WARNING'}, "No sun found in the environment image")
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_ExtractLights(bpy.types.Operator):
+    """Create one lamp per bright area of the environment image"""
+    
+    bl_idname = "object.extract_hdri_lights"
+    bl_description = "Find the brightest areas of the environment image.\n"+\
+                     "A sun or area lamp is created for each of them, the sun lamp is hidden from the render."
+    bl_label = "Extract lights"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        if obj_light.VisionHDR.hdri_name == "":
+            self.report({'WARNING'}, "No environment image")
+            return {'CANCELLED'}
+        
+        if obj_light.VisionHDR.light_mode != 'EXTRACT':
+            obj_light.VisionHDR.light_mode = 'EXTRACT'
+        else:
+            extract_lights(obj_light, context)
+        self.report({'INFO'}, "%d lamps extracted" % len(get_extracted(context, obj_light.VisionHDR.lightname)))
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_BakeTimeOfDay(bpy.types.Operator):
+    """Bake the rotation of the environment over the frames of the scene"""
+    
+    bl_idname = "object.bake_hdri_time"
+    bl_description = "Turn the environment image from the start to the end rotation over the frames of the scene.\n"+\
+                     "The images, the sun and the extracted lamps are keyed : no Python runs during playback or render."
+    bl_label = "Bake time of day"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        obj_light = bpy.data.objects[self.act_light]
+        frames = time_of_day_frames(obj_light, context.scene)
+        span = max(context.scene.frame_end - context.scene.frame_start, 1)
+        start, end = obj_light.VisionHDR.time_rotation_start, obj_light.VisionHDR.time_rotation_end
+        rotation = start + (end - start) * (frames - context.scene.frame_start) / span
+        bake_time_of_day(obj_light, context, frames, rotation, energy=obj_light.VisionHDR.sun_energy, color=obj_light.VisionHDR.lightcolor[:3])
+        self.report({'INFO'}, "%d frames baked" % len(frames))
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_ClearTimeOfDay(bpy.types.Operator):
+    """Remove the baked rotation of the environment"""
+    
+    bl_idname = "object.clear_hdri_time"
+    bl_label = "Clear time of day"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        clear_time_of_day(bpy.data.objects[self.act_light], context)
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_PlaceSun(bpy.types.Operator):
+    """Place the sun from the date, the hour and the place of the light"""
+    
+    bl_idname = "object.place_hdri_sun"
+    bl_description = "Turn the sun to its position in the sky at the date, hour and place of the light.\n"+\
+                     "With the rotation locked, the environment image turns so its sun stays under the lamp."
+    bl_label = "Place the sun"
     bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
 
     def execute(self, context):
-        create_light_env(self, context)
-
+        obj_light = bpy.data.objects[self.act_light]
+        if place_sun(obj_light, context) <= 0.0:
+            self.report({'WARNING'}, "The sun is below the horizon")
         return {'FINISHED'}
-        
+
 #########################################################################################################
 
 #########################################################################################################
-def reset_options(self, context):
-    """Reset the options for HDRI or reflection maps"""
-    
-    for ob in bpy.data.objects:
-        if ob.data.name == self.lightname:
-            cobj = ob
+class VISIONHDR_OT_BakeSunPosition(bpy.types.Operator):
+    """Bake the path of the sun over the frames of the scene"""
     
-#---Environment Light
-    world = context.scene.world
-    hdri_bright = world.node_tree.nodes['Bright/Contrast']
-    hdri_gamma = world.node_tree.nodes['Gamma']
-    hdri_hue = world.node_tree.nodes['Hue Saturation Value']
-    img_bright = world.node_tree.nodes['Bright/Contrast.001']
-    img_gamma = world.node_tree.nodes['Gamma.001']
-    img_hue = world.node_tree.nodes['Hue Saturation Value.001']             
-    
-    
-    if cobj.VisionHDR.hdri_reset:
-        cobj.VisionHDR.hdri_bright = hdri_bright.inputs['Bright'].default_value = 0
-        cobj.VisionHDR.hdri_contrast = hdri_bright.inputs['Contrast'].default_value = 0
-        cobj.VisionHDR.hdri_gamma = hdri_gamma.inputs['Gamma'].default_value = 1
-        cobj.VisionHDR.hdri_hue = hdri_hue.inputs['Hue'].default_value = 0.5
-        cobj.VisionHDR.hdri_saturation = hdri_hue.inputs['Saturation'].default_value = 1
-        cobj.VisionHDR.hdri_value = hdri_hue.inputs['Value'].default_value = 1
-        
-    if cobj.VisionHDR.img_reset:
-        cobj.VisionHDR.img_bright = img_bright.inputs['Bright'].default_value = 0
-        cobj.VisionHDR.img_contrast = img_bright.inputs['Contrast'].default_value = 0
-        cobj.VisionHDR.img_gamma = img_gamma.inputs['Gamma'].default_value = 1
-        cobj.VisionHDR.img_hue = img_hue.inputs['Hue'].default_value = 0.5
-        cobj.VisionHDR.img_saturation = img_hue.inputs['Saturation'].default_value = 1
-        cobj.VisionHDR.img_value = img_hue.inputs['Value'].default_value = 1
+    bl_idname = "object.bake_hdri_sun_position"
+    bl_description = "Move the sun from the start to the end hour of the day over the frames of the scene.\n"+\
+                     "The sun, its energy through the atmosphere and the locked images are keyed."
+    bl_label = "Bake the day"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+
+    def execute(self, context):
+        frames = bake_sun_position(bpy.data.objects[self.act_light], context)
+        self.report({'INFO'}, "%d frames baked" % len(frames))
+        return {'FINISHED'}
 
 #########################################################################################################
 
 #########################################################################################################
-def update_rotation_hdri(self, context):
-    """Update the rotation of the environment image texture"""
-    
-    cobj = get_object(context, self.lightname)
-    world = context.scene.world
-    mapping = world.node_tree.nodes['Mapping']
-    mapping2 = world.node_tree.nodes['Mapping.001']
+class VISIONHDR_OT_ExportTrace(bpy.types.Operator):
+    """Export the timings of the profiler"""
     
-    if cobj.VisionHDR.rotation_lock_hdri:
-        mapping2.rotation[2] -= (mapping.rotation[2] + math.radians(cobj.VisionHDR.hdri_rotation))
+    bl_idname = "scene.export_hdri_trace"
+    bl_label = "Export the trace"
+    bl_description = "Write the timings of the profiler in the Chrome trace format.\n"+\
+                     "Open the file in chrome://tracing"
+    filepath = bpy.props.StringProperty(subtype='FILE_PATH', default="visionhdr_trace.json")
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        _profiler.export(bpy.path.abspath(self.filepath))
+        self.report({'INFO'}, "%d events written in %s" % (len(_profiler.trace), self.filepath))
+        return {'FINISHED'}
 
-    mapping.rotation[2] = -math.radians(cobj.VisionHDR.hdri_rotation)
-    
-#---Lock the rotation of the sun on the selected pixel
-    if cobj.VisionHDR.rotation_lock_sun:
-        cobj.rotation_euler.z = math.radians(cobj.VisionHDR.hdri_rotation - cobj.VisionHDR.hdri_pix_rot)
 #########################################################################################################
 
 #########################################################################################################
-def update_rotation_hdri_lock(self, context):
-    """Lock / Unlock the rotation of the environment image texture"""
-    
-    cobj = get_object(context, self.lightname)
-    world = context.scene.world
-    mapping = world.node_tree.nodes['Mapping']
-    mapping2 = world.node_tree.nodes['Mapping.001']
+class VISIONHDR_OT_ClearCache(bpy.types.Operator):
+    """Remove all the image analysis stored on disk"""
     
-    if cobj.VisionHDR.rotation_lock_hdri == False:
-        if round(-math.degrees(mapping2.rotation[2]), 2) != round(cobj.VisionHDR.img_rotation, 2) :
-            cobj.VisionHDR.img_rotation = -math.degrees(mapping2.rotation[2])
+    bl_idname = "scene.clear_hdri_cache"
+    bl_label = "Clear the cache of the image analysis"
+
+    def execute(self, context):
+        get_cache().clear()
+        return {'FINISHED'}
 
 #########################################################################################################
 
 #########################################################################################################
-def update_rotation_img(self, context):
-    """Update the rotation of the background image texture"""
+LIBRARY_EXTENSIONS = (".hdr", ".exr")
+THUMBNAIL_SIZE = 256
+
+class VisionHDRLibrary():
+    """Persistent index of the HDRI files found in the library directories"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (IOError, OSError, ValueError) as error:
+                print("(VisionHDR) Unable to read the library index : ", error)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def scan(self, directories):
+        """Update the index from the files on disk and return the files without thumbnail"""
+        found = {}
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    if name.lower().endswith(LIBRARY_EXTENSIONS):
+                        filepath = os.path.normcase(os.path.abspath(os.path.join(root, name)))
+                        stat = os.stat(filepath)
+                        found[filepath] = (stat.st_size, stat.st_mtime)
+
+        todo = []
+        for filepath, (size, mtime) in sorted(found.items()):
+            entry = self.entries.get(filepath)
+            if entry is None or entry["size"] != size or entry["mtime"] != mtime or not os.path.isfile(entry["thumbnail"]):
+                self.entries[filepath] = {"size": size, "mtime": mtime, "resolution": [0, 0], "thumbnail": ""}
+                todo.append(filepath)
+
+    #---Forget the files removed from the library
+        for filepath in set(self.entries) - set(found):
+            del self.entries[filepath]
+
+        return todo
+
+    def update(self, results):
+        """Store the thumbnails generated by the workers"""
+        for result in results:
+            entry = self.entries.get(result["filepath"])
+            if entry is None:
+                continue
+            if "error" in result:
+                print("(VisionHDR) Unable to read %s : %s" % (result["filepath"], result["error"]))
+                continue
+            entry["resolution"] = result["resolution"]
+            entry["thumbnail"] = result["thumbnail"]
 
-    cobj = get_object(context, self.lightname)
-    world = context.scene.world
-    mapping = world.node_tree.nodes['Mapping']
-    mapping2 = world.node_tree.nodes['Mapping.001']
-    if cobj.VisionHDR.rotation_lock_img:
-        mapping.rotation[2] -= (mapping2.rotation[2] + math.radians(cobj.VisionHDR.img_rotation))
-    mapping2.rotation[2] = -math.radians(cobj.VisionHDR.img_rotation)
-    
-#---Lock the rotation of the sun on the selected pixel
-    if cobj.VisionHDR.rotation_lock_sun:
-        cobj.rotation_euler.z = math.radians(cobj.VisionHDR.img_rotation - cobj.VisionHDR.img_pix_rot)
 #########################################################################################################
 
 #########################################################################################################
-def update_rotation_img_lock(self, context):
-    """Lock / Unlock the rotatin of the background image texture"""
+def config_directory(*names):
+    """Return a directory beside the user configuration of the addon"""
+    directory = os.path.join(bpy.utils.user_resource('CONFIG', "VisionHDR", create=True), *names)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+#########################################################################################################
+
+#########################################################################################################
+_library = None
+
+def get_library():
+    """Return the index of the library, read on the first use"""
+    global _library
     
-    cobj = get_object(context, self.lightname)
-    world = context.scene.world
-    mapping = world.node_tree.nodes['Mapping']
-    mapping2 = world.node_tree.nodes['Mapping.001']
+    if _library is None:
+        _library = VisionHDRLibrary(os.path.join(config_directory(), "library.json"))
+    return _library
+
+#########################################################################################################
+
+#########################################################################################################
+_library_previews = None
+_library_items = []
+
+def load_library_previews():
+    """Load the thumbnails of the library as icons"""
+    global _library_items
     
-    if cobj.VisionHDR.rotation_lock_img == False:
-        if round(-math.degrees(mapping.rotation[2]), 2) != round(cobj.VisionHDR.hdri_rotation, 2) :
-            cobj.VisionHDR.hdri_rotation = -math.degrees(mapping.rotation[2])
+    if _library_previews is None:
+        return
+    items = []
+    for i, (filepath, entry) in enumerate(sorted(get_library().entries.items())):
+        if entry["thumbnail"] == "":
+            continue
+        if filepath not in _library_previews:
+            _library_previews.load(filepath, entry["thumbnail"], 'IMAGE')
+        description = "%s\n%d x %d" % (filepath, entry["resolution"][0], entry["resolution"][1])
+        items.append((filepath, os.path.basename(filepath), description, _library_previews[filepath].icon_id, i))
+    _library_items = items
+
+def library_items(self, context):
+    """Items of the library for the icon view"""
+    return _library_items
 
 #########################################################################################################
 
 #########################################################################################################
-def update_lamp(self, context):
-    """Update the material nodes of the blender lights"""
-    cobj = get_object(context, "VisionHDR_LAMP")
-    mat = bpy.data.lamps["VisionHDR_LAMP"]
-    emit = mat.node_tree.nodes["Emission"]
-    emit.inputs[0].default_value = cobj.VisionHDR.lightcolor
-    emit.inputs[1].default_value = cobj.VisionHDR.sun_energy
+def tonemap(pixels, exposure=0.0):
+    """Reinhard tonemapping of linear pixels to display values"""
+    rgb = pixels[..., :3] * (2.0 ** exposure)
+    rgb = rgb / (1.0 + luminance(rgb))[..., None]
+    rgb = np.clip(rgb, 0.0, 1.0) ** (1.0 / 2.2)
+    return np.concatenate((rgb, np.ones(rgb.shape[:2] + (1,), dtype=rgb.dtype)), axis=-1)
 
 #########################################################################################################
 
 #########################################################################################################
-def update_mat(self, context):
-    """Update the material nodes of the lights"""
+WORKER_RESULT = "VISIONHDR_RESULT "
+
+def run_worker(arguments, blend_file=None):
+    """Run a background Blender on this file and return the results printed by the worker"""
+    command = [bpy.app.binary_path, "-b"]
+    command += [blend_file] if blend_file else ["--factory-startup"]
+    command += ["--python", os.path.abspath(__file__), "--"] + arguments
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
     
-#---Get the duplivert
-    cobj = get_object(context, self.lightname)
+    return [json.loads(line[len(WORKER_RESULT):]) for line in process.stdout.splitlines() if line.startswith(WORKER_RESULT)]
 
-    if cobj.type != 'EMPTY' and cobj.data.name.startswith("VisionHDR"):
+#########################################################################################################
 
-        if cobj.VisionHDR.hdri_reset == False and cobj.VisionHDR.img_reset == False:
-        #---Environment Light
-            world = context.scene.world
-            env_output = world.node_tree.nodes['World Output']
-            env_mix = world.node_tree.nodes['Mix Shader']
-            hdr_text = world.node_tree.nodes['Environment Texture']
-            hdri_bright = world.node_tree.nodes['Bright/Contrast']
-            hdri_gamma = world.node_tree.nodes['Gamma']
-            hdri_hue = world.node_tree.nodes['Hue Saturation Value']
-            img_text = world.node_tree.nodes['Environment Texture.001']
-            img_bright = world.node_tree.nodes['Bright/Contrast.001']
-            img_gamma = world.node_tree.nodes['Gamma.001']
-            img_hue = world.node_tree.nodes['Hue Saturation Value.001']             
-            background1 = world.node_tree.nodes['VisionHDR_Background1']
-            background2 = world.node_tree.nodes['VisionHDR_Background2']
-            lightpath = world.node_tree.nodes['Light Path']
-            math_path = world.node_tree.nodes['Math']
-            mix = world.node_tree.nodes['Mix Shader']
-            mapping = world.node_tree.nodes['Mapping']
-            mapping2 = world.node_tree.nodes['Mapping.001']
-                
-            if cobj.VisionHDR.hdri_name != "":  
-                hdr_text.image = bpy.data.images[cobj.VisionHDR.hdri_name]
-                world.node_tree.links.new(hdr_text.outputs[0], hdri_bright.inputs[0])
-                world.node_tree.links.new(hdri_hue.outputs[0], background1.inputs[0])
-                world.node_tree.links.new(lightpath.outputs[0], math_path.inputs[0])
-                world.node_tree.links.new(lightpath.outputs[3], math_path.inputs[1])
-                world.node_tree.links.new(math_path.outputs[0], mix.inputs[0])
-                hdri_bright.inputs['Bright'].default_value = cobj.VisionHDR.hdri_bright
-                hdri_bright.inputs['Contrast'].default_value = cobj.VisionHDR.hdri_contrast
-                hdri_gamma.inputs['Gamma'].default_value = cobj.VisionHDR.hdri_gamma
-                hdri_hue.inputs['Hue'].default_value = cobj.VisionHDR.hdri_hue
-                hdri_hue.inputs['Saturation'].default_value = cobj.VisionHDR.hdri_saturation
-                hdri_hue.inputs['Value'].default_value = cobj.VisionHDR.hdri_value
-            else:
-            #--- Remove image HDRI links
-                cobj.VisionHDR.rotation_lock_img = False
-                for i in range(len(hdri_hue.outputs['Color'].links)):
-                    world.node_tree.links.remove(hdri_hue.outputs['Color'].links[i-1])
+#########################################################################################################
+def worker_thumbnails(output_dir, size, *filepaths):
+    """Worker : write a tonemapped thumbnail of each image"""
+    size = int(size)
+    for filepath in filepaths:
+        result = {"filepath": filepath}
+        try:
+            image = bpy.data.images.load(filepath)
+            source = VisionHDRPixels(image)
+            result["resolution"] = list(source.layout()[:2])
+            pixels = source.downsample(size)
+            thumbnail = bpy.data.images.new("VisionHDR_thumbnail", pixels.shape[1], pixels.shape[0], alpha=True)
+            set_image_pixels(thumbnail, tonemap(pixels))
+            thumbnail.filepath_raw = os.path.join(output_dir, hashlib.sha1(filepath.encode("utf-8")).hexdigest() + ".png")
+            thumbnail.file_format = 'PNG'
+            thumbnail.save()
+            result["thumbnail"] = thumbnail.filepath_raw
+            bpy.data.images.remove(image, do_unlink=True)
+            bpy.data.images.remove(thumbnail, do_unlink=True)
+        except (RuntimeError, ValueError) as error:
+            result["error"] = str(error)
+        print(WORKER_RESULT + json.dumps(result))
+
+#########################################################################################################
+
+#########################################################################################################
+def worker_proxy(resolution, cache_size, filepath):
+    """Worker : write the proxy of the image in the cache"""
+    get_cache().max_size = int(cache_size) * 1024 * 1024
+    result = {"filepath": filepath}
+    try:
+        get_proxy(bpy.data.images.load(filepath), int(resolution))
+    except (RuntimeError, ValueError) as error:
+        result["error"] = str(error)
+    print(WORKER_RESULT + json.dumps(result))
+
+#########################################################################################################
+
+#########################################################################################################
+def read_manifest(filepath):
+    """Return the jobs of a batch manifest : a JSON sweep or job list, or a CSV with one job per row"""
+    if filepath.lower().endswith(".csv"):
+        with open(filepath, newline='') as f:
+            rows = [{k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()} for row in csv.DictReader(f)]
+        settings = {}
+    else:
+        with open(filepath) as f:
+            manifest = json.load(f)
+        settings = manifest.get("settings", {})
+        rows = manifest.get("jobs")
+        if rows is None:
+        #---Sweep : every combination of the images, rotations and exposures
+            sun = manifest.get("sun", {})
+            rows = [dict(sun, hdri=hdri, rotation=rotation, exposure=exposure)
+                    for hdri in manifest["hdris"]
+                    for rotation in manifest.get("rotations", [0])
+                    for exposure in manifest.get("exposures", [0])]
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    jobs = []
+    for i, row in enumerate(rows):
+        job = {
+            "index": i,
+            "hdri": os.path.normcase(os.path.abspath(os.path.join(directory, row["hdri"]))),
+            "rotation": float(row.get("rotation", 0)),
+            "exposure": float(row.get("exposure", 0)),
+            "sun_energy": float(row["sun_energy"]) if "sun_energy" in row else None,
+            "sun_calibrate": str(row.get("sun_calibrate", False)).lower() in ("1", "true", "yes"),
+            "sun_detect": str(row.get("sun_detect", True)).lower() in ("1", "true", "yes"),
+            }
+        jobs.append(job)
         
-        #---HDRI for background         
-            if cobj.VisionHDR.hdri_background:
-                world.node_tree.links.new(background1.outputs[0], env_output.inputs[0])
+    return jobs, settings
 
-            else:
-                world.node_tree.links.new(env_mix.outputs[0], env_output.inputs[0])
-
-        #---Image Background 
-            if cobj.VisionHDR.img_name != "" and not cobj.VisionHDR.hdri_background: 
-                img_text.image = bpy.data.images[cobj.VisionHDR.img_name]
-                world.node_tree.links.new(img_text.outputs[0], background2.inputs[0])
-                world.node_tree.links.new(lightpath.outputs[0], math_path.inputs[0])
-                world.node_tree.links.new(lightpath.outputs[3], math_path.inputs[1])
-                if cobj.VisionHDR.back_reflect:
-                    math_path.operation = 'ADD'
-                else:
-                    math_path.operation = 'SUBTRACT'
-                world.node_tree.links.new(math_path.outputs[0], mix.inputs[0])
-                world.node_tree.links.new(img_text.outputs[0], img_bright.inputs[0])
-                world.node_tree.links.new(img_hue.outputs[0], background2.inputs[0])
-                img_bright.inputs['Bright'].default_value = cobj.VisionHDR.img_bright
-                img_bright.inputs['Contrast'].default_value = cobj.VisionHDR.img_contrast
-                img_gamma.inputs['Gamma'].default_value = cobj.VisionHDR.img_gamma
-                img_hue.inputs['Hue'].default_value = cobj.VisionHDR.img_hue
-                img_hue.inputs['Saturation'].default_value = cobj.VisionHDR.img_saturation
-                img_hue.inputs['Value'].default_value = cobj.VisionHDR.img_value                    
-            else:
-            #--- Remove image background links
-                cobj.VisionHDR.rotation_lock_hdri = False
-                for i in range(len(img_hue.outputs['Color'].links)):
-                    world.node_tree.links.remove(img_hue.outputs['Color'].links[i-1])                       
-            
-            #---Color background for reflection
-                if cobj.VisionHDR.back_reflect:
-                    math_path.operation = 'ADD'
-                else:
-                    math_path.operation = 'SUBTRACT'
+#########################################################################################################
 
-        else:
-            if cobj.VisionHDR.hdri_reset: 
-                cobj.VisionHDR.hdri_reset = False
-            if cobj.VisionHDR.img_reset: 
-                cobj.VisionHDR.img_reset = False                        
+#########################################################################################################
+def batch_split(jobs, pool_size):
+    """Split the jobs between the workers, the jobs of an image stay on the same worker"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job["hdri"], []).append(job)
+
+#---Largest groups first, each on the worker with the fewest jobs
+    workers = [[] for i in range(max(1, min(pool_size, len(groups))))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(workers, key=len).extend(group)
+        
+    return [worker for worker in workers if worker]
 
 #########################################################################################################
 
 #########################################################################################################
-def get_object(context, lightname):
-    """Return the object with this name"""
+def worker_batch(manifest, output_dir, pool_size="1"):
+    """Command line : render every job of the manifest with a pool of background Blender processes"""
+    start = time.perf_counter()
+    jobs, settings = read_manifest(manifest)
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    
+#---The workers open the same scene as the batch, or the factory scene
+    blend_file = bpy.data.filepath or None
+    arguments = []
+    for i, worker_jobs in enumerate(batch_split(jobs, int(pool_size))):
+        jobs_file = os.path.join(output_dir, ".visionhdr_jobs_%d.json" % i)
+        with open(jobs_file, 'w') as f:
+            json.dump({"settings": settings, "jobs": worker_jobs}, f)
+        arguments.append(["batch_render", jobs_file, output_dir])
+
+    with ThreadPoolExecutor(max_workers=max(1, len(arguments))) as executor:
+        results = [result for worker_results in executor.map(lambda a: run_worker(a, blend_file), arguments) for result in worker_results]
+    for worker_arguments in arguments:
+        os.remove(worker_arguments[1])
+
+#---Timing report
+    results.sort(key=lambda result: result["index"])
+    rendered = [result for result in results if "error" not in result]
+    report = {
+        "manifest": os.path.abspath(manifest),
+        "pool_size": len(arguments),
+        "jobs": len(jobs),
+        "rendered": len(rendered),
+        "failed": len(jobs) - len(rendered),
+        "wall_time": time.perf_counter() - start,
+        "setup_time": sum(result["setup_time"] for result in rendered),
+        "render_time": sum(result["render_time"] for result in rendered),
+        "results": results,
+        }
+    with open(os.path.join(output_dir, "report.json"), 'w') as f:
+        json.dump(report, f, indent=1)
+    print("(VisionHDR) %(rendered)d / %(jobs)d jobs rendered in %(wall_time).1f s with %(pool_size)d workers" % report)
 
-    for ob in context.scene.objects:
-        if ob.type != 'EMPTY' and ob.VisionHDR.lightname == lightname:
-            cobj = ob
+#########################################################################################################
 
-    return(cobj)
+#########################################################################################################
+def worker_batch_render(jobs_file, output_dir):
+    """Worker : render the jobs with the VisionHDR world, the images are loaded once for their jobs"""
+    with open(jobs_file) as f:
+        batch = json.load(f)
+    register()
+    context = bpy.context
+    scene = context.scene
+    scene.render.engine = 'CYCLES'
+    settings = batch["settings"]
+    if "resolution" in settings:
+        scene.render.resolution_x, scene.render.resolution_y = settings["resolution"]
+        scene.render.resolution_percentage = 100
+    if "samples" in settings:
+        scene.cycles.samples = settings["samples"]
+    scene.render.image_settings.file_format = settings.get("file_format", 'PNG')
+
+#---Draft renders with the proxies of the cache, shared by the workers and the next batches
+    proxy = int(settings.get("proxy", 0))
+    if proxy:
+        bpy.app.handlers.render_pre.remove(proxy_render_pre)
+
+    cobj = bpy.data.objects.get("VisionHDR_LAMP")
+    if cobj is None or find_world(context) is None:
+        cobj = create_light_env(None, context)
+    scene.world = local_world(find_world(context))
+    
+    for job in batch["jobs"]:
+        result = {"index": job["index"], "hdri": job["hdri"], "rotation": job["rotation"], "exposure": job["exposure"]}
+        start = time.perf_counter()
+        try:
+        #---Jobs are grouped by image : the image and its analysis are reused
+            image = None
+            for img in bpy.data.images:
+                if img.source == 'FILE' and image_filepath(img) == job["hdri"]:
+                    image = img
+                    break
+            if image is None:
+                image = bpy.data.images.load(job["hdri"])
+            if cobj.VisionHDR.hdri_name != image.name:
+                cobj.VisionHDR.hdri_name = image.name
+                if job["sun_detect"]:
+                    analysis = analyze_image(image)
+                    x, y = analysis["sun"]
+                    size_x, size_y = analysis["size"]
+                    cobj.VisionHDR.rotation_lock_sun = False
+                    cobj.rotation_euler = (math.pi * (1.0 - (y + 0.5) / size_y), 0, 0)
+                    align_to_pixel(cobj, "HDRI", x, y, size_x, size_y)
+                    cobj.VisionHDR.rotation_lock_sun = True
+                if proxy:
+                    get_world_graph(scene.world)["hdri_text"].image = get_proxy(image, proxy)
+
+            cobj.VisionHDR.sun_calibrate = job["sun_calibrate"]
+            cobj.VisionHDR.hdri_rotation = job["rotation"]
+            if job["sun_energy"] is not None:
+                cobj.VisionHDR.sun_energy = job["sun_energy"]
+            scene.view_settings.exposure = job["exposure"]
+            
+            result["setup_time"] = time.perf_counter() - start
+            start = time.perf_counter()
+            name = "%04d_%s_r%g_e%g" % (job["index"], os.path.splitext(os.path.basename(job["hdri"]))[0], job["rotation"], job["exposure"])
+            scene.render.filepath = os.path.join(output_dir, name)
+            bpy.ops.render.render(write_still=True)
+            result["render_time"] = time.perf_counter() - start
+            result["output"] = scene.render.filepath + scene.render.file_extension
+        except (RuntimeError, ValueError, KeyError) as error:
+            result["error"] = str(error)
+        print(WORKER_RESULT + json.dumps(result))
 
 #########################################################################################################
 
 #########################################################################################################
-def get_lamp(context, lightname):
-    """Return the lamp with this name"""
+class VISIONHDR_OT_LibraryScan(bpy.types.Operator):
+    """Scan the library directories and generate the missing thumbnails in the background"""
     
-    cobj = get_object(context, lightname)
-    for ob in context.scene.objects:
-        if ob.type != 'EMPTY' and ob.data.name == "WORLD_" + cobj.data.name :
-            cobj = ob
-    return(cobj)
+    bl_idname = "scene.hdri_library_scan"
+    bl_label = "Scan the HDRI library"
+    bl_description = "Index the HDRI files of the library directories.\n"+\
+                     "Only the new or modified files are read again"
+    chunk_size = 4
+
+    def invoke(self, context, event):
+        prefs = get_preferences()
+        directories = [d for d in prefs.library_paths.split(";") if os.path.isdir(bpy.path.abspath(d))] if prefs else []
+        if not directories:
+            self.report({'WARNING'}, "No library directory found in the preferences")
+            return {'CANCELLED'}
+
+        self.library = get_library()
+        todo = self.library.scan([bpy.path.abspath(d) for d in directories])
+        output_dir = config_directory("thumbnails")
+
+    #---Decode the images in background Blender processes, off the UI
+        self.executor = ThreadPoolExecutor(max_workers=prefs.worker_count)
+        self.futures = [self.executor.submit(run_worker, ["thumbnails", output_dir, str(THUMBNAIL_SIZE)] + todo[i:i + self.chunk_size])
+                        for i in range(0, len(todo), self.chunk_size)]
+        if not self.futures:
+            return self.finish(context)
+        
+        self.report({'INFO'}, "Reading %d images" % len(todo))
+        self._timer = context.window_manager.event_timer_add(0.25, context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            for future in self.futures:
+                future.cancel()
+            self.futures = []
+        elif event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        done = [future for future in self.futures if future.done()]
+        for future in done:
+            self.futures.remove(future)
+            try:
+                self.library.update(future.result())
+            except Exception as error:
+                print("(VisionHDR) Library worker error : ", error)
+        if done:
+            load_library_previews()
+            for area in context.screen.areas:
+                area.tag_redraw()
+
+        if not self.futures:
+            context.window_manager.event_timer_remove(self._timer)
+            return self.finish(context)
+        return {'PASS_THROUGH'}
+
+    def finish(self, context):
+        self.executor.shutdown(wait=False)
+        self.library.save()
+        load_library_previews()
+        return {'FINISHED'}
+
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_LibraryAssign(bpy.types.Operator):
+    """Use the selected image of the library for the light"""
+    
+    bl_idname = "object.hdri_library_assign"
+    bl_label = "Use the image of the library"
+    bl_options = {'REGISTER', 'UNDO'}
+    act_light = bpy.props.StringProperty()
+    img_type = bpy.props.StringProperty()
+
+    def invoke(self, context, event):
+        filepath = context.window_manager.visionhdr_library
+        prefs = get_preferences()
+        if filepath == "" or prefs is None or prefs.proxy_resolution == 'NONE':
+            return self.execute(context)
+        if os.path.isfile(get_cache().path(cache_key("proxy", prefs.proxy_resolution, file_key(filepath)), ".exr")):
+            return self.execute(context)
+
+    #---Prepare the proxy in a background Blender process before using the image
+        self.report({'INFO'}, "Preparing the proxy of " + os.path.basename(filepath))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = self.executor.submit(run_worker, ["proxy", prefs.proxy_resolution, str(prefs.cache_size), filepath])
+        self._timer = context.window_manager.event_timer_add(0.25, context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type != 'TIMER' or not self.future.done():
+            return {'PASS_THROUGH'}
+        context.window_manager.event_timer_remove(self._timer)
+        self.executor.shutdown(wait=False)
+        return self.execute(context)
+
+    def execute(self, context):
+        filepath = context.window_manager.visionhdr_library
+        if filepath == "":
+            return {'CANCELLED'}
+        
+    #---Reuse the image if already loaded : the pixels are only read when used
+        image = None
+        for img in bpy.data.images:
+            if img.source == 'FILE' and image_filepath(img) == filepath:
+                image = img
+                break
+        if image is None:
+            image = bpy.data.images.load(filepath)
 
+        obj_light = bpy.data.objects[self.act_light]
+        if self.img_type == "HDRI":
+            obj_light.VisionHDR.hdri_name = image.name
+        else:
+            obj_light.VisionHDR.img_name = image.name
+        return {'FINISHED'}
 
 #########################################################################################################
 
@@ -947,6 +3972,7 @@ class VISIONHDR_OT_SelectPixel(bpy.types.Operator):
             bpy.types.SpaceImageEditor.draw_handler_remove(self._handle, 'WINDOW')
         self._handle = None
 
+    @profiled("check_region")
     def check_region(self,context,event):
         if context.area != None:
             for region in self.visionHDR_area.regions:
@@ -995,25 +4021,15 @@ class VISIONHDR_OT_SelectPixel(bpy.types.Operator):
                             uv = region.view2d.region_to_view(mouse_x, mouse_y)
                         #--- Source : https://blenderartists.org/forum/showthread.php?292866-Pick-the-color-of-a-pixel-in-the-Image-Editor
                             if not math.isnan(uv[0]): 
-                                x = int(self.img_size_x * uv[0]) % self.img_size_x
-                                y = int(self.img_size_y * uv[1]) % self.img_size_y
-                                self.mouse_path = (x,y)
+                                x, y = uv_to_pixel(uv[0] % 1.0, uv[1] % 1.0, self.img_size_x, self.img_size_y)
+                                self.mouse_path = (float(x), float(y))
 
                 elif event.type == 'LEFTMOUSE':
                     return{'PASS_THROUGH'}  
 
                 elif event.type == 'RIGHTMOUSE':
                     obj_light = bpy.data.objects[self.act_light]
-                    rot_x = ((self.mouse_path[0] * 360) / self.img_size_x) - 90
-                    rot_y = ((self.mouse_path[1] * 180) / self.img_size_y)
-                    if self.img_type == "HDRI":
-                        obj_light.VisionHDR.hdri_rotation = rot_x - 180 + math.degrees(obj_light.rotation_euler.z)
-                        obj_light.VisionHDR.hdri_rotationy = rot_y - 180
-                        obj_light.VisionHDR.hdri_pix_rot = rot_x - 180
-                        obj_light.VisionHDR.hdri_pix_roty = rot_y - 180
-                    else:
-                        obj_light.VisionHDR.img_rotation = rot_x - 180 + math.degrees(obj_light.rotation_euler.z)
-                        obj_light.VisionHDR.img_pix_rot = rot_x - 180               
+                    align_to_pixel(obj_light, self.img_type, self.mouse_path[0], self.mouse_path[1], self.img_size_x, self.img_size_y, self.projection)
 
                     bpy.context.window.cursor_modal_set("DEFAULT")
                     self.remove_handler()
@@ -1046,6 +4062,7 @@ class VISIONHDR_OT_SelectPixel(bpy.types.Operator):
 
     def invoke(self, context, event):
         self.mouse_path = [0,0]
+        self.projection = get_world_graph(context.scene.world)["hdri_text" if self.img_type == "HDRI" else "img_text"].projection
         if context.space_data.type == 'VIEW_3D':
             context.area.type = 'IMAGE_EDITOR'
             t_panel = context.area.regions[2]
@@ -1073,7 +4090,11 @@ class VISIONHDR_OT_ActiveWorld(bpy.types.Operator):
     bl_label = "Active VisionHDR world"
 
     def execute(self, context):
-        bpy.context.scene.world = bpy.data.worlds['VisionHDR_world']
+        world = find_world(context)
+        if world is None:
+            self.report({'WARNING'}, "No VisionHDR world found")
+            return {'CANCELLED'}
+        context.scene.world = local_world(world)
         return {'FINISHED'}
 #########################################################################################################
 
@@ -1089,6 +4110,55 @@ class VISIONHDR_OT_ActiveLamp(bpy.types.Operator):
         bpy.context.scene.objects.link(light_obj)
         return {'FINISHED'}
 
+#########################################################################################################
+
+#########################################################################################################
+class VISIONHDR_OT_ApplyRig(bpy.types.Operator):
+    """Use the world and the lights of this scene in other scenes"""
+    
+    bl_idname = "scene.apply_hdri_rig"
+    bl_label = "Apply to scenes"
+    bl_description = "Share the VisionHDR world and lights of this scene with other scenes.\n"+\
+                     "The world, lights and images are linked, not copied : the rotation and exposure are overridden per scene."
+    bl_options = {'REGISTER', 'UNDO'}
+    pattern = bpy.props.StringProperty(
+            name="Scenes",
+            description="Names of the scenes, with * and ? wildcards",
+            default="*")
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        world = find_world(context)
+        if world is None:
+            self.report({'WARNING'}, "No VisionHDR world found")
+            return {'CANCELLED'}
+        world = local_world(world)
+
+    #---The main lights and the lamps extracted for them
+        rig = []
+        for obj in get_lights(context.scene):
+            rig.append(obj)
+            rig.extend(get_extracted(context, obj.VisionHDR.lightname))
+        
+        count = 0
+        for scene in bpy.data.scenes:
+            if scene == context.scene or scene.library is not None or not fnmatch.fnmatchcase(scene.name, self.pattern):
+                continue
+            if scene.world != world:
+                scene.world = world
+            for obj in rig:
+                if scene.objects.get(obj.name) is None:
+                    scene.objects.link(obj)
+            _indexes.pop(scene.name, None)
+            count += 1
+        
+        if context.scene.world != world:
+            context.scene.world = world
+        self.report({'INFO'}, "VisionHDR rig applied to %d scenes" % count)
+        return {'FINISHED'}
+
 
 #########################################################################################################
 
@@ -1127,7 +4197,190 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                            precision=3,
                            subtype='NONE',
                            unit='NONE',
-                           update=update_mat)
+                           update=queue_update_mat)
+
+#---Compute the strength and color of the sun from the environment image
+    sun_calibrate = BoolProperty(
+                                 name="Auto calibrate",
+                                 description="Compute the strength and color of the sun from the sun of the environment image.\n"+
+                                 "Updated when the image changes : the sun lobe does not depend on the rotation.",
+                                 default=False,
+                                 update=update_sun_calibrate)
+
+#---Clamp the sun out of the environment image
+    sun_clamp = BoolProperty(
+                             name="Clamp sun",
+                             description="Clamp the sun of the environment image to the level of the sky.\n"+
+                             "The sun lamp carries the energy of the sun so it is not counted twice.",
+                             default=False,
+                             update=update_mat)
+
+#---Remove the sun from the environment image
+    sun_split = EnumProperty(
+                             name="Remove sun",
+                             description="Use a copy of the environment image without its sun.\n"+
+                             "The sun lamp carries the energy of the sun : no double lighting and less fireflies.",
+                             items=(
+                             ('NONE', "Keep sun", "Use the environment image as is"),
+                             ('INPAINT', "Inpaint", "Replace the sun by the sky around it"),
+                             ('CLAMP', "Clamp", "Clamp the area of the sun to the level of the sky"),
+                             ),
+                             default='NONE',
+                             update=update_mat)
+
+#---One sun lamp or several lamps extracted from the environment image
+    light_mode = EnumProperty(
+                              name="Lights",
+                              description="Light the scene with one sun lamp or with the brightest areas of the environment image.",
+                              items=(
+                              ('SUN', "Sun", "One sun lamp aligned with the sun of the image"),
+                              ('EXTRACT', "Extract", "One sun or area lamp per bright area of the image : windows, softboxes..."),
+                              ),
+                              default='SUN',
+                              update=update_light_mode)
+
+#---Number of lamps to extract
+    extract_count = IntProperty(
+                                name="Lamps",
+                                description="Maximum number of lamps extracted from the environment image.",
+                                min=1, max=16,
+                                default=4,
+                                update=update_extract)
+
+#---Level of the bright areas to extract
+    extract_threshold = FloatProperty(
+                                      name="Threshold",
+                                      description="Level of the bright areas in EV above the median of the image.",
+                                      min=0.0, max=20.0,
+                                      default=3.0,
+                                      precision=1,
+                                      update=update_extract)
+
+#---Distance of the area lamps
+    extract_distance = FloatProperty(
+                                     name="Distance",
+                                     description="Distance of the extracted area lamps from the center of the scene.",
+                                     min=0.01, max=10000.0,
+                                     default=10.0,
+                                     subtype='DISTANCE',
+                                     unit='LENGTH',
+                                     update=update_extract)
+
+#---Rotation of the environment image at the first and last frames of the scene
+    time_rotation_start = FloatProperty(
+                                        name="Start",
+                                        description="Rotation of the environment image at the first frame of the scene.",
+                                        default=0.0,
+                                        precision=2)
+
+    time_rotation_end = FloatProperty(
+                                      name="End",
+                                      description="Rotation of the environment image at the last frame of the scene.",
+                                      default=360.0,
+                                      precision=2)
+
+#---Frames between two baked keys
+    time_step = IntProperty(
+                            name="Step",
+                            description="Number of frames between two baked keys.",
+                            min=1, max=1000,
+                            default=1)
+
+#---The animation of the light is baked
+    time_baked = BoolProperty(
+                              name="Baked",
+                              default=False)
+
+#---Date, hour and place of the sun
+    use_sun_position = BoolProperty(
+                                    name="Sun position",
+                                    description="Place the sun from the date, the hour and the place on the Earth.",
+                                    default=False,
+                                    update=update_sun_position)
+
+    sun_latitude = FloatProperty(
+                                 name="Latitude",
+                                 description="Latitude of the place in degrees, positive to the north.",
+                                 min=-90.0, max=90.0,
+                                 default=45.0,
+                                 precision=4,
+                                 update=update_sun_position)
+
+    sun_longitude = FloatProperty(
+                                  name="Longitude",
+                                  description="Longitude of the place in degrees, positive to the east.",
+                                  min=-180.0, max=180.0,
+                                  default=0.0,
+                                  precision=4,
+                                  update=update_sun_position)
+
+    sun_timezone = FloatProperty(
+                                 name="UTC",
+                                 description="Offset of the local time from UTC in hours, daylight saving included.",
+                                 min=-14.0, max=14.0,
+                                 default=0.0,
+                                 step=50,
+                                 update=update_sun_position)
+
+    sun_year = IntProperty(
+                           name="Year",
+                           min=1, max=9999,
+                           default=2017,
+                           update=update_sun_position)
+
+    sun_month = IntProperty(
+                            name="Month",
+                            min=1, max=12,
+                            default=6,
+                            update=update_sun_position)
+
+    sun_day = IntProperty(
+                          name="Day",
+                          min=1, max=31,
+                          default=21,
+                          update=update_sun_position)
+
+    sun_hour = FloatProperty(
+                             name="Hour",
+                             description="Local hour of the sun, the first frame of the baked day.",
+                             min=0.0, max=24.0,
+                             default=12.0,
+                             precision=2,
+                             update=update_sun_position)
+
+    sun_hour_end = FloatProperty(
+                                 name="End",
+                                 description="Local hour of the sun at the last frame of the baked day.",
+                                 min=0.0, max=48.0,
+                                 default=18.0,
+                                 precision=2)
+
+    sun_north = FloatProperty(
+                              name="North",
+                              description="Direction of the north in the scene : angle in degrees from the axis Y, counterclockwise.",
+                              min=-360.0, max=360.0,
+                              default=0.0,
+                              update=update_sun_position)
+
+#---Role of the lamp : the VisionHDR light or a lamp extracted for it
+    light_role = EnumProperty(
+                              name="Role",
+                              items=(
+                              ('MAIN', "Main", "VisionHDR light"),
+                              ('EXTRACTED', "Extracted", "Lamp extracted from the environment image of a light"),
+                              ),
+                              default='MAIN')
+
+#---Light the extracted lamp belongs to
+    light_owner = StringProperty(
+                                 name="Owner",
+                                 description="Light the lamp is extracted for.")
+
+#---Direction of the extracted lamp in the environment image
+    light_direction = FloatVectorProperty(
+                                          name="Direction",
+                                          size=3,
+                                          default=(0.0, 0.0, 1.0))
 
 #---Base Color of the light
     lightcolor = FloatVectorProperty(   
@@ -1167,7 +4420,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
     hdri_name = StringProperty(
                                name="HDRI", 
                                description="Name of the environment image texture.",
-                               update=update_mat)
+                               update=update_hdri_name)
 
 #---Rotation of the environment image on Z axis.
     hdri_rotation = FloatProperty(
@@ -1253,7 +4506,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                 min=-10, max=10.0,
                                 default=0,
                                 precision=2,
-                                update=update_mat)                      
+                                update=queue_update_mat)                      
 
 #---Contrast of the environment image.
     hdri_contrast = FloatProperty(
@@ -1264,7 +4517,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                   precision=2,
                                   subtype='NONE',
                                   unit='NONE',
-                                  update=update_mat) 
+                                  update=queue_update_mat) 
 
 #---Gamma of the environment image.
     hdri_gamma = FloatProperty(
@@ -1275,7 +4528,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                precision=2,
                                subtype='NONE',
                                unit='NONE',
-                               update=update_mat) 
+                               update=queue_update_mat) 
 
 #---Hue of the environment image.
     hdri_hue = FloatProperty(
@@ -1286,7 +4539,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                              precision=2,
                              subtype='NONE',
                              unit='NONE',
-                             update=update_mat) 
+                             update=queue_update_mat) 
 
 #---Saturation of the environment image.
     hdri_saturation = FloatProperty(
@@ -1298,7 +4551,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                     precision=2,
                                     subtype='NONE',
                                     unit='NONE',
-                                    update=update_mat) 
+                                    update=queue_update_mat) 
 
 #---Value of the environment image.
     hdri_value = FloatProperty(
@@ -1310,7 +4563,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                precision=2,
                                subtype='NONE',
                                unit='NONE',
-                               update=update_mat) 
+                               update=queue_update_mat) 
 
 #---Name of the background image texture
     img_name = StringProperty(
@@ -1352,7 +4605,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                min=-10, max=10.0,
                                default=0,
                                precision=2,
-                               update=update_mat)                       
+                               update=queue_update_mat)                       
 
 #---Contrast of the background image.
     img_contrast = FloatProperty(
@@ -1363,7 +4616,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                  precision=2,
                                  subtype='NONE',
                                  unit='NONE',
-                                 update=update_mat) 
+                                 update=queue_update_mat) 
 
 #---Gamma of the background image.
     img_gamma = FloatProperty(
@@ -1374,7 +4627,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                               precision=2,
                               subtype='NONE',
                               unit='NONE',
-                              update=update_mat) 
+                              update=queue_update_mat) 
 
 #---Hue of the background image.
     img_hue = FloatProperty(
@@ -1385,7 +4638,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                             precision=2,
                             subtype='NONE',
                             unit='NONE',
-                            update=update_mat) 
+                            update=queue_update_mat) 
 
 #---Saturation of the background image.
     img_saturation = FloatProperty(
@@ -1397,7 +4650,7 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                                    precision=2,
                                    subtype='NONE',
                                    unit='NONE',
-                                   update=update_mat) 
+                                   update=queue_update_mat) 
 
 #---Value of the background image.
     img_value = FloatProperty(
@@ -1409,7 +4662,71 @@ class VisionHDRObj(bpy.types.PropertyGroup):
                               precision=2,
                               subtype='NONE',
                               unit='NONE',
-                              update=update_mat)  
+                              update=queue_update_mat)  
+
+#---Spherical harmonics of the environment image (9 RGB coefficients)
+    sh_coeffs = FloatVectorProperty(
+                                    name="Spherical harmonics",
+                                    description="L2 spherical harmonics coefficients of the environment image.",
+                                    size=27,
+                                    default=(0.0,) * 27)
+
+#---Light the scene with the spherical harmonics instead of the environment image
+    sh_lighting = BoolProperty(
+                               name="SH lighting",
+                               description="Replace the environment image by its spherical harmonics.\n"+
+                               "Fast approximate lighting for look-dev and previews.",
+                               default=False,
+                               update=update_mat)
+
+#---Map resolution recommended by the importance map of the environment image
+    importance_resolution = IntProperty(
+                                        name="Recommended map resolution",
+                                        description="Map resolution recommended by the importance map of the environment image.",
+                                        default=0)
+
+#---Set the map resolution of the world from the importance map
+    importance_auto = BoolProperty(
+                                   name="Auto map resolution",
+                                   description="Set the map resolution of the world from the importance map of the environment image.",
+                                   default=False,
+                                   update=update_importance)
+
+#########################################################################################################
+
+#########################################################################################################
+
+class VisionHDRScene(bpy.types.PropertyGroup):
+#---Rotation of the environment image in this scene
+    use_rotation = BoolProperty(
+                                name="Override rotation",
+                                description="Use a rotation of the environment image for this scene only.",
+                                default=False,
+                                update=update_scene_override)
+
+    rotation = FloatProperty(
+                             name="Rotation",
+                             description="Rotation of the environment image in this scene.",
+                             min=-360.0, max=360.0,
+                             default=0.0,
+                             precision=2,
+                             update=update_scene_override)
+
+#---Exposure of the environment in this scene
+    use_exposure = BoolProperty(
+                                name="Override exposure",
+                                description="Use an exposure of the environment for this scene only.",
+                                default=False,
+                                update=update_scene_override)
+
+    exposure = FloatProperty(
+                             name="Exposure",
+                             description="Exposure of the environment in this scene (EV).",
+                             min=-20.0, max=20.0,
+                             soft_min=-5.0, soft_max=5.0,
+                             default=0.0,
+                             precision=2,
+                             update=update_scene_override)
 
 #########################################################################################################
 
@@ -1458,6 +4775,18 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
             row.label(text="Map resolution: ")
             row.prop(active_world_cycles, "sample_map_resolution", text="")
             row = col.row(align=True)   
+        #---Importance map of the environment image
+            if cobj.VisionHDR.hdri_name != "":
+                op = row.operator("object.hdri_importance", text="Importance map", icon='IMAGE_COL')
+                op.act_light = cobj.name
+                row.prop(cobj.VisionHDR, "importance_auto", text="Auto", toggle=True)
+                if cobj.VisionHDR.importance_resolution:
+                    row = col.row(align=True)
+                    row.label(text="Recommended: %d" % cobj.VisionHDR.importance_resolution)
+                if _importance_items:
+                    row = col.row(align=True)
+                    row.template_icon_view(context.window_manager, "visionhdr_importance")
+                row = col.row(align=True)
         #---Samples
             row.label(text="Samples: ")
             row.prop(active_world_cycles, "samples", text="")
@@ -1483,6 +4812,20 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
             row.label(text="Look: ")
             row.prop(scene_view, "look", text="")
             row = col.row(align=True)   
+        #---Overrides of the scene, the world is shared by the scenes
+            col = box.column(align=True)
+            row = col.row(align=True)
+            row.prop(scene.visionhdr, "use_rotation", text="")
+            sub = row.row(align=True)
+            sub.active = scene.visionhdr.use_rotation
+            sub.prop(scene.visionhdr, "rotation", text="Scene rotation")
+            row = col.row(align=True)
+            row.prop(scene.visionhdr, "use_exposure", text="")
+            sub = row.row(align=True)
+            sub.active = scene.visionhdr.use_exposure
+            sub.prop(scene.visionhdr, "exposure", text="Scene exposure")
+            row = col.row(align=True)
+            row.operator("scene.apply_hdri_rig", text="Apply to scenes", icon='SCENE_DATA')
 
             
         elif cobj.VisionHDR.options_type == "Sun":
@@ -1512,6 +4855,67 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
             row.prop(cobj.VisionHDR, "rotation_lock_sun", text='')
             col = box.column(align=True)
             row = col.row(align=True)
+        #---Time of day : rotation baked over the frames
+            row.prop(cobj.VisionHDR, "time_rotation_start")
+            row.prop(cobj.VisionHDR, "time_rotation_end")
+            row.prop(cobj.VisionHDR, "time_step")
+            row = col.row(align=True)
+            op = row.operator("object.bake_hdri_time", text="Bake time of day", icon='TIME')
+            op.act_light = cobj.name
+            if cobj.VisionHDR.time_baked:
+                op = row.operator("object.clear_hdri_time", text="Clear", icon='X')
+                op.act_light = cobj.name
+            col = box.column(align=True)
+            row = col.row(align=True)
+        #---Sun position from the date and the place
+            row.prop(cobj.VisionHDR, "use_sun_position", toggle=True, icon='WORLD')
+            if cobj.VisionHDR.use_sun_position:
+                row = col.row(align=True)
+                row.prop(cobj.VisionHDR, "sun_latitude")
+                row.prop(cobj.VisionHDR, "sun_longitude")
+                row = col.row(align=True)
+                row.prop(cobj.VisionHDR, "sun_year")
+                row.prop(cobj.VisionHDR, "sun_month")
+                row.prop(cobj.VisionHDR, "sun_day")
+                row = col.row(align=True)
+                row.prop(cobj.VisionHDR, "sun_hour")
+                row.prop(cobj.VisionHDR, "sun_timezone")
+                row.prop(cobj.VisionHDR, "sun_north")
+                row = col.row(align=True)
+                op = row.operator("object.place_hdri_sun", text="Place", icon='LAMP_SUN')
+                op.act_light = cobj.name
+                row.prop(cobj.VisionHDR, "sun_hour_end")
+                op = row.operator("object.bake_hdri_sun_position", text="Bake the day", icon='TIME')
+                op.act_light = cobj.name
+            col = box.column(align=True)
+            row = col.row(align=True)
+        #---Calibration from the environment image
+            if cobj.VisionHDR.hdri_name != "":
+                op = row.operator("object.calibrate_sun", text="Calibrate", icon='LAMP_SUN')
+                op.act_light = cobj.name
+                row.prop(cobj.VisionHDR, "sun_calibrate", text="Auto", toggle=True)
+                row.prop(cobj.VisionHDR, "sun_clamp", text="Clamp sun", toggle=True)
+                row = col.row(align=True)
+                row.prop(cobj.VisionHDR, "sun_split", text="")
+                col = box.column(align=True)
+                row = col.row(align=True)
+            #---Lamps extracted from the environment image
+                row.prop(cobj.VisionHDR, "light_mode", expand=True)
+                if cobj.VisionHDR.light_mode == 'EXTRACT':
+                    row = col.row(align=True)
+                    row.prop(cobj.VisionHDR, "extract_count")
+                    row.prop(cobj.VisionHDR, "extract_threshold")
+                    row = col.row(align=True)
+                    row.prop(cobj.VisionHDR, "extract_distance")
+                    op = row.operator("object.extract_hdri_lights", text="Extract", icon='FILE_REFRESH')
+                    op.act_light = cobj.name
+                    for light in get_extracted(context, cobj.VisionHDR.lightname):
+                        row = col.row(align=True)
+                        row.label(text=light.name, icon='LAMP_SUN' if light.data.type == 'SUN' else 'LAMP_AREA')
+                        row.prop(light.VisionHDR, "sun_energy", text="")
+                        row.prop(light.VisionHDR, "lightcolor", text="")
+                col = box.column(align=True)
+                row = col.row(align=True)
         #---MIS/Shadows/Diffuse/Specular
             row.prop(lamp.data.cycles, "use_multiple_importance_sampling", text='MIS', toggle=True)
             row.prop(lamp.data.cycles, "cast_shadow", text='Shadow', toggle=True)
@@ -1533,6 +4937,10 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                 op.img_type = "HDRI"
                 op.img_size_x = bpy.data.images[cobj.VisionHDR.hdri_name].size[0]
                 op.img_size_y = bpy.data.images[cobj.VisionHDR.hdri_name].size[1]
+                op = row.operator("object.detect_sun", text ='Auto-detect sun', icon='LAMP_SUN')
+                op.act_light = cobj.name 
+                op.img_name = cobj.VisionHDR.hdri_name
+                op.img_type = "HDRI"
                 
                 col = box.column()
                 col = box.column(align=True)
@@ -1544,7 +4952,7 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
             
         #---HDRI color
             if cobj.VisionHDR.hdri_name == "":
-                hdri_col = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['VisionHDR_Background1'].inputs[0] 
+                hdri_col = get_world_graph(context.scene.world)["background1"].inputs[0] 
                 row.prop(hdri_col, "default_value", text="")
             else:
             #---HDRI Rotation
@@ -1583,8 +4991,13 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                         row.prop(cobj.VisionHDR, "hdri_value", text="Value")
                     #---Mirror / Equirectangular
                         row = col.row(align=True)
-                        hdri_img = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['Environment Texture']
+                        hdri_img = get_world_graph(context.scene.world)["hdri_text"]
                         row.prop(hdri_img, "projection", text="")
+                    #---Spherical harmonics
+                        row = col.row(align=True)
+                        op = row.operator("object.hdri_sh_project", text="Spherical harmonics")
+                        op.act_light = cobj.name
+                        row.prop(cobj.VisionHDR, "sh_lighting", text="SH lighting", toggle=True)
                     #---Reset values
                         row = col.row(align=True)
                         row.prop(cobj.VisionHDR, "hdri_reset", text="Reset options", toggle=True)
@@ -1606,6 +5019,10 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                     op.img_type = "IMG"
                     op.img_size_x = bpy.data.images[cobj.VisionHDR.img_name].size[0]
                     op.img_size_y = bpy.data.images[cobj.VisionHDR.img_name].size[1]
+                    op = row.operator("object.detect_sun", text ='Auto-detect sun', icon='LAMP_SUN')
+                    op.act_light = cobj.name 
+                    op.img_name = cobj.VisionHDR.img_name
+                    op.img_type = "IMG"
                     col = box.column()
                     col = box.column(align=True)
                 
@@ -1617,7 +5034,7 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                 
             #---Background color
                 if cobj.VisionHDR.img_name == "":
-                    back_col = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['VisionHDR_Background2'].inputs[0] 
+                    back_col = get_world_graph(context.scene.world)["background2"].inputs[0] 
                     row.prop(back_col, "default_value", text="")    
 
                 else:
@@ -1655,11 +5072,11 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                         row.prop(cobj.VisionHDR, "img_value", text="Value")
                     #---Blur
                         row = col.row(align=True)
-                        reflection_blur = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['Mix.001'].inputs[0] 
+                        reflection_blur = get_world_graph(context.scene.world)["blur"].inputs[0] 
                         row.prop(reflection_blur, "default_value", text="Blur", slider = True)
                     #---Mirror / Equirectangular
                         row = col.row(align=True)
-                        back_img = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['Environment Texture.001']
+                        back_img = get_world_graph(context.scene.world)["img_text"]
                         row.prop(back_img, "projection", text="")
                     #---Reset values
                         row = col.row(align=True)
@@ -1669,6 +5086,22 @@ class VISIONHDR_PT_Preferences(bpy.types.Panel):
                 row = col.row(align=True)
                 row.prop(cobj.VisionHDR, "back_reflect", text='Background for reflection', toggle=True)
 
+        #---HDRI library
+            col = box.column(align=True)
+            row = col.row(align=True)
+            row.label(text="Library:")
+            row.operator("scene.hdri_library_scan", text="", icon='FILE_REFRESH')
+            if _library_items:
+                col.template_icon_view(context.window_manager, "visionhdr_library")
+                row = col.row(align=True)
+                op = row.operator("object.hdri_library_assign", text="Environment")
+                op.act_light = cobj.name
+                op.img_type = "HDRI"
+                if not cobj.VisionHDR.hdri_background:
+                    op = row.operator("object.hdri_library_assign", text="Background")
+                    op.act_light = cobj.name
+                    op.img_type = "IMG"
+
 """
 #########################################################################################################
 # LIGHT PARAMETER
@@ -1707,7 +5140,7 @@ class VISIONHDR_PT_Edit(bpy.types.Panel):
         #---Environment strength
             col = row.column(align=True)
             row = col.row(align=True)
-            hdr_back = bpy.data.worlds['VisionHDR_world'].node_tree.nodes['VisionHDR_Background1'].inputs['Strength']   
+            hdr_back = get_world_graph(context.scene.world)["background1"].inputs['Strength']   
             row.prop(hdr_back, "default_value", text='Env energy', slider = False)
         
         #---Light Name
@@ -1755,28 +5188,21 @@ class VISIONHDR_PT_Init(bpy.types.Panel):
 #----------------------------------
 # ADD LIGHTS
 #----------------------------------                    
-        active_world = ""
-        for world in bpy.data.worlds:
-            if world.name == "VisionHDR_world":
-                active_world = world
-                break
+        active_world = find_world(context)
                 
-        if active_world == "":
+        if active_world is None:
             row.operator("scene.addlightenv", text="New", icon='BLANK1')
             
         elif context.scene.world == active_world :
-            world = bpy.data.worlds[active_world.name].node_tree.nodes
 #----------------------------------
 # EDIT MODE
 #----------------------------------         
                         
-        #---For each layer
-            l = -1  
-            for layer in bpy.data.scenes[scene.name].layers:
-                l += 1
-                light_on_layer = [obj for obj in context.scene.objects if not obj.users_group and obj.type != 'EMPTY' and obj.layers[l] and layer == True and obj.data.name.startswith("VisionHDR")]
-                if layer == True and light_on_layer != []: 
-                    objects_on_layer.extend(light_on_layer)
+        #---Lights of the index on the visible layers, the scene is only scanned when the index is rebuilt
+            layers = scene.layers
+            for obj in get_lights(scene):
+                if not obj.users_group and any(layer and obj_layer for layer, obj_layer in zip(layers, obj.layers)):
+                    objects_on_layer.append(obj)
                 
             """
             #########################################################################################################
@@ -1791,7 +5217,7 @@ class VISIONHDR_PT_Init(bpy.types.Panel):
                 row = layout.row(align=True)
                 row.operator("scene.active_lamp", text="Active Sun Lamp", icon='BLANK1')
             else:
-                for self.object in list(set(objects_on_layer)):
+                for self.object in objects_on_layer:
                     VISIONHDR_PT_Edit.draw(self, context)
                     cobj = self.cobj
         else:
@@ -1800,14 +5226,74 @@ class VISIONHDR_PT_Init(bpy.types.Panel):
 
 #########################################################################################################
 
+HANDLERS = (
+    ("scene_update_post", raycaster_update),
+    ("scene_update_post", index_update),
+    ("scene_update_post", scheduler_flush),
+    ("scene_update_pre", profiler_update_pre),
+    ("scene_update_post", profiler_update_post),
+    ("load_post", scheduler_reset),
+    ("render_pre", proxy_render_pre),
+    ("render_post", proxy_render_post),
+    ("render_cancel", proxy_render_post),
+    ("load_post", raycaster_reset),
+    ("load_post", index_reset),
+    ("undo_post", index_reset),
+    ("redo_post", index_reset),
+    ("undo_post", raycaster_reset),
+    ("redo_post", raycaster_reset),
+    ("load_post", world_graph_reset),
+    ("load_post", world_graph_migrate),
+    ("load_post", sh_image_restore),
+    ("load_post", scene_override_reset),
+    ("scene_update_post", scene_override_update),
+    ("render_pre", scene_override_render_pre),
+    ("render_post", scene_override_render_post),
+    ("render_cancel", scene_override_render_post),
+    ("undo_post", world_graph_reset),
+    ("redo_post", world_graph_reset),
+    )
+
+WORKER_COMMANDS = {
+    "thumbnails": worker_thumbnails,
+    "proxy": worker_proxy,
+    "batch": worker_batch,
+    "batch_render": worker_batch_render,
+    }
+
 def register():
+    global _library_previews, _importance_previews
     bpy.utils.register_module(__name__)
     bpy.types.Object.VisionHDR = bpy.props.PointerProperty(type=VisionHDRObj)
+    bpy.types.Scene.visionhdr = bpy.props.PointerProperty(type=VisionHDRScene)
+    bpy.types.WindowManager.visionhdr_library = bpy.props.EnumProperty(name="Library", items=library_items)
+    bpy.types.WindowManager.visionhdr_importance = bpy.props.EnumProperty(name="Importance", items=importance_items)
+    for handler, function in HANDLERS:
+        getattr(bpy.app.handlers, handler).append(function)
+    _library_previews = bpy.utils.previews.new()
+    _importance_previews = bpy.utils.previews.new()
+    load_library_previews()
+    prefs = get_preferences()
+    _profiler.enabled = prefs is not None and prefs.profiling
     update_panel(None, bpy.context)
     
 def unregister():
+    global _library_previews, _importance_previews
+    for handler, function in HANDLERS:
+        getattr(bpy.app.handlers, handler).remove(function)
+    bpy.utils.previews.remove(_library_previews)
+    _library_previews = None
+    bpy.utils.previews.remove(_importance_previews)
+    _importance_previews = None
+    del bpy.types.WindowManager.visionhdr_library
+    del bpy.types.WindowManager.visionhdr_importance
     del bpy.types.Object.VisionHDR
+    del bpy.types.Scene.visionhdr
     bpy.utils.unregister_module(__name__)   
     
 if __name__ == "__main__":
-    register()
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if argv and argv[0] in WORKER_COMMANDS:
+        WORKER_COMMANDS[argv[0]](*argv[1:])
+    else:
+        register()
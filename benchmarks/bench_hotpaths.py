@@ -0,0 +1,207 @@
+# -*- coding:utf-8 -*-
+
+# Time of the VisionHDR hot paths on synthetic scenes and images.
+#
+# Run with :
+#   blender -b --factory-startup --python benchmarks/bench_hotpaths.py -- [output.json]
+#
+# Nothing is drawn or rendered : the scenes are built in background mode and only
+# the Python paths of the addon are timed, so it runs on a machine without GPU.
+# Compare the JSON of two versions to track the regressions.
+
+import bpy, os, sys, json, time, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import VisionHDR
+import numpy as np
+from mathutils import Vector
+
+SIZES = (100, 1000, 5000)
+LIGHTS = 10
+RESOLUTIONS = (1024, 2048, 4096)
+RAYS = 1000
+MIN_TIME = 0.2
+
+#########################################################################################################
+
+#########################################################################################################
+class BenchLayout():
+    """Layout of the panels in background mode : every call returns the layout itself"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls += 1
+            return self
+        return call
+
+#########################################################################################################
+
+#########################################################################################################
+class BenchPanel():
+    """Panel instance for the draw functions of the addon"""
+
+    def __init__(self):
+        self.layout = BenchLayout()
+
+#########################################################################################################
+
+#########################################################################################################
+def timeit(function, *args):
+    """Return the mean time of a call in microseconds and the number of calls"""
+    calls = 0
+    start = time.perf_counter()
+    while calls == 0 or time.perf_counter() - start < MIN_TIME:
+        function(*args)
+        calls += 1
+    return (time.perf_counter() - start) / calls * 1e6, calls
+
+#########################################################################################################
+
+#########################################################################################################
+def synthetic_hdri(name, size_x):
+    """Float image with a sky gradient and a small sun"""
+    size_y = size_x // 2
+    v = (np.arange(size_y, dtype=np.float32) + 0.5) / size_y
+    pixels = np.empty((size_y, size_x, 4), dtype=np.float32)
+    pixels[..., 0] = 0.2 + 0.6 * v[:, None]
+    pixels[..., 1] = 0.3 + 0.5 * v[:, None]
+    pixels[..., 2] = 0.6 + 0.3 * v[:, None]
+    pixels[..., 3] = 1.0
+    sun_x, sun_y, radius = size_x // 3, int(size_y * 0.7), max(1, size_x // 1024)
+    pixels[sun_y - radius:sun_y + radius + 1, sun_x - radius:sun_x + radius + 1, :3] = 5000.0
+
+    image = bpy.data.images.new(name, size_x, size_y, alpha=True, float_buffer=True)
+    VisionHDR.set_image_pixels(image, pixels)
+    return image
+
+#########################################################################################################
+
+#########################################################################################################
+def populate(scene, count):
+    """Add cubes and VisionHDR lamps to the scene up to count meshes"""
+    mesh = bpy.data.meshes.get("bench_cube")
+    if mesh is None:
+        mesh = bpy.data.meshes.new("bench_cube")
+        verts = [(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]
+        faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+        mesh.from_pydata(verts, [], faces)
+        mesh.update()
+
+    meshes = [obj for obj in scene.objects if obj.name.startswith("bench_mesh_")]
+    rng = random.Random(len(meshes))
+    for i in range(len(meshes), count):
+        obj = bpy.data.objects.new("bench_mesh_%d" % i, mesh)
+        obj.location = (rng.uniform(-100, 100), rng.uniform(-100, 100), rng.uniform(-10, 10))
+        scene.objects.link(obj)
+
+    for i in range(len([obj for obj in scene.objects if obj.name.startswith("bench_light_")]), LIGHTS):
+        lamp = bpy.data.lamps.new("VisionHDR_bench_%d" % i, 'SUN')
+        obj = bpy.data.objects.new("bench_light_%d" % i, lamp)
+        obj.VisionHDR.lightname = lamp.name
+        scene.objects.link(obj)
+    scene.update()
+
+#########################################################################################################
+
+#########################################################################################################
+def bench_scene(context, count, results):
+    """Paths of the scene : lookups, node updates, raycast and panel"""
+    scene = context.scene
+    populate(scene, count)
+    cobj = bpy.data.objects["VisionHDR_LAMP"]
+    graph = VisionHDR.get_world_graph(scene.world)
+
+    def update_mat_relink():
+        graph.topology = None
+        VisionHDR.update_mat(cobj.VisionHDR, context)
+
+    def update_rotation_hdri():
+        cobj.VisionHDR.hdri_rotation = (cobj.VisionHDR.hdri_rotation + 1.0) % 360
+
+#---Rays from above the scene to random points of the ground
+    rng = random.Random(count)
+    rays = [(Vector((rng.uniform(-100, 100), rng.uniform(-100, 100), 50)), Vector((rng.uniform(-0.5, 0.5), rng.uniform(-0.5, 0.5), -1)))
+            for i in range(RAYS)]
+
+    def raycast():
+        raycaster = VisionHDR.get_raycaster(context)
+        for origin, direction in rays:
+            raycaster.ray_cast(origin, direction)
+
+    panel = BenchPanel()
+    paths = (
+        ("get_object", VisionHDR.get_object, context, "VisionHDR_LAMP"),
+        ("get_lamp", VisionHDR.get_lamp, context, "VisionHDR_LAMP"),
+        ("update_mat", VisionHDR.update_mat, cobj.VisionHDR, context),
+        ("update_mat_relink", update_mat_relink),
+        ("update_rotation_hdri", update_rotation_hdri),
+        ("raycast_%d_rays" % RAYS, raycast),
+        ("panel_draw", VisionHDR.VISIONHDR_PT_Init.draw, panel, context),
+        )
+    for path in paths:
+        us, calls = timeit(*path[1:])
+        results.append({"path": path[0], "objects": len(scene.objects), "us": us, "calls": calls})
+        print("%-24s %6d objects : %12.2f us" % (path[0], len(scene.objects), us))
+
+#########################################################################################################
+
+#########################################################################################################
+def bench_image(cobj, size_x, results):
+    """Paths of the image : pixels, sun detection, pixel selection, proxy and spherical harmonics"""
+    image = synthetic_hdri("bench_hdri_%d" % size_x, size_x)
+    pixels = VisionHDR.image_pixels(image)
+    lum = VisionHDR.luminance(pixels)
+    rng = random.Random(size_x)
+    targets = [(rng.randrange(size_x), rng.randrange(size_x // 2)) for i in range(100)]
+
+    def select_pixels():
+        for x, y in targets:
+            VisionHDR.align_to_pixel(cobj, "HDRI", x, y, size_x, size_x // 2)
+
+    paths = (
+        ("image_pixels", VisionHDR.image_pixels, image),
+        ("find_sun_pixel", VisionHDR.find_sun_pixel, lum),
+        ("align_to_pixel_x100", select_pixels),
+        ("box_downsample_1024", VisionHDR.box_downsample, pixels, 1024),
+        ("sh_project", VisionHDR.sh_project, pixels),
+        )
+    for path in paths:
+        us, calls = timeit(*path[1:])
+        results.append({"path": path[0], "resolution": size_x, "us": us, "calls": calls})
+        print("%-24s %6d pixels  : %12.2f us" % (path[0], size_x, us))
+    bpy.data.images.remove(image, do_unlink=True)
+
+#########################################################################################################
+
+#########################################################################################################
+def main():
+    VisionHDR.register()
+    context = bpy.context
+    results = []
+
+    us, calls = timeit(VisionHDR.create_light_env, None, context)
+    results.append({"path": "create_light_env", "us": us, "calls": calls})
+    print("%-24s : %12.2f us" % ("create_light_env", us))
+
+    cobj = bpy.data.objects["VisionHDR_LAMP"]
+    cobj.VisionHDR.hdri_name = synthetic_hdri("bench_world", 1024).name
+
+    for count in SIZES:
+        bench_scene(context, count, results)
+    for size_x in RESOLUTIONS:
+        bench_image(cobj, size_x, results)
+
+    report = {
+        "blender": bpy.app.version_string,
+        "visionhdr": ".".join(str(v) for v in VisionHDR.bl_info["version"]),
+        "results": results,
+        }
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if argv:
+        with open(argv[0], 'w') as f:
+            json.dump(report, f, indent=2)
+
+main()
@@ -0,0 +1,81 @@
+# -*- coding:utf-8 -*-
+
+# Time of the VisionHDR object lookups as the scene grows.
+#
+# Run with :
+#   blender -b --factory-startup --python benchmarks/bench_lookup.py -- [output.json]
+#
+# The lookups through the index, misses included, and the scene_update_post
+# handler of the index must stay flat while the linear scan grows with the
+# number of objects.
+
+import bpy, os, sys, json, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import VisionHDR
+
+SIZES = (1000, 5000, 20000)
+CALLS = 200
+
+#########################################################################################################
+
+#########################################################################################################
+def linear_get_object(context, lightname):
+    """Lookup of the previous versions, kept as reference"""
+    for ob in context.scene.objects:
+        if ob.type != 'EMPTY' and ob.VisionHDR.lightname == lightname:
+            cobj = ob
+    return(cobj)
+
+#########################################################################################################
+
+#########################################################################################################
+def populate(scene, count):
+    """Add meshes to the scene up to count objects"""
+    mesh = bpy.data.meshes.get("bench_mesh") or bpy.data.meshes.new("bench_mesh")
+    for i in range(len(scene.objects), count):
+        scene.objects.link(bpy.data.objects.new("bench_%d" % i, mesh))
+    scene.update()
+
+#########################################################################################################
+
+#########################################################################################################
+def timeit(function, *args):
+    start = time.perf_counter()
+    for i in range(CALLS):
+        function(*args)
+    return (time.perf_counter() - start) / CALLS * 1e6
+
+#########################################################################################################
+
+#########################################################################################################
+def main():
+    VisionHDR.register()
+    context = bpy.context
+    scene = context.scene
+
+    lamp = bpy.data.objects.new("VisionHDR_LAMP", bpy.data.lamps.new("VisionHDR_LAMP", 'SUN'))
+    scene.objects.link(lamp)
+    lamp.VisionHDR.lightname = "VisionHDR_LAMP"
+
+    results = []
+    for count in SIZES:
+        populate(scene, count)
+        VisionHDR.get_object(context, "VisionHDR_LAMP")
+        result = {
+            "objects": len(scene.objects),
+            "get_object_us": timeit(VisionHDR.get_object, context, "VisionHDR_LAMP"),
+            "get_lamp_us": timeit(VisionHDR.get_lamp, context, "VisionHDR_LAMP"),
+            "get_object_miss_us": timeit(VisionHDR.get_object, context, "VisionHDR_MISSING"),
+            "index_update_us": timeit(VisionHDR.index_update, scene),
+            "linear_scan_us": timeit(linear_get_object, context, "VisionHDR_LAMP"),
+            }
+        results.append(result)
+        print("%(objects)6d objects : get_object %(get_object_us)8.2f us | get_lamp %(get_lamp_us)8.2f us | miss %(get_object_miss_us)8.2f us | handler %(index_update_us)8.2f us | linear scan %(linear_scan_us)10.2f us" % result)
+
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if argv:
+        with open(argv[0], 'w') as f:
+            json.dump(results, f, indent=2)
+
+main()
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+
+# The addon imports bpy at the top : outside of Blender, the top-level functions and the
+# constants of VisionHDR.py are compiled from its source so the NumPy paths are tested
+# without Blender. Inside Blender the module itself is used.
+
+import ast, importlib.util, math, os, sys, types
+import numpy as np
+import pytest
+
+ADDON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "VisionHDR.py")
+
+#########################################################################################################
+
+#########################################################################################################
+def load_functions(path):
+    """Module with the functions (without decorators) and the constants of the addon, the tests can patch it"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    
+    module = types.ModuleType("VisionHDR")
+    namespace = module.__dict__
+    namespace.update({"np": np, "math": math})
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            node.decorator_list = []
+        elif not (isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets)):
+            continue
+    #---Constants built from the classes or from bpy are left out
+        try:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), path, "exec"), namespace)
+        except (NameError, AttributeError):
+            pass
+    
+    return module
+
+#########################################################################################################
+
+#########################################################################################################
+@pytest.fixture(scope="session")
+def addon():
+    if importlib.util.find_spec("bpy") is None:
+        return load_functions(ADDON)
+    sys.path.insert(0, os.path.dirname(ADDON))
+    import VisionHDR
+    return VisionHDR
@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+
+# Importance map of the environment images, 2:1 or not.
+
+import numpy as np
+import pytest
+
+#########################################################################################################
+
+#########################################################################################################
+def sky(size_x, size_y):
+    """Gradient sky with a small bright sun"""
+    pixels = np.ones((size_y, size_x, 4), dtype=np.float32)
+    pixels[..., :3] *= np.linspace(0.2, 1.0, size_y, dtype=np.float32)[:, None, None]
+    pixels[size_y * 3 // 4:size_y * 3 // 4 + 2, size_x // 3:size_x // 3 + 2, :3] = 1000.0
+    return pixels
+
+#########################################################################################################
+
+#########################################################################################################
+@pytest.mark.parametrize("size_x, size_y", [(2048, 1024), (4096, 1024), (4096, 300), (1024, 2048), (200, 50)])
+def test_importance_map_shapes(addon, size_x, size_y):
+    """The maps of the image follow its rows and columns whatever its aspect"""
+    importance = addon.importance_map(sky(size_x, size_y))
+    
+    assert importance["marginal"].shape == (size_y,)
+    assert importance["marginal"][-1] == pytest.approx(1.0)
+    assert np.all(np.diff(importance["marginal"]) >= 0.0)
+    assert np.all(importance["resolutions"] <= max(256, min(size_x, 2 * size_y)))
+    assert 0.0 < float(importance["area_50"]) <= float(importance["area_90"]) <= 1.0
+
+def test_block_sums_keep_the_total(addon):
+    values = np.random.RandomState(0).rand(300, 600)
+    sums = addon.block_sums(values, 512, 256)
+    
+    assert sums.shape == (256, 512)
+    assert sums.sum() == pytest.approx(values.sum())
@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+
+# Round trips of the projections of the environment texture node, pixel centers at (x + 0.5, y + 0.5).
+
+import math
+import numpy as np
+import pytest
+
+SIZE_X, SIZE_Y = 64, 32
+BALL = 63
+
+#########################################################################################################
+
+#########################################################################################################
+def random_directions(count=1000, seed=0):
+    directions = np.random.RandomState(seed).normal(size=(3, count))
+    return directions / np.linalg.norm(directions, axis=0)
+
+def special_directions():
+    """Poles, axes and directions on both sides of the seam of the equirectangular image (-X)"""
+    eps = 1e-9
+    return np.array([
+        (0.0, 0.0, 1.0), (0.0, 0.0, -1.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, -1.0, 0.0), (-1.0, 0.0, 0.0),
+        (-1.0, eps, 0.0), (-1.0, -eps, 0.0), (-math.cos(0.3), 1e-6, math.sin(0.3)), (-math.cos(0.3), -1e-6, -math.sin(0.3)),
+        (1e-7, 0.0, 1.0), (-1e-7, 1e-7, -1.0),
+        ]).T
+
+def normalize(directions):
+    return directions / np.linalg.norm(directions, axis=0)
+
+#########################################################################################################
+
+#########################################################################################################
+def test_pixel_centers(addon):
+    """The center of the image looks at +X, the column -0.5 is the seam at -X and the row 0 is at the bottom"""
+    direction = addon.pixel_to_direction(SIZE_X / 2.0 - 0.5, SIZE_Y / 2.0 - 0.5, SIZE_X, SIZE_Y)
+    np.testing.assert_allclose(direction, (1.0, 0.0, 0.0), atol=1e-12)
+    np.testing.assert_allclose(addon.pixel_to_direction(-0.5, SIZE_Y / 2.0 - 0.5, SIZE_X, SIZE_Y), (-1.0, 0.0, 0.0), atol=1e-12)
+    assert addon.pixel_to_direction(0, 0, SIZE_X, SIZE_Y)[2] == pytest.approx(-math.cos(0.5 * math.pi / SIZE_Y))
+    assert addon.pixel_to_direction(0, SIZE_Y - 1, SIZE_X, SIZE_Y)[2] == pytest.approx(math.cos(0.5 * math.pi / SIZE_Y))
+    
+    x, y = addon.direction_to_pixel(1.0, 0.0, 0.0, SIZE_X, SIZE_Y)
+    assert (float(x), float(y)) == pytest.approx((SIZE_X / 2.0 - 0.5, SIZE_Y / 2.0 - 0.5))
+
+def test_equirectangular_pixel_round_trip(addon):
+    """Every pixel of the image, the rows of the poles and the columns of the seam included"""
+    x, y = np.meshgrid(np.arange(SIZE_X), np.arange(SIZE_Y))
+    px, py = addon.direction_to_pixel(*addon.pixel_to_direction(x, y, SIZE_X, SIZE_Y), size_x=SIZE_X, size_y=SIZE_Y)
+    
+    np.testing.assert_allclose(px, x, atol=1e-9)
+    np.testing.assert_allclose(py, y, atol=1e-9)
+
+def test_equirectangular_direction_round_trip(addon):
+    directions = np.concatenate((random_directions(), normalize(special_directions())), axis=1)
+    px, py = addon.direction_to_pixel(*directions, size_x=SIZE_X, size_y=SIZE_Y)
+    
+    np.testing.assert_allclose(addon.pixel_to_direction(px, py, SIZE_X, SIZE_Y), directions, atol=1e-9)
+
+def test_equirectangular_seam(addon):
+    """Both sides of the seam wrap in the columns [-0.5, size_x - 0.5)"""
+    px, py = addon.direction_to_pixel(*normalize(special_directions()), size_x=SIZE_X, size_y=SIZE_Y)
+    
+    assert np.all(px >= -0.5) and np.all(px < SIZE_X - 0.5)
+    assert np.all(py >= -0.5) and np.all(py <= SIZE_Y - 0.5)
+    x, y = addon.direction_to_pixel(-1.0, 1e-9, 0.0, SIZE_X, SIZE_Y)
+    assert float(x) == pytest.approx(-0.5, abs=1e-6)
+    x, y = addon.direction_to_pixel(-1.0, -1e-9, 0.0, SIZE_X, SIZE_Y)
+    assert float(x) == pytest.approx(SIZE_X - 0.5, abs=1e-6)
+
+def test_equirectangular_poles(addon):
+    for z, row in ((1.0, SIZE_Y - 0.5), (-1.0, -0.5)):
+        x, y = addon.direction_to_pixel(0.0, 0.0, z, SIZE_X, SIZE_Y)
+        assert float(y) == pytest.approx(row)
+        np.testing.assert_allclose(addon.pixel_to_direction(x, y, SIZE_X, SIZE_Y), (0.0, 0.0, z), atol=1e-12)
+
+#########################################################################################################
+
+#########################################################################################################
+def test_mirror_ball_center(addon):
+    """The center of the ball reflects the view back to the camera"""
+    center = (BALL - 1) / 2.0
+    np.testing.assert_allclose(addon.pixel_to_direction(center, center, BALL, BALL, 'MIRROR_BALL'), (0.0, -1.0, 0.0), atol=1e-12)
+
+def test_mirror_ball_pixel_round_trip(addon):
+    """Every pixel inside the ball, the rim left out where the directions converge"""
+    x, y = np.meshgrid(np.arange(BALL), np.arange(BALL))
+    u, v = addon.pixel_to_uv(x, y, BALL, BALL)
+    inside = (2.0 * u - 1.0) ** 2 + (2.0 * v - 1.0) ** 2 < 0.99
+    x, y = x[inside], y[inside]
+    px, py = addon.direction_to_pixel(*addon.pixel_to_direction(x, y, BALL, BALL, 'MIRROR_BALL'), size_x=BALL, size_y=BALL, projection='MIRROR_BALL')
+    
+    np.testing.assert_allclose(px, x, atol=1e-9)
+    np.testing.assert_allclose(py, y, atol=1e-9)
+
+def test_mirror_ball_direction_round_trip(addon):
+    """All the directions but the one behind the ball, the poles and the seam of the equirectangular image included"""
+    directions = np.concatenate((random_directions(), normalize(special_directions())), axis=1)
+    directions = directions[:, directions[1] < 1.0 - 1e-6]
+    px, py = addon.direction_to_pixel(*directions, size_x=BALL, size_y=BALL, projection='MIRROR_BALL')
+    
+    assert np.all((px >= -0.5) & (px <= BALL - 0.5) & (py >= -0.5) & (py <= BALL - 0.5))
+    np.testing.assert_allclose(addon.pixel_to_direction(px, py, BALL, BALL, 'MIRROR_BALL'), directions, atol=1e-6)
+
+def test_mirror_ball_outside(addon):
+    """The corners of the image are outside of the ball"""
+    np.testing.assert_array_equal(addon.pixel_to_direction(0, 0, BALL, BALL, 'MIRROR_BALL'), (0.0, 0.0, 0.0))
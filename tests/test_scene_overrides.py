@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+
+# Overrides of the scene written on render_pre, with and without a baked time of day.
+
+import math
+import types
+import pytest
+
+MAPPING_PATH = 'nodes["VisionHDR_Mapping"].rotation'
+
+#########################################################################################################
+
+#########################################################################################################
+class World(dict):
+    """VisionHDR world with the custom property of the version of its graph"""
+
+    def __init__(self, node_tree):
+        dict.__init__(self, visionhdr_graph_version=3)
+        self.name = "VisionHDR_world"
+        self.library = None
+        self.node_tree = node_tree
+
+class FCurves():
+
+    def __init__(self, paths):
+        self.paths = set(paths)
+
+    def find(self, data_path, index=0):
+        return (data_path, index) if (data_path, index) in self.paths else None
+
+def animation(paths):
+    if paths is None:
+        return None
+    return types.SimpleNamespace(action=types.SimpleNamespace(fcurves=FCurves(paths)))
+
+@pytest.fixture
+def rig(addon, monkeypatch):
+    """Scene with one light and the nodes of its world"""
+    def make(time_baked=False, fcurves=None):
+        mapping = types.SimpleNamespace(rotation=[0.0, 0.0, -0.5], path_from_id=lambda name: MAPPING_PATH)
+        graph = {"mapping": mapping, "exposure": None}
+        light = types.SimpleNamespace(
+            name="VisionHDR_LAMP",
+            library=None,
+            rotation_euler=types.SimpleNamespace(z=0.25),
+            VisionHDR=types.SimpleNamespace(time_baked=time_baked, rotation_lock_sun=True, hdri_rotation=90.0, hdri_pix_rot=30.0))
+        world = World(types.SimpleNamespace(animation_data=animation(fcurves)))
+        scene = types.SimpleNamespace(world=world, visionhdr=types.SimpleNamespace(use_rotation=False, rotation=0.0, use_exposure=False, exposure=0.0))
+        monkeypatch.setattr(addon, "get_index", lambda scene: types.SimpleNamespace(lights=[light]))
+        monkeypatch.setattr(addon, "get_world_graph", lambda world: graph)
+        return scene, mapping, light
+    return make
+
+#########################################################################################################
+
+#########################################################################################################
+def test_render_pre_writes_the_static_rotation(addon, rig):
+    scene, mapping, light = rig()
+    addon.scene_override_render_pre(scene)
+    
+    assert mapping.rotation[2] == pytest.approx(-math.radians(90.0))
+    assert light.rotation_euler.z == pytest.approx(math.radians(90.0 - 30.0))
+
+@pytest.mark.parametrize("time_baked, fcurves", [
+    (True, None),
+    (False, [(MAPPING_PATH, 2)]),
+    ])
+def test_render_pre_leaves_an_animated_mapping(addon, rig, time_baked, fcurves):
+    """The values evaluated from the fcurves of the frame are kept for the render"""
+    scene, mapping, light = rig(time_baked, fcurves)
+    addon.scene_override_render_pre(scene)
+    
+    assert mapping.rotation[2] == -0.5
+    assert light.rotation_euler.z == 0.25
+
+def test_other_fcurves_do_not_lock_the_rotation(addon, rig):
+    scene, mapping, light = rig(fcurves=[(MAPPING_PATH, 0)])
+    addon.scene_override_render_pre(scene)
+    
+    assert mapping.rotation[2] == pytest.approx(-math.radians(90.0))
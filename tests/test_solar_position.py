@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+
+# Solar position against the published reference values of the NOAA and SPA calculators.
+
+import datetime
+import numpy as np
+import pytest
+
+#########################################################################################################
+
+#########################################################################################################
+def solar_day(addon, date, latitude, longitude, timezone, step=10.0 / 3600.0):
+    """Local hours of a day with the azimuth and elevation of the sun"""
+    hours = np.arange(0.0, 24.0, step)
+    azimuth, elevation = addon.solar_position(addon.local_timestamps(date[0], date[1], date[2], hours, timezone), latitude, longitude)
+    return hours, azimuth, elevation
+
+#########################################################################################################
+
+#########################################################################################################
+@pytest.mark.parametrize("date, hours, timezone", [
+    ((1970, 1, 1), 0.0, 0.0),
+    ((2000, 1, 1), 12.0, 0.0),
+    ((2003, 10, 17), 12.5 + 30.0 / 3600.0, -7.0),
+    ((2024, 2, 29), 23.75, 5.5),
+    ((1900, 3, 1), 6.0, -3.0),
+    ])
+def test_local_timestamps(addon, date, hours, timezone):
+    utc = datetime.datetime(*date, tzinfo=datetime.timezone.utc) + datetime.timedelta(hours=hours - timezone)
+    expected = (utc - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)).total_seconds()
+    assert float(addon.local_timestamps(*date, hours=hours, timezone=timezone)) == pytest.approx(expected, abs=1e-3)
+
+def test_spa_reference(addon):
+    """Example of the SPA report (Reda & Andreas, NREL 2004) : Golden, 2003-10-17 12:30:30 -7h"""
+    timestamp = addon.local_timestamps(2003, 10, 17, 12.5 + 30.0 / 3600.0, -7.0)
+    azimuth, elevation = addon.solar_position(timestamp, 39.742476, -105.1786)
+    
+    assert float(azimuth) == pytest.approx(194.34024, abs=0.02)
+    assert 90.0 - float(elevation) == pytest.approx(50.11162, abs=0.02)
+
+@pytest.mark.parametrize("date, latitude, longitude, timezone, elevation, azimuth", [
+#---Solstice of June : 90 - latitude + 23.44 at the transit, to the south or to the north
+    ((2021, 6, 21), 40.0, -105.0, -7.0, 73.44, 180.0),
+    ((2021, 6, 21), -33.87, 151.21, 10.0, 32.72, 0.0),
+#---Equinox on the equator (09:37 UTC) : 2.5 hours later the declination is 0.04 degrees
+    ((2021, 3, 20), 0.0, 0.0, 0.0, 89.96, None),
+    ])
+def test_transit(addon, date, latitude, longitude, timezone, elevation, azimuth):
+    hours, azimuths, elevations = solar_day(addon, date, latitude, longitude, timezone)
+    i = int(np.argmax(elevations))
+    
+    assert elevations[i] == pytest.approx(elevation, abs=0.05)
+    if azimuth is not None:
+        assert abs((azimuths[i] - azimuth + 180.0) % 360.0 - 180.0) < 0.5
+
+def test_polar_day_and_night(addon):
+    """Tromso : the sun does not set at the solstice of June and does not rise at the solstice of December"""
+    hours, azimuth, elevation = solar_day(addon, (2021, 6, 21), 69.65, 18.96, 2.0)
+    assert elevation.min() == pytest.approx(3.3, abs=0.1)
+    assert elevation.min() > 0.0
+    
+    hours, azimuth, elevation = solar_day(addon, (2021, 12, 21), 69.65, 18.96, 1.0)
+    assert elevation.max() == pytest.approx(-2.98, abs=0.1)
+    assert elevation.max() < 0.0
+
+def test_south_pole(addon):
+    """At the pole the sun turns around the sky at the height of the declination"""
+    hours, azimuth, elevation = solar_day(addon, (2021, 12, 21), -90.0, 0.0, 0.0)
+    assert np.ptp(elevation) < 0.05
+    assert elevation.mean() == pytest.approx(23.47, abs=0.05)
+
+@pytest.mark.parametrize("date, transit", [
+#---Equation of time : +16.4 minutes early in November, -14.2 minutes in February
+    ((2021, 11, 3), 12.0 - 16.4 / 60.0),
+    ((2021, 2, 11), 12.0 + 14.2 / 60.0),
+    ])
+def test_timezone_and_longitude(addon, date, transit):
+    """On the meridian of its time zone the sun transits at noon corrected by the equation of time"""
+    hours, azimuth, elevation = solar_day(addon, date, 45.0, 15.0, 1.0)
+    assert hours[np.argmax(elevation)] == pytest.approx(transit, abs=1.0 / 60.0)
+    
+#---The same instant in the time zone of the meridian 0, where the sun comes one hour later
+    timestamps = addon.local_timestamps(date[0], date[1], date[2], hours, 1.0)
+    np.testing.assert_array_equal(timestamps, addon.local_timestamps(date[0], date[1], date[2], hours - 1.0, 0.0))
+    azimuth_west, elevation_west = addon.solar_position(timestamps + 3600.0, 45.0, 0.0)
+    np.testing.assert_allclose(elevation_west, elevation, atol=0.05)
+
+def test_vectorized(addon):
+    """Days of a year and hours of a day in one call, the same values as the scalar calls"""
+    days = np.arange(1, 366)
+    timestamps = addon.local_timestamps(2021, 1, days[:, None], np.arange(0.0, 24.0, 0.5)[None, :], 2.0)
+    azimuth, elevation = addon.solar_position(timestamps, 48.85, 2.35)
+    
+    assert azimuth.shape == elevation.shape == (365, 48)
+    assert np.all((azimuth >= 0.0) & (azimuth < 360.0))
+    assert np.all((elevation >= -90.0) & (elevation <= 90.0))
+    scalar = addon.solar_position(float(timestamps[170, 27]), 48.85, 2.35)
+    assert (float(scalar[0]), float(scalar[1])) == pytest.approx((azimuth[170, 27], elevation[170, 27]))
+
+def test_sun_tint(addon):
+    """White at the zenith, redder and redder down to the horizon"""
+    tint = addon.sun_tint(np.array([90.0, 45.0, 10.0, 1.0]))
+    
+    assert tint.shape == (4, 3)
+    np.testing.assert_allclose(tint[0], 1.0, atol=1e-3)
+    np.testing.assert_allclose(tint.max(axis=-1), 1.0)
+    assert np.all(tint[:, 0] >= tint[:, 1]) and np.all(tint[:, 1] >= tint[:, 2])
+    assert np.all(np.diff(tint[:, 2]) < 0.0)
+    assert tint[-1, 2] < 0.05
@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+
+# Irradiance of the L2 spherical harmonics against a direct quadrature over the sphere.
+
+import math
+import numpy as np
+import pytest
+
+SIZE_X, SIZE_Y = 256, 128
+
+#########################################################################################################
+
+#########################################################################################################
+def radiance_map(addon, function):
+    """Float RGBA equirectangular image of the radiance function(x, y, z)"""
+    x, y, z = addon.equirect_directions(SIZE_X, SIZE_Y)
+    pixels = np.ones((SIZE_Y, SIZE_X, 4), dtype=np.float32)
+    pixels[..., :3] = np.asarray(function(x, y, z), dtype=np.float32)[..., None]
+    return pixels
+
+def quadrature_irradiance(addon, pixels, normals):
+    """Irradiance of the normals as the sum of the radiance weighted by the clamped cosine and the solid angles"""
+    x, y, z = addon.equirect_directions(SIZE_X, SIZE_Y)
+    weights = pixels[..., 0].astype(np.float64) * addon.equirect_solid_angles(SIZE_X, SIZE_Y)[:, None]
+    cosines = np.maximum(np.einsum('nk,khw->nhw', normals, np.stack((x, y, z))), 0.0)
+    return (cosines * weights).sum(axis=(1, 2))
+
+def random_normals(count=32, seed=0):
+    normals = np.random.RandomState(seed).normal(size=(count, 3))
+    return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+#########################################################################################################
+
+#########################################################################################################
+def test_constant_radiance(addon):
+    """A uniform sky of radiance L gives the irradiance pi * L to every normal"""
+    coeffs = addon.sh_project(radiance_map(addon, lambda x, y, z: 2.0 * np.ones_like(x)))
+    normals = random_normals()
+    irradiance = addon.sh_irradiance(coeffs, *normals.T)
+    
+    assert irradiance.shape == (len(normals), 3)
+    np.testing.assert_allclose(irradiance, 2.0 * math.pi, rtol=1e-3)
+
+@pytest.mark.parametrize("function", [
+    lambda x, y, z: 1.0 + 0.5 * z,
+    lambda x, y, z: 1.0 + 0.4 * x - 0.3 * y + 0.2 * x * z,
+    lambda x, y, z: 1.0 + 0.5 * (3.0 * z * z - 1.0) + 0.3 * (x * x - y * y),
+    ])
+def test_band_limited_radiance(addon, function):
+    """The L2 radiance is projected without loss : the irradiance matches the quadrature"""
+    pixels = radiance_map(addon, function)
+    normals = random_normals()
+    expected = quadrature_irradiance(addon, pixels, normals)
+    irradiance = addon.sh_irradiance(addon.sh_project(pixels), *normals.T)[:, 0]
+    
+    np.testing.assert_allclose(irradiance, expected, rtol=1e-2)
+
+def test_energy_conservation(addon):
+    """A sun lobe is not band limited but the energy over all the normals is kept"""
+    sun = np.array((0.3, -0.5, 0.81))
+    sun /= np.linalg.norm(sun)
+    pixels = radiance_map(addon, lambda x, y, z: 0.2 + 50.0 * ((x * sun[0] + y * sun[1] + z * sun[2]) > math.cos(math.radians(10.0))))
+    normals = random_normals(2048, seed=1)
+    expected = quadrature_irradiance(addon, pixels, normals)
+    irradiance = addon.sh_irradiance(addon.sh_project(pixels), *normals.T)[:, 0]
+    
+    assert irradiance.mean() == pytest.approx(expected.mean(), rel=2e-2)
+    
+#---The clamped cosine keeps the L2 approximation close to the full irradiance (Ramamoorthi & Hanrahan)
+    assert np.abs(irradiance - expected).mean() < 0.05 * expected.max()